@@ -4,13 +4,211 @@ import os
 import json
 import re
 import urllib.parse
-import inspect
+import struct
+import threading
+import time
+from io import StringIO
 from botocore.exceptions import ClientError
 
 
 class RequiredTableNotUpdated(Exception):
     """ This is a custom exception to report back to the AWS Step Function that a required table does not exist or has not yet been updated with the current reference time. """
 
+###################################################################################################################################################
+###################################################################################################################################################
+class connection_manager:
+    """ Module-level pool of db connections and SQLAlchemy engines, keyed by db type and connection string. Because
+    lambda containers keep imported modules alive between warm invocations, connections are reused across invocations
+    instead of every invocation (and every database method) opening and tearing down its own. A db type whose
+    credentials or host change gets new connections, and the pooled connections of the old ones are closed.
+
+    Pooled psycopg2 connections are handed out as usual, and calling close() on them returns them to the pool.
+    Connections that have sat idle for DB_POOL_PRE_PING_SECONDS are checked with a "SELECT 1" before they are reused,
+    and connections older than DB_POOL_RECYCLE_SECONDS are replaced. Returned connections (engine connections too)
+    are cleaned up with DISCARD ALL, so session state that a caller set (e.g. SET work_mem, temp tables) does not leak
+    into the next invocation.
+    Set DB_POOL_MAX_IDLE to 0 to disable pooling, e.g. if a proxy should do all of the pooling. """
+    max_idle = int(os.environ.get('DB_POOL_MAX_IDLE', 2))
+    recycle_seconds = int(os.environ.get('DB_POOL_RECYCLE_SECONDS', 1800))
+    pre_ping_seconds = int(os.environ.get('DB_POOL_PRE_PING_SECONDS', 60))
+    connect_timeout = int(os.environ.get('DB_CONNECT_TIMEOUT', 10))
+
+    _lock = threading.Lock()
+    _idle_connections = {}
+    _engines = {}
+    _connection_class = None
+    stats = {}
+
+    ###################################
+    @classmethod
+    def _count(cls, db_type, stat):
+        with cls._lock:
+            db_stats = cls.stats.setdefault(db_type, {'acquired': 0, 'created': 0, 'reused': 0, 'released': 0, 'discarded': 0})
+            db_stats[stat] += 1
+
+    ###################################
+    @classmethod
+    def get_connect_args(cls, db_type):
+        connect_args = {
+            'connect_timeout': cls.connect_timeout,
+            'keepalives': 1,
+            'keepalives_idle': 30,
+            'application_name': os.environ.get('AWS_LAMBDA_FUNCTION_NAME', 'hydrovis')[:63]
+        }
+        return connect_args
+
+    ###################################
+    @classmethod
+    def _get_connection_class(cls):
+        if cls._connection_class is None:
+            import psycopg2.extensions
+
+            class pooled_connection(psycopg2.extensions.connection):
+                """ psycopg2 connection that returns itself to the connection_manager pool when closed. """
+                def close(self):
+                    cls.release(self)
+
+                def discard(self):
+                    psycopg2.extensions.connection.close(self)
+
+            cls._connection_class = pooled_connection
+        return cls._connection_class
+
+    ###################################
+    @classmethod
+    def get_connection(cls, db_type, dsn):
+        """ Returns a pooled psycopg2 connection for the db type, reusing an idle, healthy one when possible. """
+        import psycopg2
+        pool_key = (db_type, dsn)
+        with cls._lock:
+            stale_connections = [
+                connection for key in list(cls._idle_connections) if key[0] == db_type and key != pool_key
+                for connection in cls._idle_connections.pop(key)
+            ]
+        for connection in stale_connections:
+            cls._count(db_type, 'discarded')
+            connection.pooled = False
+            connection.discard()
+
+        while True:
+            with cls._lock:
+                idle = cls._idle_connections.get(pool_key, [])
+                connection = idle.pop() if idle else None
+            if connection is None:
+                break
+            if cls._is_healthy(connection):
+                cls._count(db_type, 'acquired')
+                cls._count(db_type, 'reused')
+                connection.pooled = False
+                connection.lease_id += 1
+                return connection
+            cls._count(db_type, 'discarded')
+            connection.pooled = False
+            connection.discard()
+
+        connection = psycopg2.connect(dsn, connection_factory=cls._get_connection_class(), **cls.get_connect_args(db_type))
+        connection.db_type = db_type
+        connection.pool_key = pool_key
+        connection.created_at = time.monotonic()
+        connection.released_at = connection.created_at
+        connection.lease_id = 0
+        connection.pooled = False
+        cls._count(db_type, 'acquired')
+        cls._count(db_type, 'created')
+        print(f"***> Established db connection to: {db_type} db ({cls.stats[db_type]})")
+        return connection
+
+    ###################################
+    @classmethod
+    def _is_healthy(cls, connection):
+        import psycopg2
+        now = time.monotonic()
+        if connection.closed or now - connection.created_at > cls.recycle_seconds:
+            return False
+        if now - connection.released_at < cls.pre_ping_seconds:
+            return True
+        try:
+            with connection.cursor() as cur:
+                cur.execute("SELECT 1")
+            connection.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    ###################################
+    @classmethod
+    def release(cls, connection):
+        """ Returns a connection to the pool, rolling back anything left uncommitted and resetting the session. """
+        if connection.pooled:  # Already returned to the pool
+            return
+        db_type = connection.db_type
+        connection.lease_id += 1
+        reset = not connection.closed and cls._reset_session(connection)
+
+        with cls._lock:
+            idle = cls._idle_connections.setdefault(connection.pool_key, [])
+            keep = reset and len(idle) < cls.max_idle
+            if keep:
+                connection.released_at = time.monotonic()
+                connection.pooled = True
+                idle.append(connection)
+        if keep:
+            cls._count(db_type, 'released')
+        else:
+            cls._count(db_type, 'discarded')
+            connection.discard()
+
+    ###################################
+    @staticmethod
+    def _reset_session(connection):
+        """ Rolls back anything left uncommitted and clears the session state of a psycopg2 connection. Returns False
+        if the connection is no longer usable. """
+        import psycopg2
+        try:
+            if connection.status != psycopg2.extensions.STATUS_READY:
+                connection.rollback()
+            # DISCARD ALL can't run inside a transaction block
+            connection.autocommit = True
+            with connection.cursor() as cur:
+                cur.execute("DISCARD ALL")
+            connection.autocommit = False
+            return True
+        except psycopg2.Error:
+            return False
+
+    ###################################
+    @classmethod
+    def get_engine(cls, db_type, url):
+        """ Returns the SQLAlchemy engine for the db type and url, creating it on first use (and disposing of the
+        engine of a previous url). Its pool pre-pings, recycles, and resets connections the same way as the psycopg2
+        pool. """
+        with cls._lock:
+            engine = cls._engines.get((db_type, url))
+            if engine is None:
+                for key in [key for key in cls._engines if key[0] == db_type]:
+                    cls._engines.pop(key).dispose()
+                from sqlalchemy import create_engine, event
+                engine = create_engine(
+                    url, pool_pre_ping=True, pool_recycle=cls.recycle_seconds, pool_size=max(cls.max_idle, 1),
+                    max_overflow=4, connect_args=cls.get_connect_args(db_type)
+                )
+                event.listen(engine, 'connect', lambda *args: cls._count(db_type, 'created'))
+                event.listen(engine, 'checkout', lambda *args: cls._count(db_type, 'acquired'))
+                event.listen(engine, 'checkin', lambda dbapi_connection, *args: dbapi_connection is not None and cls._reset_session(dbapi_connection))
+                cls._engines[(db_type, url)] = engine
+                print(f"***> Established db engine to: {db_type} db")
+        return engine
+
+    ###################################
+    @classmethod
+    def get_stats(cls):
+        """ Returns the connection counters of each db type, with reused = acquired - created for engines too. """
+        with cls._lock:
+            return {
+                db_type: {**db_stats, 'reused': db_stats['acquired'] - db_stats['created']}
+                for db_type, db_stats in cls.stats.items()
+            }
+
 ###################################################################################################################################################
 ###################################################################################################################################################
 class database: #TODO: Should we be creating a connection/engine upon initialization, or within each method like we are now?
@@ -18,6 +216,7 @@ class database: #TODO: Should we be creating a connection/engine upon initializa
         self.type = db_type.upper()
         self._engine = None
         self._connection = None
+        self._connection_lease = None
     
     def __exit__(self, exc_type, exc_value, traceback):
         if self._connection:
@@ -31,8 +230,10 @@ class database: #TODO: Should we be creating a connection/engine upon initializa
 
     @property
     def connection(self):
-        if not self._connection:
+        # Get a new connection if the previous one has been closed / returned to the pool
+        if not self._connection or self._connection.closed or getattr(self._connection, 'lease_id', None) != self._connection_lease:
             self._connection = self.get_db_connection()
+            self._connection_lease = getattr(self._connection, 'lease_id', None)
         return self._connection
     
     ###################################
@@ -45,20 +246,20 @@ class database: #TODO: Should we be creating a connection/engine upon initializa
 
     ###################################
     def get_db_engine(self):
-        from sqlalchemy import create_engine
         db_host, db_name, db_user, db_password = self.get_db_credentials()
-        db_engine = create_engine(f'postgresql://{db_user}:{db_password}@{db_host}/{db_name}')
-        print(f"***> Established db engine to: {db_host} from {inspect.stack()[1].function}()")
-        return db_engine
+        return connection_manager.get_engine(self.type, f'postgresql://{db_user}:{db_password}@{db_host}/{db_name}')
 
     ###################################
     def get_db_connection(self, asynchronous=False):
         import psycopg2
         db_host, db_name, db_user, db_password = self.get_db_credentials()
         port = 5439 if self.type == "REDSHIFT" else 5432
-        connection = psycopg2.connect(f"host={db_host} dbname={db_name} user={db_user} password={db_password} port={port}", async_=asynchronous)
-        print(f"***> Established db connection to: {db_host} from {inspect.stack()[1].function}()")
-        return connection
+        dsn = f"host={db_host} dbname={db_name} user={db_user} password={db_password} port={port}"
+        if asynchronous or connection_manager.max_idle == 0:
+            connection = psycopg2.connect(dsn, async_=asynchronous, **connection_manager.get_connect_args(self.type))
+            print(f"***> Established db connection to: {db_host}")
+            return connection
+        return connection_manager.get_connection(self.type, dsn)
 
     ###################################
     def get_db_values(self, table, columns):
@@ -69,7 +270,6 @@ class database: #TODO: Should we be creating a connection/engine upon initializa
         columns = ",".join(columns)
         print(f"---> Retrieving values for {columns}")
         df = pd.read_sql(f'SELECT {columns} FROM {table}', db_engine)
-        db_engine.dispose()
         return df
     
     ###################################
@@ -91,7 +291,108 @@ class database: #TODO: Should we be creating a connection/engine upon initializa
             db_engine.execute(create_table_statement)  # Create the new empty stage table
         print(f"---> Adding data to {table_name}")
         df.to_sql(con=db_engine, schema=schema, name=table, index=False, if_exists='append')
-        db_engine.dispose()
+
+    ###################################
+    def copy_dataframes_to_db(self, dataframes, connection=None, srid=None, chunk_size=100000):
+        """ Bulk loads DataFrames / GeoDataFrames into tables with COPY, creating any table that does not exist yet. All
+        of the tables are loaded in a single transaction on a single connection, so either every table is loaded or
+        none are.
+
+        Args:
+            dataframes (list): List of (table_name, DataFrame) tuples. Only the DataFrame columns are loaded, by
+                name, so the tables may have additional columns. Geometries are sent as hex EWKB.
+            connection (psycopg2 connection): An open connection to use. If provided, the caller is responsible for
+                the transaction (e.g. "with connection:") so that several calls can share it. Otherwise a new
+                connection is opened, committed, and closed.
+            srid (int): SRID of the geometries. Defaults to the crs of each GeoDataFrame.
+            chunk_size (int): Maximum number of rows sent in each COPY
+
+        Returns:
+            dict: The number of rows copied into each table
+        """
+        if connection is None:
+            connection = self.get_db_connection()
+            try:
+                with connection:
+                    return self.copy_dataframes_to_db(dataframes, connection=connection, srid=srid, chunk_size=chunk_size)
+            finally:
+                connection.close()
+
+        rows_copied = {}
+        with connection.cursor() as cur:
+            for table_name, df in dataframes:
+                if df is None or df.empty:
+                    continue
+                df = self._prepare_df_for_copy(cur, table_name, df, srid)
+                columns = ", ".join(f'"{column}"' for column in df.columns)
+                for start in range(0, len(df), chunk_size):
+                    f = StringIO()  # Use StringIO to store the temporary text file in memory (faster than on disk)
+                    df.iloc[start:start+chunk_size].to_csv(f, sep='\t', index=False, header=False)
+                    f.seek(0)
+                    cur.copy_expert(f"COPY {table_name} ({columns}) FROM STDIN WITH (FORMAT csv, DELIMITER E'\\t', NULL '')", f)
+                rows_copied[table_name] = rows_copied.get(table_name, 0) + len(df)
+                print(f"---> Copied {len(df)} rows into {table_name}")
+        return rows_copied
+
+    ###################################
+    @staticmethod
+    def _prepare_df_for_copy(cur, table_name, df, srid=None):
+        """ Converts DataFrame columns into values that COPY will accept for the matching table columns - hex EWKB
+        for geometry columns, and rounded integers for float values going into integer columns (which an INSERT
+        would round implicitly, but COPY rejects). Creates the table from the DataFrame columns if it does not
+        exist yet, like to_sql / to_postgis with if_exists='append' would. """
+        import pandas as pd
+        schema, table = table_name.split(".") if "." in table_name else ("public", table_name)
+        column_types_sql = "SELECT column_name, udt_name FROM information_schema.columns WHERE table_schema = %s AND table_name = %s"
+        cur.execute(column_types_sql, (schema, table))
+        column_types = dict(cur.fetchall())
+        if not column_types:
+            database._create_table_for_df(cur, schema, table, df, srid)
+            cur.execute(column_types_sql, (schema, table))
+            column_types = dict(cur.fetchall())
+
+        df = pd.DataFrame(df, copy=False)
+        converted = {}
+        for column in df.columns:
+            values = df[column]
+            if column_types.get(column) == 'geometry' or values.dtype.name == 'geometry':
+                geom_srid = srid or (values.crs.to_epsg() if getattr(values, 'crs', None) else None) or 0
+                converted[column] = [geometry_to_ewkb_hex(geom, geom_srid) for geom in values]
+            elif column_types.get(column) in ('int2', 'int4', 'int8') and values.dtype.kind == 'f':
+                converted[column] = values.round().astype('Int64')
+        if converted:
+            df = df.assign(**converted)
+        return df
+
+    ###################################
+    @staticmethod
+    def _create_table_for_df(cur, schema, table, df, srid=None):
+        """ Creates a table with the column types that to_sql / to_postgis would give the DataFrame columns, plus a
+        spatial index on each geometry column. """
+        column_definitions = []
+        geometry_columns = []
+        for column in df.columns:
+            values = df[column]
+            if values.dtype.name == 'geometry':
+                geom_srid = srid or (values.crs.to_epsg() if getattr(values, 'crs', None) else None) or 0
+                column_type = f"geometry(Geometry, {geom_srid})"
+                geometry_columns.append(column)
+            elif values.dtype.kind == 'b':
+                column_type = "BOOLEAN"
+            elif values.dtype.kind in ('i', 'u'):
+                column_type = "BIGINT"
+            elif values.dtype.kind == 'f':
+                column_type = "DOUBLE PRECISION"
+            elif values.dtype.kind == 'M':
+                column_type = "TIMESTAMPTZ" if getattr(values.dtype, 'tz', None) else "TIMESTAMP"
+            else:
+                column_type = "TEXT"
+            column_definitions.append(f'"{column}" {column_type}')
+
+        print(f"---> Creating {schema}.{table}")
+        cur.execute(f'CREATE TABLE IF NOT EXISTS {schema}.{table} ({", ".join(column_definitions)})')
+        for column in geometry_columns:
+            cur.execute(f'CREATE INDEX IF NOT EXISTS "idx_{table}_{column}" ON {schema}.{table} USING GIST ("{column}")')
 
     ###################################
     def execute_sql(self, sql):
@@ -118,7 +419,6 @@ class database: #TODO: Should we be creating a connection/engine upon initializa
             import geopandas as gdp
             df = gdp.GeoDataFrame.from_postgis(sql, db_engine)
         
-        db_engine.dispose()
         return df
 
     ###################################
@@ -173,8 +473,6 @@ class database: #TODO: Should we be creating a connection/engine upon initializa
             print(f"---> Renaming {dest_table} to {dest_final_table}")
             dest_engine.execute(f'DROP TABLE IF EXISTS {dest_final_table};')  # Drop the published table if it exists
             dest_engine.execute(f'ALTER TABLE {dest_table} RENAME TO {dest_final_table_name};')  # Rename the staged table
-        origin_engine.dispose()
-        dest_engine.dispose()
     
     ###################################
     def cache_data(self, table, reference_time, retention_days=30):
@@ -187,7 +485,6 @@ class database: #TODO: Should we be creating a connection/engine upon initializa
         db_engine.execute(f'DROP TABLE IF EXISTS {new_archive_table};')
         db_engine.execute(f'DROP TABLE IF EXISTS {cutoff_archive_table};')
         db_engine.execute(f'SELECT * INTO {new_archive_table} FROM publish.{table};')
-        db_engine.dispose()
         print(f"---> Wrote cache data into {new_archive_table} and dropped corresponding table from {retention_days} days ago, if it existed.")
     
     ###########################################
@@ -436,6 +733,19 @@ class s3_file:
             else:
                 raise
 
+###################################################################################################################################################
+###################################################################################################################################################
+def geometry_to_ewkb_hex(geom, srid):
+    """ Returns the hex EWKB (WKB with an embedded SRID, which PostGIS accepts as text input) of a shapely geometry. """
+    if geom is None:
+        return None
+    wkb = geom.wkb
+    endian = '<' if wkb[0] == 1 else '>'
+    geom_type = struct.unpack(f'{endian}I', wkb[1:5])[0]
+    if geom_type & 0x20000000:  # SRID is already embedded
+        return wkb.hex()
+    return (wkb[:1] + struct.pack(f'{endian}II', geom_type | 0x20000000, srid) + wkb[5:]).hex()
+
 ###################################################################################################################################################
 ###################################################################################################################################################
 def get_elasticsearch_logger():
@@ -5,9 +5,19 @@ import json
 import time
 import re
 import urllib.parse
+import threading
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from botocore.exceptions import ClientError
 
+FETCH_THREADS = int(os.environ.get('FETCH_THREADS', 8))  # Number of input files checked / downloaded at once
+FETCH_CACHE_MAX_MB = int(os.environ.get('FETCH_CACHE_MAX_MB', 4096))  # Size cap of the downloaded input files kept in /tmp
+
+_s3_client = None
+_s3_client_lock = threading.Lock()
+_download_cache = OrderedDict()  # LRU of the downloaded input files (path: size) kept by warm lambdas
+_download_cache_lock = threading.Lock()
+
 class MissingS3FileException(Exception):
     """ my custom exception class """
 
@@ -537,22 +547,62 @@ def move_data_to_another_db(origin_db, dest_db, origin_table, dest_table, stage=
         dest_engine.execute(f'DROP TABLE IF EXISTS {dest_final_table};')  # Drop the published table if it exists
         dest_engine.execute(f'ALTER TABLE {dest_table} RENAME TO {dest_final_table_name};')  # Rename the staged table
 
-def check_if_file_exists(bucket, file, download=False, download_subfolder=None):
+def get_s3_client():
+    """
+        Gets the s3 client shared by the lambda (and its threads). boto3 clients are thread safe, but creating them
+        from the default session in several threads at once isn't.
+
+        Returns:
+            s3_client: boto3 s3 client
+    """
+    global _s3_client
+    with _s3_client_lock:
+        if _s3_client is None:
+            _s3_client = boto3.client('s3')
+    return _s3_client
+
+def get_download_path(file, download_subfolder=None):
+    """
+        Gets the /tmp path that check_if_file_exists downloads a file to (creating the subfolder if needed).
+
+        Args:
+            file(str): key (path) or url of the file
+            download_subfolder(str): subfolder of /tmp to download the file to
+
+        Returns:
+            download_path(str): local path of the file
+    """
+    tempdir = "/tmp"
+    if download_subfolder:
+        download_folder = os.path.join(tempdir, download_subfolder)
+        os.makedirs(download_folder, exist_ok=True)
+        return os.path.join(download_folder, os.path.basename(file))
+    return os.path.join(tempdir, os.path.basename(file))
+
+def check_if_file_exists(bucket, file, download=False, download_subfolder=None, exists=None):
+    """
+        Checks that a file exists in S3 (or on the Google Cloud / retrospective mirrors of NWM files), and optionally
+        downloads it.
+
+        Args:
+            bucket(str): S3 bucket where the file resides
+            file(str): key (path) or url of the file
+            download(bool): Whether to download the file to /tmp
+            download_subfolder(str): subfolder of /tmp to download the file to
+            exists(bool): Whether the file is already known to exist in the bucket (e.g. from list_s3_key_existence),
+                          which skips its S3 existence check
+
+        Returns:
+            file(str): The local path of the file if it was downloaded, or else the file
+    """
     import requests
     from viz_classes import s3_file
     import xarray as xr
     
-    s3 = boto3.client('s3')
+    s3 = get_s3_client()
     file_exists = False
 
-    tempdir = "/tmp"
-    if download_subfolder:
-        download_folder=os.path.join(tempdir, download_subfolder)
-        if not os.path.exists(download_folder):
-            os.mkdir(download_folder)
-        download_path = os.path.join(download_folder, os.path.basename(file))
-    else:
-        download_path = os.path.join(tempdir, os.path.basename(file))
+    download_path = get_download_path(file, download_subfolder)
     https_file = None
 
     if "https" in file:
@@ -563,7 +613,9 @@ def check_if_file_exists(bucket, file, download=False, download_subfolder=None):
         else:
             raise Exception(f"https file doesn't seem to exist: {file}")   
     else:
-        if s3_file(bucket, file).check_existence():
+        if exists is None:
+            exists = s3_file(bucket, file).check_existence()
+        if exists:
             file_exists = True
             print(f"{file} exists in {bucket}")
         else:
@@ -761,9 +813,127 @@ def gen_dict_extract(key, var):
                     for result in gen_dict_extract(key, d):
                         yield result
 
-def organize_input_files(fileset_bucket, fileset, download_subfolder):
-    local_files = []
-    for file in fileset:
-        download_path = check_if_file_exists(fileset_bucket, file, download=True, download_subfolder=download_subfolder)
-        local_files.append(download_path)
-    return local_files
\ No newline at end of file
+def list_s3_key_existence(bucket, keys):
+    """
+        Checks which S3 keys exist by listing (ListObjectsV2) the common prefix of the keys of each folder, instead of
+        a HEAD request per key. Keys of folders that can't be listed are checked one at a time.
+
+        Args:
+            bucket(str): S3 bucket where the files reside
+            keys(list): keys (paths) of the files
+
+        Returns:
+            key_existence(dict): True or False for each key
+    """
+    s3 = get_s3_client()
+    folders = {}
+    for key in keys:
+        folders.setdefault(os.path.dirname(key), []).append(key)
+
+    key_existence = {}
+    for folder_keys in folders.values():
+        try:
+            listed_keys = set()
+            for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=os.path.commonprefix(folder_keys)):
+                listed_keys.update(s3_object['Key'] for s3_object in page.get('Contents', []))
+            key_existence.update({key: key in listed_keys for key in folder_keys})
+        except ClientError as e:
+            print(f"Couldn't list the files of {os.path.dirname(folder_keys[0])} ({e}). Checking them one at a time.")
+            for key in folder_keys:
+                try:
+                    s3.head_object(Bucket=bucket, Key=key)
+                    key_existence[key] = True
+                except ClientError as e:
+                    if e.response['Error']['Code'] != "404":
+                        raise
+                    key_existence[key] = False
+    return key_existence
+
+def add_to_download_cache(download_path, protected_paths=()):
+    """
+        Adds a downloaded file to the LRU of downloaded input files, and deletes the least recently used files
+        (other than protected_paths, e.g. the other files still being used) while they total more than
+        FETCH_CACHE_MAX_MB.
+
+        Args:
+            download_path(str): local path of the downloaded file
+            protected_paths(set): local paths that can't be deleted
+    """
+    with _download_cache_lock:
+        _download_cache[download_path] = os.path.getsize(download_path) if os.path.isfile(download_path) else 0
+        _download_cache.move_to_end(download_path)
+
+        cached_size = 0
+        for path in list(_download_cache):
+            if not os.path.isfile(path):  # Removed by whatever used it
+                del _download_cache[path]
+            else:
+                cached_size += _download_cache[path]
+
+        for path in list(_download_cache):
+            if cached_size <= FETCH_CACHE_MAX_MB * 1024 * 1024:
+                break
+            if path == download_path or path in protected_paths:
+                continue
+            print(f"Removing {path} from the download cache")
+            os.remove(path)
+            cached_size -= _download_cache.pop(path)
+
+def iter_input_files(fileset_bucket, fileset, download_subfolder, threads=FETCH_THREADS):
+    """
+        Checks and downloads the files of a fileset on a thread pool, yielding each file as soon as it's downloaded.
+        The existence of the S3 files is checked with a listing of their folders, files already in /tmp are reused,
+        and files that share a download path are only fetched once.
+
+        Args:
+            fileset_bucket(str): S3 bucket where the files reside
+            fileset(list): keys (paths) or urls of the files
+            download_subfolder(str): subfolder of /tmp to download the files to
+            threads(int): number of files checked / downloaded at once
+
+        Yields:
+            index(int): position of the file in the fileset
+            download_path(str): local path of the file
+    """
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    key_existence = list_s3_key_existence(fileset_bucket, [file for file in fileset if "https" not in file])
+
+    fileset_indexes = {}
+    for index, file in enumerate(fileset):
+        fileset_indexes.setdefault(get_download_path(file, download_subfolder), []).append(index)
+    protected_paths = set(fileset_indexes)
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        futures = {}
+        for indexes in fileset_indexes.values():
+            file = fileset[indexes[0]]
+            future = executor.submit(
+                check_if_file_exists, fileset_bucket, file, download=True, download_subfolder=download_subfolder,
+                exists=key_existence.get(file)
+            )
+            futures[future] = indexes
+
+        for future in as_completed(futures):
+            download_path = future.result()
+            add_to_download_cache(download_path, protected_paths)
+            for index in futures[future]:
+                yield index, download_path
+
+def organize_input_files(fileset_bucket, fileset, download_subfolder, threads=FETCH_THREADS):
+    """
+        Checks and downloads the files of a fileset (threads at a time).
+
+        Args:
+            fileset_bucket(str): S3 bucket where the files reside
+            fileset(list): keys (paths) or urls of the files
+            download_subfolder(str): subfolder of /tmp to download the files to
+            threads(int): number of files checked / downloaded at once
+
+        Returns:
+            local_files(list): local paths of the files, in the order of the fileset
+    """
+    local_files = [None] * len(fileset)
+    for index, download_path in iter_input_files(fileset_bucket, fileset, download_subfolder, threads):
+        local_files[index] = download_path
+    return local_files
@@ -1,5 +1,5 @@
 import boto3
-from botocore.exceptions import ResponseStreamingError
+from botocore.exceptions import ResponseStreamingError, ClientError
 import rasterio
 from rasterio import windows as riowindows
 from rasterio.features import shapes
@@ -11,8 +11,13 @@ import os
 import time
 import datetime
 import re
-from math import floor, ceil
+import io
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from collections import defaultdict, deque
 from shapely.geometry import shape
+from shapely.ops import unary_union
 
 
 from viz_classes import s3_file, database
@@ -25,6 +30,24 @@ HAND_PREFIX = f"fim/hand_{HAND_VERSION.replace('.', '_')}/hand_datasets"
 CACHE_FIM_RESOLUTION_FT = 0.25
 CACHE_FIM_RESOLUTION_ROUNDING = 'up'
 
+# Precompiled hydrotables (see Core/Manual_Workflows/helper_functions/build_hydrotable_cache.py) are kept in an
+# in-process LRU cache so that warm lambda containers don't re-download / re-parse the same static branch hydrotables
+HYDROTABLE_COLUMNS = ['HydroID', 'feature_id', 'stage', 'discharge_cms', 'LakeID']
+HYDROTABLE_CACHE_SIZE = int(os.environ.get('HYDROTABLE_CACHE_SIZE', 64))
+
+# Size of the square raster windows the HAND and catchment grids are processed in. Must match the block size used
+# to build the catchment window indexes (see Core/Manual_Workflows/helper_functions/build_catchment_window_index.py)
+HAND_WINDOW_SIZE = 1024
+
+# Largest range of hydroids (in table entries) that the per-branch stage lookup table is allowed to cover
+HAND_STAGE_LUT_MAX_SIZE = 50_000_000
+
+# Number of finished inundation features that are formatted and written to the db at a time
+HAND_INUNDATION_CHUNK_SIZE = int(os.environ.get('HAND_INUNDATION_CHUNK_SIZE', 2000))
+
+# Number of raster windows processed concurrently. Each worker thread opens its own HAND / catchment dataset handles.
+HAND_PROCESSING_THREADS = int(os.environ.get('HAND_PROCESSING_THREADS', 4))
+
 
 # Vendor subdivide from Rasterio 1.4
 # REMOVE when rasterio is upgraded!
@@ -77,6 +100,87 @@ def subdivide(window, height, width):
 class HANDDatasetReadError(Exception):
     """ my custom exception class """
 
+def open_s3_raster(key, tries=3, wait=30):
+    """
+        Opens a raster from the HAND bucket, retrying a few times before failing
+    """
+    for i in range(tries):
+        try:
+            return rasterio.open(f's3://{HAND_BUCKET}/{key}')
+        except Exception as e:
+            if i == tries - 1:
+                break
+            print(f"Failed to open {key}. Trying again in {wait} seconds - ({e})")
+            time.sleep(wait)
+
+    raise HANDDatasetReadError(f"Failed to open {key}")
+
+def read_window(dataset, window, tries=3, wait=10):
+    """
+        Reads a window of a dataset, retrying a few times before failing
+    """
+    for i in range(tries):
+        try:
+            return dataset.read(window=window)
+        except Exception as e:
+            if i == tries - 1:
+                break
+            print(f"Failed to read {dataset.name} window. Trying again in {wait} seconds - ({e})")
+            time.sleep(wait)
+
+    raise HANDDatasetReadError(f"Failed to read {dataset.name} window")
+
+def map_windows(process, windows, dataset_keys, threads=HAND_PROCESSING_THREADS):
+    """
+        Runs process(window, datasets) for every window on a bounded pool of worker threads, so that the S3 reads
+        of some windows overlap with the numpy / polygonizing work of others. Windows are submitted as the results
+        are consumed, with at most 2 x threads of them in flight, so finished windows don't pile up in memory.
+        Rasterio datasets are not thread safe, so each worker opens its own handle of every dataset in dataset_keys
+        the first time it runs and the handles are closed once all windows are done.
+
+        Arguments:
+            process (function): Function taking a window and a dictionary of open datasets keyed like dataset_keys
+            windows (list): List of rasterio windows
+            dataset_keys (dict): Dictionary of dataset name to HAND bucket key
+            threads (int): Maximum number of windows to process at the same time
+
+        Yields:
+            The return value of process for each window, in the same order as windows, as soon as it is available
+    """
+    worker = threading.local()
+    opened_datasets = []
+    lock = threading.Lock()
+
+    def run(window):
+        if not hasattr(worker, 'datasets'):
+            worker.datasets = {}
+            with lock:
+                opened_datasets.append(worker.datasets)
+            for name, key in dataset_keys.items():
+                worker.datasets[name] = open_s3_raster(key)
+        return process(window, worker.datasets)
+
+    try:
+        if threads <= 1:
+            for window in windows:
+                yield run(window)
+        else:
+            with ThreadPoolExecutor(max_workers=threads) as executor:
+                pending = deque()
+                for window in windows:
+                    pending.append(executor.submit(run, window))
+
+                    # Keep up to 2 x threads windows in flight, so that finished windows don't pile up in memory while
+                    # the consumer is busy writing
+                    if len(pending) >= threads * 2:
+                        yield pending.popleft().result()
+                while pending:
+                    yield pending.popleft().result()
+    finally:
+        for datasets in opened_datasets:
+            for dataset in datasets.values():
+                dataset.close()
+
 def lambda_handler(event, context):
     """
         The lambda handler is the function that is kicked off with the lambda. This function will coordinate
@@ -127,11 +231,9 @@ def lambda_handler(event, context):
 
         print(f"Adding data to {db_fim_table}")# Only process inundation configuration if available data
         try:
-            df_inundation.to_postgis(f"{db_table}", con=process_db.engine, schema=db_schema, if_exists='append')
+            process_db.copy_dataframes_to_db([(db_fim_table, df_inundation)])
         except Exception as e:
-            process_db.engine.dispose()
             raise Exception(f"Failed to add inundation data to DB for {huc8}-{branch} - ({e})")
-        process_db.engine.dispose()
 
     else:
         print(f"Processing FIM for huc {huc8} and branch {branch}")
@@ -141,6 +243,7 @@ def lambda_handler(event, context):
 
         print(f"Processing HUC {huc8} for {fim_config_name} for {date}T{hour}:00:00Z")
 
+        df_zero_stage_records = pd.DataFrame()
         if input_variable == 'stage':
             stage_lookup = s3_csv_to_df(data_bucket, subsetted_data)
             stage_lookup = stage_lookup.set_index('hydro_id')
@@ -156,63 +259,60 @@ def lambda_handler(event, context):
             rating_curve_exists = s3_file(HAND_BUCKET, rating_curve_key).check_existence()
 
             stage_lookup = pd.DataFrame()
-            df_zero_stage_records = pd.DataFrame()
             if catch_exists and hand_exists and rating_curve_exists:
                 print("->Calculating flood depth")
                 stage_lookup, df_zero_stage_records = calculate_stage_values(rating_curve_key, data_bucket, subsetted_data, huc8_branch)  # get stages
             else:
                 print(f"catchment, hand, or rating curve are missing for huc {huc8} and branch {branch}:\nCatchment exists: {catch_exists} ({catchment_key})\nHand exists: {hand_exists} ({hand_key})\nRating curve exists: {rating_curve_exists} ({rating_curve_key})")
  
-        # If not a reference/egis fim run, Upload zero_stage reaches for tracking / FIM cache
-        if fim_run_type != 'reference' and not df_zero_stage_records.empty:
-            print(f"Adding zero stage data to {db_table}_zero_stage")# Only process inundation configuration if available data
-            df_zero_stage_records = df_zero_stage_records.reset_index()
-            df_zero_stage_records.drop(columns=['hydro_id','feature_id'], inplace=True)
-            df_zero_stage_records.to_sql(f"{db_table}_zero_stage", con=process_db.engine, schema=db_schema, if_exists='append', index=False)
-        
         # If no features with above zero stages are present, then just copy an unflood raster instead of processing nothing
         if stage_lookup.empty:
             print("No reaches with valid stages")
-            return
+            if fim_run_type == 'reference' or df_zero_stage_records.empty:
+                return
+
+        # All of the outputs of this branch are written with COPY in a single transaction on a single connection
+        connection = process_db.get_db_connection()
+        try:
+            with connection:
+                # If not a reference/egis fim run, Upload zero_stage reaches for tracking / FIM cache
+                if fim_run_type != 'reference' and not df_zero_stage_records.empty:
+                    print(f"Adding zero stage data to {db_table}_zero_stage")# Only process inundation configuration if available data
+                    df_zero_stage_records = df_zero_stage_records.reset_index()
+                    df_zero_stage_records.drop(columns=['hydro_id','feature_id'], inplace=True)
+                    write_inundation_outputs(process_db, connection, [(f"{db_fim_table}_zero_stage", df_zero_stage_records)], huc8, branch)
+
+                if not stage_lookup.empty:
+                    create_and_write_inundation_outputs(process_db, connection, huc8, branch, stage_lookup, reference_time, input_variable, stage_ft_round_up, fim_run_type, db_fim_table)
+        finally:
+            connection.close()
 
-        # Run the desired configuration
-        df_inundation = create_inundation_output(huc8, branch, stage_lookup, reference_time, input_variable, stage_ft_round_up=stage_ft_round_up)
+    print(f"Successfully processed tif for HUC {huc8} and branch {branch} for {product} for {reference_time}")
+
+    return
 
-        # If not a reference run, split up the geometry into a seperate table for caching, upload no-stage data, and format dataframe accordingly
+def create_and_write_inundation_outputs(process_db, connection, huc8, branch, stage_lookup, reference_time, input_variable, stage_ft_round_up, fim_run_type, db_fim_table):
+    """
+        Runs the inundation workflow for the reaches in stage_lookup and writes the outputs to the db as they are
+        streamed back, on the provided connection / transaction.
+    """
+    # Run the desired configuration. Inundation is streamed back in chunks of finished features so that the whole
+    # branch never has to be held in memory at once.
+    processed_hand_ids = set()
+    for df_inundation in create_inundation_output(huc8, branch, stage_lookup, reference_time, input_variable, stage_ft_round_up=stage_ft_round_up):
+
+        # If not a reference run, split up the geometry into a seperate table for caching and format dataframe accordingly
         if fim_run_type == 'normal':
             # Split geometry into seperate table per new schema
             df_inundation_geo = df_inundation[['hand_id', 'rc_stage_ft', 'geom']]
-            df_inundation.drop(columns=['geom'], inplace=True)
-            
-            # If records exist in stage_lookup that don't exist in df_inundation, add those to the zero_stage table.
-            df_no_inundation = stage_lookup.merge(df_inundation.drop_duplicates(), on=['hand_id'],how='left',indicator=True)
-            df_no_inundation = df_no_inundation.loc[df_no_inundation['_merge'] == 'left_only']
-            if df_no_inundation.empty == False:
-                print(f"Adding {len(df_no_inundation)} reaches with NaN inundation to zero_stage table")
-                df_no_inundation.drop(df_no_inundation.columns.difference(['hand_id','rc_discharge_cms','note']), axis=1,  inplace=True)
-                df_no_inundation['note'] = "Error - No inundation returned from hand processing."
-                df_no_inundation.to_sql(f"{db_table}_zero_stage", con=process_db.engine, schema=db_schema, if_exists='append', index=False)
-            
-            # If no records exist for valid inundation, stop.
-            if df_inundation.empty:
-                return
+            df_inundation.drop(columns=['geom', 'hydro_id', 'feature_id'], inplace=True)
+            processed_hand_ids.update(df_inundation['hand_id'])
         
-            print(f"Adding data to {db_fim_table}")# Only process inundation configuration if available data
-            try:
-                df_inundation.drop(columns=['hydro_id', 'feature_id'], inplace=True)
-                df_inundation.to_sql(db_table, con=process_db.engine, schema=db_schema, if_exists='append', index=False)
-                df_inundation_geo.to_postgis(f"{db_table}_geo", con=process_db.engine, schema=db_schema, if_exists='append')
-            except Exception as e:
-                process_db.engine.dispose()
-                raise Exception(f"Failed to add inundation data to DB for {huc8}-{branch} - ({e})")
-            process_db.engine.dispose()
+            print(f"Adding {len(df_inundation)} records to {db_fim_table}")# Only process inundation configuration if available data
+            write_inundation_outputs(process_db, connection, [(db_fim_table, df_inundation), (f"{db_fim_table}_geo", df_inundation_geo)], huc8, branch)
         
         # If a reference configuration - do things a little diferently.
         elif fim_run_type == 'reference':
-            # If no records exist for valid inundation, stop.
-            if df_inundation.empty:
-                return
-            
             # Re-format data for aep tables
             df_inundation.drop(columns=['hand_id', 'rc_stage_ft', 'rc_previous_stage_ft', 'rc_discharge_cfs', 'rc_previous_discharge_cfs', 'prc_method', ], inplace=True)
             df_inundation = df_inundation.rename(columns={"forecast_stage_ft": "fim_stage_ft", "forecast_discharge_cfs": "streamflow_cfs"})
@@ -222,17 +322,25 @@ def lambda_handler(event, context):
             df_inundation['branch'] = branch
             df_inundation = df_inundation.rename(columns={"index": "oid"})
             
-            print(f"Adding data to {db_fim_table}")# Only process inundation configuration if available data
-            try:
-                df_inundation.to_postgis(f"{db_table}", con=process_db.engine, schema=db_schema, if_exists='append')
-            except Exception as e:
-                process_db.engine.dispose()
-                raise Exception(f"Failed to add inundation data to DB for {huc8}-{branch} - ({e})")
-            process_db.engine.dispose()
-
-    print(f"Successfully processed tif for HUC {huc8} and branch {branch} for {product} for {reference_time}")
-
-    return
+            print(f"Adding {len(df_inundation)} records to {db_fim_table}")# Only process inundation configuration if available data
+            write_inundation_outputs(process_db, connection, [(db_fim_table, df_inundation)], huc8, branch)
+
+    # If records exist in stage_lookup that don't exist in the inundation output, add those to the zero_stage table.
+    if fim_run_type == 'normal':
+        df_no_inundation = stage_lookup.loc[~stage_lookup['hand_id'].isin(processed_hand_ids), ['hand_id', 'rc_discharge_cms']]
+        if df_no_inundation.empty == False:
+            print(f"Adding {len(df_no_inundation)} reaches with NaN inundation to zero_stage table")
+            df_no_inundation = df_no_inundation.assign(note="Error - No inundation returned from hand processing.")
+            write_inundation_outputs(process_db, connection, [(f"{db_fim_table}_zero_stage", df_no_inundation)], huc8, branch)
+
+def write_inundation_outputs(process_db, connection, dataframes, huc8, branch):
+    """
+        Bulk copies (table, DataFrame) pairs to the db within the open transaction of connection
+    """
+    try:
+        process_db.copy_dataframes_to_db(dataframes, connection=connection)
+    except Exception as e:
+        raise Exception(f"Failed to add inundation data to DB for {huc8}-{branch} - ({e})")
 
 def create_inundation_catchment_boundary(huc8, branch):
     """
@@ -243,20 +351,7 @@ def create_inundation_catchment_boundary(huc8, branch):
     catchment_dataset = None
     try:
         print("--> Connecting to S3 datasets")
-        tries = 0
-        raster_open_success = False
-        while tries < 3:
-            try:
-                catchment_dataset = rasterio.open(f's3://{HAND_BUCKET}/{catchment_key}')  # open catchment grid from S3  # noqa
-                tries = 3
-                raster_open_success = True
-            except Exception as e:
-                tries += 1
-                time.sleep(30)
-                print(f"Failed to open datasets. Trying again in 30 seconds - ({e})")
-
-        if not raster_open_success:
-            raise HANDDatasetReadError("Failed to open HAND and Catchment datasets")
+        catchment_dataset = open_s3_raster(catchment_key)  # open catchment grid from S3  # noqa
             
         print("--> Setting up mapping array")
         profile = catchment_dataset.profile  # get the rasterio profile so the output can use the profile and match the input  # noqa
@@ -269,45 +364,23 @@ def create_inundation_catchment_boundary(huc8, branch):
         print("--> Setting up windows")
 
         # Get the list of windows according to the raster metadata so they can be looped through
-        windows = subdivide(riowindows.Window(0, 0, width=catchment_dataset.width, height=catchment_dataset.height), 1024, 1024)
+        windows = subdivide(riowindows.Window(0, 0, width=catchment_dataset.width, height=catchment_dataset.height), HAND_WINDOW_SIZE, HAND_WINDOW_SIZE)
+        catchment_transform = catchment_dataset.transform
 
         # This function will be run for each raster window.
-        def process(window):
+        def process(window, datasets):
             """
                 This function is run for each raster window in parallel. The function will read in the appropriate
-                window of the HAND and catchment datasets for main stem and/or full resolution. The stages will
-                then be mapped from a numpy array to the catchment window. This will create a windowed stage array.
-                The stage array is then compared to the HAND window array to create an inundation array where the
-                HAND values are gte to the stage values.
-
-                Each windowed inundation array is then saved to the output array for that specific window that was
-                ran.
+                window of the catchment dataset, using the dataset handle belonging to the current worker thread,
+                and polygonize it.
 
                 For more information on rasterio window processing, see
                 https://rasterio.readthedocs.io/en/latest/topics/windowed-rw.html
-
-                If main stem AND full resolution are ran, then the inundation arrays for each configuration will be
-                compared and the highest value for each element in the array will be used. This is how we 'merge'
-                the two configurations. Because the extents of fr and ms are not the same, we do have to reshape
-                the arrays a bit to allow for the comparison
             """
-            tries = 0
-            catchment_open_success = False
-            while tries < 3:
-                try:
-                    catchment_window = catchment_dataset.read(window=window)  # Read the dataset for the specified window  # noqa
-                    tries = 3
-                    catchment_open_success = True
-                except Exception as e:
-                    tries += 1
-                    time.sleep(10)
-                    print(f"Failed to open catchment. Trying again in 10 seconds - ({e})")
-
-            if not catchment_open_success:
-                raise HANDDatasetReadError("Failed to open Catchment dataset window")
+            catchment_window = read_window(datasets['catchment'], window)  # Read the dataset for the specified window  # noqa
             
             results = []
-            for s, v in shapes(catchment_window, mask=None, transform=riowindows.transform(window, catchment_dataset.transform)):
+            for s, v in shapes(catchment_window, mask=None, transform=riowindows.transform(window, catchment_transform)):
                 if int(v):
                     results.append((int(v), shape(s)))
 
@@ -315,8 +388,8 @@ def create_inundation_catchment_boundary(huc8, branch):
 
         # Use threading to parallelize the processing of the inundation windows
         geoms = []
-        for window in windows:
-            geoms.extend(process(window))
+        for window_geoms in map_windows(process, windows, {'catchment': catchment_key}):
+            geoms.extend(window_geoms)
                         
     except Exception as e:
         raise e
@@ -346,14 +419,105 @@ def create_inundation_catchment_boundary(huc8, branch):
     return df_final
     
 
+def build_stage_lut(hydroids, stages, max_lut_size=HAND_STAGE_LUT_MAX_SIZE):
+    """
+        Builds the lookup table that converts catchment hydroids to their stage, once per branch. Hydroids are
+        offset by the smallest hydroid so the table only spans the range of hydroids with a stage, and the last slot is
+        a sentinel for any catchment value outside of that range. If that range is still larger than max_lut_size
+        (e.g. very large, sparse hydroids) the hydroids are looked up by binary search instead.
+
+        Arguments:
+            hydroids (numpy array): The hydroids with a stage
+            stages (numpy array): The stage of each hydroid
+
+        Returns:
+            stage_lut (dict): The lookup table to pass to lookup_stages
+    """
+    order = np.argsort(hydroids)
+    hydroids = hydroids[order].astype('int64')
+    stages = stages[order].astype('float32')
+
+    base = int(hydroids[0])
+    size = int(hydroids[-1]) - base + 1
+    if size > max_lut_size:
+        return {'hydroids': hydroids, 'stages': stages}
+
+    valid = np.zeros(size + 1, dtype=bool)
+    valid[hydroids - base] = True
+    lut = np.full(size + 1, -9999, dtype='float32')
+    lut[hydroids - base] = stages
+    return {'base': base, 'size': size, 'valid': valid, 'stages': lut}
+
+def lookup_stages(stage_lut, catchment_window):
+    """
+        Converts a catchment window to a stage window with a lookup table from build_stage_lut.
+
+        Returns:
+            reclass_window (numpy array): The stage of each pixel, -9999 where the hydroid doesn't have a stage
+            valid_window (numpy array): True where the hydroid has a stage
+    """
+    if 'base' not in stage_lut:
+        hydroids = stage_lut['hydroids']
+        positions = np.searchsorted(hydroids, catchment_window).clip(max=len(hydroids) - 1)
+        valid_window = hydroids[positions] == catchment_window
+        reclass_window = np.where(valid_window, stage_lut['stages'][positions], np.float32(-9999))
+        return reclass_window, valid_window
+
+    # Index with int32 when the catchment values and the table range allow it, to halve the size of the index window
+    int32_max = np.iinfo('int32').max
+    index_dtype = 'int32' if np.can_cast(catchment_window.dtype, 'int32') and stage_lut['base'] + stage_lut['size'] < int32_max else 'int64'
+    index_window = catchment_window.astype(index_dtype) - stage_lut['base']
+    index_window[(index_window < 0) | (index_window >= stage_lut['size'])] = stage_lut['size']
+    return stage_lut['stages'][index_window], stage_lut['valid'][index_window]
+
+class InundationPolygonAccumulator:
+    """
+        Collects the polygon pieces of each hydro_id as the raster windows are processed, and dissolves a hydro_id as
+        soon as every window it intersects has been processed, so that finished features can be written out while
+        the remaining windows are still being processed. Without the catchment window index (pair_hydro_ids and
+        pair_window_ids), hydro_ids are only dissolved by finish_all.
+    """
+    def __init__(self, pair_hydro_ids=(), pair_window_ids=()):
+        self.window_hydro_ids = defaultdict(list)
+        self.remaining_windows = defaultdict(int)
+        for hydro_id, window_number in zip(pair_hydro_ids, pair_window_ids):
+            self.window_hydro_ids[int(window_number)].append(int(hydro_id))
+            self.remaining_windows[int(hydro_id)] += 1
+        self.pieces = defaultdict(list)
+        self.finished = []
+
+    def add_window(self, window_number, results):
+        for hydro_id, geom in results:
+            self.pieces[hydro_id].append(geom)
+        for hydro_id in self.window_hydro_ids.pop(window_number, []):
+            self.remaining_windows[hydro_id] -= 1
+            if self.remaining_windows[hydro_id] == 0:
+                self.finish(hydro_id)
+
+    def finish(self, hydro_id):
+        pieces = self.pieces.pop(hydro_id, None)
+        if pieces:
+            self.finished.append((hydro_id, unary_union(pieces)))
+
+    def finish_all(self):
+        for hydro_id in sorted(self.pieces):
+            self.finish(hydro_id)
+
+    def pop_finished(self):
+        finished, self.finished = self.finished, []
+        return finished
+
 def create_inundation_output(huc8, branch, stage_lookup, reference_time, input_variable, stage_ft_round_up=False):
     """
-        Creates the actual inundation output from the stages, catchments, and hand grids
+        Creates the actual inundation output from the stages, catchments, and hand grids. Output is yielded in chunks
+        of up to HAND_INUNDATION_CHUNK_SIZE features as each hydroid's polygons are finished.
     """
     # join metadata to get path to FIM datasets
     catchment_key = f'{HAND_PREFIX}/{huc8}/branches/{branch}/gw_catchments_reaches_filtered_addedAttributes_{branch}.tif'
     hand_key = f'{HAND_PREFIX}/{huc8}/branches/{branch}/rem_zeroed_masked_{branch}.tif'
     
+    hand_dataset = None
+    catchment_dataset = None
     try:
         print(f"Creating inundation for huc {huc8} and branch {branch}")
         
@@ -362,25 +526,11 @@ def create_inundation_output(huc8, branch, stage_lookup, reference_time, input_v
             os.mkdir('/tmp/raw_rasters/')
         
         print("--> Connecting to S3 datasets")
-        tries = 0
-        raster_open_success = False
-        while tries < 3:
-            try:
-                hand_dataset = rasterio.open(f's3://{HAND_BUCKET}/{hand_key}')  # open HAND grid from S3
-                catchment_dataset = rasterio.open(f's3://{HAND_BUCKET}/{catchment_key}')  # open catchment grid from S3  # noqa
-                tries = 3
-                raster_open_success = True
-            except Exception as e:
-                tries += 1
-                time.sleep(30)
-                print(f"Failed to open datasets. Trying again in 30 seconds - ({e})")
-
-        if not raster_open_success:
-            raise HANDDatasetReadError("Failed to open HAND and Catchment datasets")
+        hand_dataset = open_s3_raster(hand_key)  # open HAND grid from S3
+        catchment_dataset = open_s3_raster(catchment_key)  # open catchment grid from S3  # noqa
             
         print("--> Setting up mapping array")
         catchment_nodata = int(catchment_dataset.nodata)  # get no_data value for catchment raster
-        valid_catchments = stage_lookup.index.tolist() # parse lookup to get features with >0 stages  # noqa
         hydroids = stage_lookup.index.tolist()  # parse lookup to get all features
         
         # Notable FIM Caching Change: Use the rc_stage_m (upper rating curve table step) for extents when running normal cached workflows (default)
@@ -392,10 +542,10 @@ def create_inundation_output(huc8, branch, stage_lookup, reference_time, input_v
         hydroids = np.array(hydroids)  # Create a feature numpy array from the list
         stages = np.array(stages)  # Create a stage numpy array from the list
 
-        hydro_id_max = hydroids.max()  # Get the max feature id in the array
+        # Create the stage mapper that converts hydroids to their corresponding stage once, and share it across windows
+        stage_lut = build_stage_lut(hydroids, stages)
 
         hand_nodata = hand_dataset.nodata  # get the no_data value for the HAND raster
-        hand_dtype = hand_dataset.dtypes[0]  # get the dtype for the HAND raster
         profile = hand_dataset.profile  # get the rasterio profile so the output can use the profile and match the input  # noqa
 
         # set the output nodata to 0
@@ -406,10 +556,29 @@ def create_inundation_output(huc8, branch, stage_lookup, reference_time, input_v
         print("--> Setting up windows")
 
         # Get the list of windows according to the raster metadata so they can be looped through
-        windows = subdivide(riowindows.Window(0, 0, width=hand_dataset.width, height=hand_dataset.height), 1024, 1024)
+        windows = subdivide(riowindows.Window(0, 0, width=hand_dataset.width, height=hand_dataset.height), HAND_WINDOW_SIZE, HAND_WINDOW_SIZE)
+        hand_transform = hand_dataset.transform
+
+        window_numbers = list(range(len(windows)))
+        crs = 'EPSG:3338' if str(huc8).startswith('19') else 'EPSG:5070'
+        accumulator = InundationPolygonAccumulator()
+
+        # Skip reading windows that don't contain any of the reaches with a stage, if the branch has a window index, and
+        # only read the part of each window that their pixel bounding boxes cover. The index also tells the accumulator
+        # when all windows of a hydroid are done, so it can be finished early.
+        window_index = load_catchment_window_index(catchment_key)
+        if window_index is not None:
+            if (int(window_index['width']), int(window_index['height'])) == (hand_dataset.width, hand_dataset.height):
+                pair_hydro_ids, pair_window_ids = get_catchment_window_pairs(window_index, hydroids)
+                accumulator = InundationPolygonAccumulator(pair_hydro_ids, pair_window_ids)
+                window_numbers = np.unique(pair_window_ids).tolist()
+                print(f"--> Window index: {len(window_numbers)} of {len(windows)} windows contain reaches with a stage")
+                windows = crop_windows_to_bboxes([windows[i] for i in window_numbers], window_index, pair_hydro_ids, pair_window_ids)
+            else:
+                print("WARNING: Catchment window index does not match the HAND grid dimensions. Processing all windows.")
 
         # This function will be run for each raster window.
-        def process(window):
+        def process(window, datasets):
             """
                 This function is run for each raster window in parallel. The function will read in the appropriate
                 window of the HAND and catchment datasets for main stem and/or full resolution. The stages will
@@ -427,62 +596,25 @@ def create_inundation_output(huc8, branch, stage_lookup, reference_time, input_v
                 compared and the highest value for each element in the array will be used. This is how we 'merge'
                 the two configurations. Because the extents of fr and ms are not the same, we do have to reshape
                 the arrays a bit to allow for the comparison
-            """
-            tries = 0
-            catchment_open_success = False
-            while tries < 3:
-                try:
-                    catchment_window = catchment_dataset.read(window=window)  # Read the dataset for the specified window  # noqa
-                    tries = 3
-                    catchment_open_success = True
-                except Exception as e:
-                    tries += 1
-                    time.sleep(10)
-                    print(f"Failed to open catchment. Trying again in 10 seconds - ({e})")
-
-            if not catchment_open_success:
-                raise HANDDatasetReadError("Failed to open Catchment dataset window")
-
-            unique_window_catchments = np.unique(catchment_window).tolist()  # Get a list of unique hydroids within the window  # noqa
-            window_valid_catchments = [catchment for catchment in unique_window_catchments if catchment in valid_catchments]  # Check to see if any hydroids with stages >0 are inside this window  # noqa
-            # Only process if there are hydroids with stage >0 in this window
-            if not window_valid_catchments:
-                return 
 
+                The datasets are the HAND and catchment dataset handles belonging to the current worker thread.
+            """
+            catchment_window = read_window(datasets['catchment'], window)  # Read the dataset for the specified window  # noqa
 
-            tries = 0
-            hand_open_success = False
-            while tries < 3:
-                try:
-                    hand_window = hand_dataset.read(window=window)
-                    tries = 3
-                    hand_open_success = True
-                except Exception as e:
-                    tries += 1
-                    time.sleep(10)
-                    print(f"Failed to open catchment. Trying again in 10 seconds - ({e})")
-
-            if not hand_open_success:
-                raise HANDDatasetReadError("Failed to open HAND dataset window")
-            
-            # Create an empty numpy array with the nodata value that will be overwritten
-            inundation_window = np.full(catchment_window.shape, hand_nodata, hand_dtype)
-
-            # If catchment window values exist, then find the max between the stage mapper and the window
-            mapping_ar_max = max(hydro_id_max, catchment_window.max())
+            # Convert the catchment to stage, and flag the pixels of hydroids with stages >0
+            reclass_window, valid_window = lookup_stages(stage_lut, catchment_window)
 
-            # Create a stage mapper that will convert hydroids to their corresponding stage. -9999 is null or
-            # no value. we cant use 0 because it will mess up the mapping and use the 0 index
-            mapping_ar = np.full(mapping_ar_max+1, -9999, dtype="float32")
-            mapping_ar[hydroids] = stages
+            # Only process if there are hydroids with stage >0 in this window
+            if not valid_window.any():
+                return 
 
-            catchment_window[catchment_window == catchment_nodata] = 0  # Convert catchment values to 0 where the catchment = catchment_nodata  # noqa
-            catchment_window[hand_window == hand_nodata] = 0  # Convert catchment values to 0 where the HAND = HAND_nodata. THis will ensure we are only processing where we have HAND values!  # noqa
+            hand_window = read_window(datasets['hand'], window)
 
-            reclass_window = mapping_ar[catchment_window]  # Convert the catchment to stage
+            valid_window &= catchment_window != catchment_nodata  # Ignore pixels where the catchment = catchment_nodata  # noqa
+            valid_window &= hand_window != hand_nodata  # Ignore pixels where the HAND = HAND_nodata. THis will ensure we are only processing where we have HAND values!  # noqa
 
             conditions = reclass_window > hand_window  # Select where stage is gte to HAND
-            conditions &= reclass_window != -9999  # Select where stage is gte to HAND
+            conditions &= valid_window  # Select where stage is gte to HAND
 
             inundation_window = np.where(conditions, catchment_window, 0).astype('int32')
 
@@ -492,18 +624,22 @@ def create_inundation_output(huc8, branch, stage_lookup, reference_time, input_v
 
             if np.max(inundation_window) != 0:
                 results = []
-                for s, v in shapes(inundation_window, mask=None, transform=riowindows.transform(window, hand_dataset.transform)):
+                for s, v in shapes(inundation_window, mask=None, transform=riowindows.transform(window, hand_transform)):
                     if int(v):
                         results.append((int(v), shape(s)))
                     
                 return results
 
         # Use threading to parallelize the processing of the inundation windows
-        geoms = []
-        for window in windows:
-            inundation_windows = process(window)
-            if inundation_windows:
-                geoms.extend(inundation_windows)
+        dataset_keys = {'hand': hand_key, 'catchment': catchment_key}
+        for window_number, inundation_windows in zip(window_numbers, map_windows(process, windows, dataset_keys)):
+            accumulator.add_window(window_number, inundation_windows or [])
+            if len(accumulator.finished) >= HAND_INUNDATION_CHUNK_SIZE:
+                yield format_inundation_output(accumulator.pop_finished(), crs, stage_lookup, reference_time, input_variable)
+
+        accumulator.finish_all()
+        if accumulator.finished:
+            yield format_inundation_output(accumulator.pop_finished(), crs, stage_lookup, reference_time, input_variable)
                         
     except Exception as e:
         raise e
@@ -514,10 +650,20 @@ def create_inundation_output(huc8, branch, stage_lookup, reference_time, input_v
         if catchment_dataset is not None:
             catchment_dataset.close()
 
-    print("Generating polygons")
-    crs = 'EPSG:3338' if str(huc8).startswith('19') else 'EPSG:5070'
+def format_inundation_output(geoms, crs, stage_lookup, reference_time, input_variable):
+    """
+        Formats dissolved inundation polygons into the inundation output table, joining the stage lookup attributes
+        
+        Arguments:
+            geoms (list): List of (hydro_id, dissolved polygon) tuples
+            crs (str): The crs of the polygons
+            stage_lookup (DataFrame): The stage lookup, indexed by hydro_id
+            reference_time (str): The reference time of the run
+            input_variable (str): Either 'flow' or 'stage'
+    """
+    print(f"Generating {len(geoms)} polygons")
     df_final = gpd.GeoDataFrame(geoms, columns=['hydro_id', 'geom'], crs=crs, geometry="geom")
-    df_final = df_final.dissolve(by="hydro_id")
+    df_final = df_final.set_index("hydro_id")
     df_final['geom'] = df_final['geom'].simplify(5) #Simplifying polygons to ~5m to clean up problematic geometries
     df_final = df_final.to_crs(3857)
     df_final = df_final.set_crs('epsg:3857')
@@ -576,6 +722,129 @@ def s3_csv_to_df(bucket, key, columns=None):
 
     return df
 
+def s3_npz_to_arrays(bucket, key):
+    """
+        Reads a precompiled .npz artifact from S3 into a dictionary of read-only numpy arrays. Returns None if the
+        artifact does not exist or was built for a different HAND_VERSION.
+    """
+    try:
+        print(f"Reading {key} from {bucket}")
+        obj = boto3.client('s3').get_object(Bucket=bucket, Key=key)
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ["NoSuchKey", "404"]:
+            raise
+        print(f"No precompiled artifact found at {key}")
+        return None
+
+    with np.load(io.BytesIO(obj['Body'].read())) as npz:
+        arrays = {name: npz[name] for name in npz.files}
+
+    artifact_hand_version = str(arrays.pop('hand_version'))
+    if artifact_hand_version != HAND_VERSION:
+        print(f"WARNING: {key} was built for HAND {artifact_hand_version}, not HAND {HAND_VERSION}")
+        return None
+
+    for array in arrays.values():
+        array.setflags(write=False)
+
+    return arrays
+
+@lru_cache(maxsize=HYDROTABLE_CACHE_SIZE)
+def load_hydrotable_arrays(bucket, hydrotable_key):
+    """
+        Loads the columns of a branch hydrotable as read-only numpy arrays. The precompiled hydroTable_{branch}.npz
+        that sits next to the csv is used when it exists, otherwise the csv itself is parsed. Results are memoized for
+        the life of the lambda container.
+
+        Arguments:
+            bucket (str): The bucket of the hydrotable
+            hydrotable_key (str): The key of the hydroTable_{branch}.csv
+
+        Returns:
+            arrays (dict): A dictionary with the HYDROTABLE_COLUMNS as keys and numpy arrays as values
+    """
+    arrays = s3_npz_to_arrays(bucket, re.sub(r'\.csv$', '.npz', hydrotable_key))
+
+    if arrays is None:
+        df_hydro = s3_csv_to_df(bucket, hydrotable_key, columns=HYDROTABLE_COLUMNS)
+        arrays = {column: df_hydro[column].to_numpy() for column in HYDROTABLE_COLUMNS}
+        for array in arrays.values():
+            array.setflags(write=False)
+    
+    return arrays
+
+def read_hydrotable(bucket, hydrotable_key):
+    """
+        Returns a fresh DataFrame of a branch hydrotable, backed by the cached arrays from load_hydrotable_arrays.
+    """
+    arrays = load_hydrotable_arrays(bucket, hydrotable_key)
+    print(f"Hydrotable cache: {load_hydrotable_arrays.cache_info()}")
+    return pd.DataFrame({column: arrays[column] for column in HYDROTABLE_COLUMNS})
+
+@lru_cache(maxsize=HYDROTABLE_CACHE_SIZE)
+def load_catchment_window_index(catchment_key):
+    """
+        Loads the window index of a branch catchment grid (gw_catchments_..._{branch}_windows.npz), which lists the
+        HAND_WINDOW_SIZE raster windows that each hydro_id intersects, along with its pixel bounding box. Returns None
+        if the branch doesn't have an index for the current HAND_VERSION, or it was built with another window size.
+
+        Arrays:
+            width, height, window_size: The catchment grid dimensions and window size the index was built with
+            hydro_ids: Sorted unique hydro_ids in the catchment grid
+            window_offsets: hydro_ids[i] intersects window_ids[window_offsets[i]:window_offsets[i+1]]
+            window_ids: Row-major window numbers, in the same order as subdivide() returns the windows
+            bboxes: (row_min, col_min, row_max, col_max) pixel bounding box of each hydro_id
+    """
+    window_index = s3_npz_to_arrays(HAND_BUCKET, re.sub(r'\.tif$', '_windows.npz', catchment_key))
+    if window_index is not None and int(window_index['window_size']) != HAND_WINDOW_SIZE:
+        print(f"WARNING: Catchment window index was built with {int(window_index['window_size'])} pixel windows, not {HAND_WINDOW_SIZE}")
+        return None
+    return window_index
+
+def get_catchment_window_pairs(window_index, hydro_ids):
+    """
+        Returns the (hydro_id, window number) pairs of every window that the provided hydro_ids intersect.
+    """
+    index_hydro_ids = window_index['hydro_ids']
+    positions = np.searchsorted(index_hydro_ids, hydro_ids).clip(max=len(index_hydro_ids) - 1)
+    positions = positions[index_hydro_ids[positions] == hydro_ids]
+    if not positions.size:
+        return np.array([], dtype='int64'), np.array([], dtype='int64')
+
+    starts = window_index['window_offsets'][positions]
+    counts = window_index['window_offsets'][positions + 1] - starts
+    pair_positions = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+    return np.repeat(index_hydro_ids[positions], counts), window_index['window_ids'][pair_positions]
+
+def crop_windows_to_bboxes(windows, window_index, pair_hydro_ids, pair_window_ids):
+    """
+        Crops each window to the combined pixel bounding box of the hydro_ids with a stage that it intersects, so that
+        only that part of the HAND and catchment grids is read. Pixels outside of every bounding box belong to other
+        hydro_ids or nodata, and can't be inundated.
+
+        Arguments:
+            windows (list): The windows of the unique pair_window_ids, in sorted window number order
+            window_index (dict): The catchment window index arrays (see load_catchment_window_index)
+            pair_hydro_ids, pair_window_ids (arrays): The (hydro_id, window number) pairs from get_catchment_window_pairs
+    """
+    if not windows:
+        return windows
+
+    pair_bboxes = window_index['bboxes'][np.searchsorted(window_index['hydro_ids'], pair_hydro_ids)]
+    order = np.argsort(pair_window_ids, kind='stable')
+    pair_bboxes = pair_bboxes[order]
+    _, starts = np.unique(pair_window_ids[order], return_index=True)
+    row_mins, col_mins = np.minimum.reduceat(pair_bboxes[:, 0], starts), np.minimum.reduceat(pair_bboxes[:, 1], starts)
+    row_maxs, col_maxs = np.maximum.reduceat(pair_bboxes[:, 2], starts), np.maximum.reduceat(pair_bboxes[:, 3], starts)
+
+    cropped_windows = []
+    for window, row_min, col_min, row_max, col_max in zip(windows, row_mins, col_mins, row_maxs, col_maxs):
+        row_start, col_start = max(int(row_min), window.row_off), max(int(col_min), window.col_off)
+        row_stop = min(int(row_max) + 1, window.row_off + window.height)
+        col_stop = min(int(col_max) + 1, window.col_off + window.width)
+        cropped_windows.append(riowindows.Window(col_start, row_start, col_stop - col_start, row_stop - row_start))
+    return cropped_windows
+
 def calculate_stage_values(hydrotable_key, subsetted_streams_bucket, subsetted_streams, huc8_branch):
     """
         Converts discharge (streamflow) values to stage using the rating curve and linear interpolation because rating curve intervals
@@ -587,8 +856,7 @@ def calculate_stage_values(hydrotable_key, subsetted_streams_bucket, subsetted_s
         Returns:
             stage_dict (dict): A dictionary with the hydroid as the key and interpolated stage as the value
     """
-    hydrocols = ['HydroID', 'feature_id', 'stage', 'discharge_cms', 'LakeID']
-    df_hydro = s3_csv_to_df(HAND_BUCKET, hydrotable_key, columns=hydrocols)
+    df_hydro = read_hydrotable(HAND_BUCKET, hydrotable_key)
     df_hydro = df_hydro.rename(columns={'HydroID': 'hydro_id', 'stage': 'stage_m'})
 
     df_hydro_max = df_hydro.loc[df_hydro.groupby('hydro_id')['stage_m'].idxmax()]
@@ -598,7 +866,7 @@ def calculate_stage_values(hydrotable_key, subsetted_streams_bucket, subsetted_s
     df_forecast = s3_csv_to_df(subsetted_streams_bucket, subsetted_streams)
     df_forecast = df_forecast.loc[df_forecast['huc8_branch']==huc8_branch]
     df_forecast = df_forecast.rename(columns={'streamflow_cms': 'discharge_cms'}) #TODO: Change the output CSV to list discharge instead of streamflow for consistency?
-    df_forecast[['stage_m', 'rc_stage_m', 'rc_previous_stage_m', 'rc_discharge_cms', 'rc_previous_discharge_cms']] = df_forecast.apply(lambda row : interpolate_stage(row, df_hydro), axis=1).apply(pd.Series)
+    df_forecast[['stage_m', 'rc_stage_m', 'rc_previous_stage_m', 'rc_discharge_cms', 'rc_previous_discharge_cms']] = interpolate_stages(df_forecast, df_hydro)
     
     df_forecast = df_forecast.drop(columns=['huc8_branch', 'huc'])
     df_forecast = df_forecast.set_index('hydro_id')
@@ -622,58 +890,108 @@ def calculate_stage_values(hydrotable_key, subsetted_streams_bucket, subsetted_s
 
 
 def round_m_to_nearest_ft_resolution(value_m, resolution_ft, method="nearest", decimals=4):
-    valid_methods = {'up': ceil, 'down': floor, 'nearest': round}
+    valid_methods = {'up': np.ceil, 'down': np.floor, 'nearest': np.round}
     method = method.lower()
     if method not in valid_methods:
         raise ValueError(f"The method argument must be one of: {', '.join(valid_methods)}")
     value_ft = value_m * 3.28084
     method_func = valid_methods[method]
     rounded_ft = method_func(value_ft / resolution_ft) * resolution_ft
-    rounded_m = round(rounded_ft / 3.28084, decimals)
+    rounded_m = np.round(rounded_ft / 3.28084, decimals)
     return rounded_m
 
-def interpolate_stage(df_row, df_hydro):
-    ''' 
-    Yields both an exactly interpolated stage and a rounded stage based on the CACHE_FIM_RESOLUTION_FT variable.
-    The rounded stage is "rounded_stage" here, but ends up being used as "rc_stage_m" everywhere else after being returned.
+def interpolate_stages(df_forecast, df_hydro):
     '''
-    hydro_id = df_row['hydro_id']
-    forecast = df_row['discharge_cms']
-    
-    hydro_mask = df_hydro.hydro_id == hydro_id
-    
-    # Filter the hydrotable to this hydroid and pull out discharge and stages into arrays
-    subset_hydro = df_hydro.loc[hydro_mask, ['discharge_cms', 'stage_m']]
-    if subset_hydro.empty:
-        return np.nan, np.nan, np.nan, np.nan, np.nan
-
-    subset_hydro = subset_hydro.sort_values('discharge_cms')
-    discharges = subset_hydro['discharge_cms'].values
-    stages = subset_hydro['stage_m'].values
-    
-    # Get the interpolated stage by using the discharge forecast value against the arrays
-    interpolated_stage = round(np.interp(forecast, discharges, stages), 2)
+    Yields both an exactly interpolated stage and a rounded stage based on the CACHE_FIM_RESOLUTION_FT variable for
+    every reach in df_forecast at once. The rounded stage is "rounded_stage" here, but ends up being used as "rc_stage_m"
+    everywhere else after being returned.
 
-    if np.isnan(interpolated_stage):
-        print(f"WARNING: Interpolated stage is NaN where hydro_id == {hydro_id}")
-        return np.nan, np.nan, np.nan, np.nan, np.nan
+    The hydrotable is sorted once by (hydro_id, discharge) so that each rating curve is a contiguous slice of flat
+    discharge / stage arrays. Every forecast is then located within its own rating curve with a single lexsort over
+    the rating curve rows and the forecasts, rather than scanning and sorting the hydrotable once per reach.
 
-    # Get the upper and lower values of the 1-ft hydrotable array that the current forecast / interpolated stage is at
-    hydrotable_index = np.searchsorted(discharges, forecast, side='right')
+    Arguments:
+        df_forecast (DataFrame): A pandas dataframe with hydro_id and discharge_cms columns
+        df_hydro (DataFrame): The branch hydrotable with hydro_id, discharge_cms, and stage_m columns
 
+    Returns:
+        DataFrame: stage_m, rc_stage_m, rc_previous_stage_m, rc_discharge_cms, and rc_previous_discharge_cms
+            columns aligned to the index of df_forecast. Rows are NaN where no valid stage could be interpolated.
+    '''
+    columns = ['stage_m', 'rc_stage_m', 'rc_previous_stage_m', 'rc_discharge_cms', 'rc_previous_discharge_cms']
+    results = np.full((len(df_forecast), len(columns)), np.nan)
+    if df_forecast.empty or df_hydro.empty:
+        return pd.DataFrame(results, columns=columns, index=df_forecast.index)
+
+    # Sort the hydrotable once so that each rating curve is a contiguous run, ordered by discharge (ties by stage)
+    rc_hydro_ids = df_hydro['hydro_id'].to_numpy()
+    rc_discharges = df_hydro['discharge_cms'].to_numpy(dtype='float64')
+    rc_stages = df_hydro['stage_m'].to_numpy(dtype='float64')
+    order = np.lexsort((rc_stages, rc_discharges, rc_hydro_ids))
+    rc_hydro_ids, rc_discharges, rc_stages = rc_hydro_ids[order], rc_discharges[order], rc_stages[order]
+
+    # Offset arrays - curve_starts[g]:curve_starts[g]+curve_lengths[g] is the rating curve of unique_hydro_ids[g]
+    unique_hydro_ids, curve_starts, curve_lengths = np.unique(rc_hydro_ids, return_index=True, return_counts=True)
+
+    # Match each forecast reach to its rating curve
+    hydro_ids = df_forecast['hydro_id'].to_numpy()
+    forecasts = df_forecast['discharge_cms'].to_numpy(dtype='float64')
+    curve = np.searchsorted(unique_hydro_ids, hydro_ids).clip(max=len(unique_hydro_ids) - 1)
+    has_curve = unique_hydro_ids[curve] == hydro_ids
+    rows = np.flatnonzero(has_curve)
+    if not rows.size:
+        return pd.DataFrame(results, columns=columns, index=df_forecast.index)
+    curve, forecasts = curve[rows], forecasts[rows]
+    starts, lengths = curve_starts[curve], curve_lengths[curve]
+
+    # Batched searchsorted(side='right') within each rating curve. Rating curve rows and forecasts are sorted together
+    # by (curve, value, rating curve rows before forecasts), so every rating curve row that sorts ahead of a forecast
+    # is either in an earlier curve or has a discharge <= the forecast.
+    curve_ids = np.concatenate([np.repeat(np.arange(len(unique_hydro_ids)), curve_lengths), curve])
+    values = np.concatenate([rc_discharges, forecasts])
+    is_forecast = np.concatenate([np.zeros(len(rc_discharges), dtype=bool), np.ones(len(forecasts), dtype=bool)])
+    merged_order = np.lexsort((is_forecast, values, curve_ids))
+    merged_forecast_positions = np.flatnonzero(is_forecast[merged_order])
+    rc_rows_before = merged_forecast_positions - np.arange(len(merged_forecast_positions))
+    global_index = np.empty(len(forecasts), dtype='int64')
+    global_index[merged_order[merged_forecast_positions] - len(rc_discharges)] = rc_rows_before
+    hydrotable_index = global_index - starts
+
+    # Linear interpolation with the same edge handling as np.interp (clamped to the first / last rating curve step)
+    first, last = starts, starts + lengths - 1
+    lower = np.clip(starts + hydrotable_index - 1, first, last)
+    upper = np.clip(starts + hydrotable_index, first, last)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slopes = (rc_stages[upper] - rc_stages[lower]) / (rc_discharges[upper] - rc_discharges[lower])
+        interpolated = slopes * (forecasts - rc_discharges[lower]) + rc_stages[lower]
+        retry = np.isnan(interpolated)
+        interpolated[retry] = (slopes * (forecasts - rc_discharges[upper]) + rc_stages[upper])[retry]
+    flat_step = np.isnan(interpolated) & (rc_stages[lower] == rc_stages[upper])
+    interpolated[flat_step] = rc_stages[lower][flat_step]
+    at_step = (hydrotable_index == 0) | (hydrotable_index >= lengths) | (forecasts == rc_discharges[lower])
+    interpolated[at_step] = np.where(hydrotable_index == 0, rc_stages[first], rc_stages[lower])[at_step]
+    interpolated[np.isnan(forecasts) & (lengths > 1)] = np.nan
+    interpolated_stages = np.round(interpolated, 2)
+
+    # Get the upper and lower values of the 1-ft hydrotable array that the current forecast / interpolated stage is at
     # If streamflow exceeds the rating curve max, just use the max value
-    exceeds_max = False
-    if hydrotable_index >= len(stages):
-        exceeds_max = True
-        hydrotable_index = hydrotable_index - 1
-        
-    hydrotable_previous_index = hydrotable_index-1
-    if CACHE_FIM_RESOLUTION_FT == 1 or exceeds_max:
-        rounded_stage = stages[hydrotable_index]
+    exceeds_max = hydrotable_index >= lengths
+    hydrotable_index = np.where(exceeds_max, lengths - 1, hydrotable_index)
+    hydrotable_previous_index = np.where(hydrotable_index == 0, lengths - 1, hydrotable_index - 1)
+    step = starts + hydrotable_index
+    previous_step = starts + hydrotable_previous_index
+
+    if CACHE_FIM_RESOLUTION_FT == 1:
+        rounded_stages = rc_stages[step]
     else:
-        rounded_stage = round_m_to_nearest_ft_resolution(interpolated_stage, CACHE_FIM_RESOLUTION_FT, CACHE_FIM_RESOLUTION_ROUNDING)
-    rc_previous_stage = stages[hydrotable_previous_index]
-    rc_discharge = discharges[hydrotable_index]
-    rc_previous_discharge = discharges[hydrotable_previous_index]
-    
-    return interpolated_stage, rounded_stage, rc_previous_stage, rc_discharge, rc_previous_discharge
\ No newline at end of file
+        rounded_stages = np.where(exceeds_max, rc_stages[step], round_m_to_nearest_ft_resolution(interpolated_stages, CACHE_FIM_RESOLUTION_FT, CACHE_FIM_RESOLUTION_ROUNDING))
+
+    valid = ~np.isnan(interpolated_stages)
+    for hydro_id in hydro_ids[rows[~valid]]:
+        print(f"WARNING: Interpolated stage is NaN where hydro_id == {hydro_id}")
+
+    results[rows[valid]] = np.column_stack([
+        interpolated_stages, rounded_stages, rc_stages[previous_step], rc_discharges[step], rc_discharges[previous_step]
+    ])[valid]
+
+    return pd.DataFrame(results, columns=columns, index=df_forecast.index)
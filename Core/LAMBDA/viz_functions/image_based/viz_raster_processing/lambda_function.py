@@ -1,10 +1,27 @@
 import boto3
+import io
 import os
+import numpy as np
+import xarray as xr
 import rioxarray as rxr
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from rasterio.crs import CRS
+from rasterio.io import MemoryFile
 from datetime import datetime
 from viz_lambda_shared_funcs import check_if_file_exists, generate_file_list
 
+DOWNLOAD_THREADS = int(os.environ.get('DOWNLOAD_THREADS', 4))  # Number of input files downloaded ahead at once
+OUTPUT_THREADS = int(os.environ.get('OUTPUT_THREADS', 4))  # Number of output rasters encoded / uploaded at once
+COG_OPTIONS = {
+    "driver": "COG",
+    "BLOCKSIZE": 512,
+    "COMPRESS": "DEFLATE",
+    "PREDICTOR": "YES",
+    "OVERVIEWS": "AUTO",
+    "OVERVIEW_RESAMPLING": "NEAREST"
+}
+
 
 def lambda_handler(event, context):
     product_name = event['product']['product']
@@ -39,8 +56,9 @@ def lambda_handler(event, context):
 
     return event
 
-def open_raster(bucket, file, variable):
-    download_path = check_if_file_exists(bucket, file, download=True)
+def open_raster(bucket, file, variable, download_path=None):
+    if not download_path:
+        download_path = check_if_file_exists(bucket, file, download=True)
     print(f"--> Downloaded {file} to {download_path}")
     
     print(f"Opening {variable} in raster for {file}")
@@ -68,6 +86,16 @@ def open_raster(bucket, file, variable):
     return [data, crs]
 
 def create_raster(data, crs, raster_name):
+    """
+    Encodes a raster as a tiled and compressed Cloud Optimized GeoTIFF (with overviews) in memory.
+
+    Args:
+        data (DataArray): The raster data
+        crs (CRS): The coordinate reference system of the raster
+        raster_name (str): The name of the raster (without the .tif extension)
+    Returns:
+        raster (BytesIO): The COG, named {raster_name}.tif
+    """
     print(f"Creating raster for {raster_name}")
     data.rio.write_crs(crs, inplace=True)
     data.rio.write_nodata(0, inplace=True)
@@ -78,46 +106,146 @@ def create_raster(data, crs, raster_name):
     if "_FillValue" in data.attrs:
         data.attrs.pop("_FillValue")
 
-    local_raster = f'/tmp/{raster_name}.tif'
-
-    print(f"Saving raster to {local_raster}")
-    data.rio.to_raster(local_raster)
+    print(f"Saving {raster_name} as a cloud optimized raster")
+    with MemoryFile(ext=".tif") as memfile:
+        data.rio.to_raster(memfile.name, **COG_OPTIONS)
+        raster = io.BytesIO(memfile.read())
+    raster.name = f"{raster_name}.tif"
     
-    return local_raster
+    return raster
 
-def upload_raster(local_raster, output_bucket, output_workspace):
-    raster_name = os.path.basename(local_raster)
+def upload_raster(raster, output_bucket, output_workspace):
+    raster_name = os.path.basename(raster.name)
     
     s3_raster_key = f"{output_workspace}/tif/{raster_name}"
     
     print(f"--> Uploading raster to s3://{output_bucket}/{s3_raster_key}")
     s3 = boto3.client('s3')
     
-    s3.upload_file(local_raster, output_bucket, s3_raster_key)
-    os.remove(local_raster)
+    s3.upload_fileobj(raster, output_bucket, s3_raster_key)
+    raster.close()
 
     return s3_raster_key
 
-def sum_rasters(bucket, input_files, variable):
-    print(f"Adding {variable} variable of {len(input_files)} raster(s)...")
-    sum_initiated = False
-    for input_file in input_files:
-        print(f"Adding {input_file}...")
-        data, crs = open_raster(bucket, input_file, variable)
-        time_index = 0
-        if len(data.time) > 1:
-            time_index = -1
-            for i, t in enumerate(data.time):
-                if str(float(data.sel(time=t)[0][0])) != 'nan':
-                    time_index = i
-                    break
-            if (time_index < 0):
-                raise Exception(f"No valid time steps were found in file: {input_file}")
-        
-        if not sum_initiated:
-            data_sum = data.sel(time=data.time[time_index])
-            sum_initiated = True
-        else:
-            data_sum += data.sel(time=data.time[time_index])
+def write_rasters(rasters, output_bucket, output_workspace, threads=OUTPUT_THREADS):
+    """
+    Encodes and uploads rasters concurrently, keeping up to threads rasters in flight (rasters can be a generator, so
+    that they are only created as they are needed).
+
+    Args:
+        rasters (iterable): The (data, crs, raster_name) of each raster
+        output_bucket (str): S3 bucket of the output rasters
+        output_workspace (str): S3 prefix of the output rasters
+        threads (int): Number of rasters encoded / uploaded at once
+    Returns:
+        uploaded_rasters (list): S3 keys of the uploaded rasters, in the order of rasters
+    """
+    def write_raster(data, crs, raster_name):
+        return upload_raster(create_raster(data, crs, raster_name), output_bucket, output_workspace)
+
+    uploaded_rasters = []
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        pending = deque()
+        for data, crs, raster_name in rasters:
+            pending.append(executor.submit(write_raster, data, crs, raster_name))
+            while len(pending) >= threads:
+                uploaded_rasters.append(pending.popleft().result())
+        while pending:
+            uploaded_rasters.append(pending.popleft().result())
+
+    return uploaded_rasters
+
+def get_valid_time(data, input_file):
+    time_index = 0
+    if len(data.time) > 1:
+        time_index = -1
+        for i, t in enumerate(data.time):
+            if str(float(data.sel(time=t)[0][0])) != 'nan':
+                time_index = i
+                break
+        if (time_index < 0):
+            raise Exception(f"No valid time steps were found in file: {input_file}")
+    return data.time[time_index]
+
+def accumulate_precip(bucket, input_files, accumulations, output_bucket, output_workspace, variable="RAINRATE",
+                      threads=DOWNLOAD_THREADS):
+    """
+    Creates and uploads the accumulated precipitation (inches) rasters of a product in a single pass of its forcing
+    files. Each forcing hour is read once (while the next files are downloaded) and added into the float32 sum of each
+    hour interval that includes it. Accumulations of other accumulations (e.g. daily or forecast totals) are then added
+    up, in order, from their already rounded parts.
+
+    Args:
+        bucket (str): S3 bucket of the forcing files
+        input_files (list): The forcing files, in hour order (input_files[0] is hour 1)
+        accumulations (list): The accumulations of the product, as dicts with a "name" (of the raster, before
+            _accum_precipitation) and either "hours" ([first hour, last hour] of the forcing files to sum) or
+            "accumulations" (names of the accumulations to add up). Optionally, "mask" is the name of the accumulation
+            whose values <= 0.01 are removed from the raster (itself by default), and "output": False skips the raster.
+        output_bucket (str): S3 bucket of the output rasters
+        output_workspace (str): S3 prefix of the output rasters
+        variable (str): The precipitation rate variable of the forcing files
+    Returns:
+        uploaded_rasters (list): S3 keys of the uploaded rasters, in the order of accumulations
+    """
+    hour_intervals = {accumulation["name"]: accumulation["hours"] for accumulation in accumulations if "hours" in accumulation}
+    hours = sorted({hour for first_hour, last_hour in hour_intervals.values() for hour in range(first_hour, last_hour+1)})
+    print(f"Adding {variable} variable of {len(hours)} raster(s) into {len(hour_intervals)} hour interval(s)...")
+
+    interval_sums = {}
+    template = None
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        downloads = deque()
+        for index, hour in enumerate(hours):
+            downloads.append((hour, executor.submit(check_if_file_exists, bucket, input_files[hour-1], download=True)))
+            if len(downloads) <= threads and index < len(hours) - 1:
+                continue
+
+            # Add the downloaded files in hour order, keeping up to threads downloads ahead
+            while downloads and (len(downloads) > threads or index == len(hours) - 1):
+                hour, download = downloads.popleft()
+                input_file = input_files[hour-1]
+                print(f"Adding {input_file}...")
+                data, crs = open_raster(bucket, input_file, variable, download_path=download.result())
+                data = data.sel(time=get_valid_time(data, input_file))
+                if template is None:
+                    template = data
+                values = data.values.astype("float32", copy=False)
+
+                for name, (first_hour, last_hour) in hour_intervals.items():
+                    if first_hour <= hour <= last_hour:
+                        if name not in interval_sums:
+                            interval_sums[name] = values.copy()
+                        else:
+                            interval_sums[name] += values
     print("Done adding rasters!")
-    return data_sum, crs
+
+    accumulated = {}
+    for accumulation in accumulations:
+        name = accumulation["name"]
+        if name in interval_sums:
+            accumulated[name] = np.round(interval_sums.pop(name) * 3600 / 25.4, 2)
+        else:
+            parts = accumulation["accumulations"]
+            accumulated[name] = accumulated[parts[0]].copy()
+            for part in parts[1:]:
+                accumulated[name] += accumulated[part]
+
+    # Free each accumulation once the last raster using it is created
+    last_uses = {}
+    for index, accumulation in enumerate(accumulations):
+        for name in [accumulation["name"], accumulation.get("mask", accumulation["name"])] + accumulation.get("accumulations", []):
+            last_uses[name] = index
+
+    def output_rasters():
+        for index, accumulation in enumerate(accumulations):
+            name = accumulation["name"]
+            if accumulation.get("output", True):
+                mask = accumulated[accumulation.get("mask", name)]
+                data = xr.DataArray(np.where(mask > 0.01, accumulated[name], np.nan), coords=template.coords, dims=template.dims)
+                yield data, crs, f"{name}_accum_precipitation"
+
+            for unused_name in [unused_name for unused_name, last_use in last_uses.items() if last_use == index]:
+                del accumulated[unused_name]
+
+    return write_rasters(output_rasters(), output_bucket, output_workspace)
@@ -1,76 +1,29 @@
 import sys
 sys.path.append("../utils")
-from lambda_function import sum_rasters, create_raster, upload_raster
+from lambda_function import accumulate_precip
 
-def main(product_name, data_bucket, input_files, reference_time, output_bucket, output_workspace):    
-    all_uploaded_rasters = []
-
-    ###########################
+ACCUMULATIONS = [
     ## Day 1 Hourly Precip ##
-    ###########################
-    hour_intervals = [[1, 6], [7, 12], [13, 18], [19, 24]]
-    
-    daily_sum_initiated = False
-    for hours in hour_intervals:
-        hour1 = hours[0]-1
-        hour2 = hours[1]
-    
-        data_sum, crs = sum_rasters(data_bucket, input_files[hour1:hour2], "RAINRATE")
-        
-        data_sum = data_sum * 3600 / 25.4
-        data_sum = data_sum.round(2)
-
-        if not daily_sum_initiated:
-            daily_sum_initiated = True
-            daily_sum = data_sum
-        else:
-            daily_sum += data_sum
-        
-        data_sum = data_sum.where(data_sum>0.01)
-        local_raster = create_raster(data_sum, crs, f"{hours[0]}hour-{hours[1]}hour_accum_precipitation")
+    {"name": "1hour-6hour", "hours": [1, 6]},
+    {"name": "7hour-12hour", "hours": [7, 12]},
+    {"name": "13hour-18hour", "hours": [13, 18]},
+    {"name": "19hour-24hour", "hours": [19, 24]},
 
-        uploaded_raster = upload_raster(local_raster, output_bucket, output_workspace)
-        all_uploaded_rasters.append(uploaded_raster)
-
-    ##########################
     ## Day 1 Total Precip ##
-    ##########################
-    total_sum = daily_sum
-    daily_sum = daily_sum.where(total_sum>0.01)
-    local_raster = create_raster(daily_sum, crs, "1hour-24hour_accum_precipitation")
+    {"name": "1hour-24hour", "accumulations": ["1hour-6hour", "7hour-12hour", "13hour-18hour", "19hour-24hour"]},
 
-    uploaded_raster = upload_raster(local_raster, output_bucket, output_workspace)
-    all_uploaded_rasters.append(uploaded_raster)
-    
-    ###################
     ## Hourly Precip ##
-    ###################
-    hour_intervals = [[25, 48], [49, 72], [73, 120], [121, 168], [169, 240]]
-    
-    for hours in hour_intervals:
-        hour1 = hours[0]-1
-        hour2 = hours[1]
-    
-        data_sum, crs = sum_rasters(data_bucket, input_files[hour1:hour2], "RAINRATE")
-        
-        data_sum = data_sum * 3600 / 25.4
-        data_sum = data_sum.round(2)
-
-        total_sum += data_sum
-        
-        data_sum = data_sum.where(data_sum>0.01)
-        local_raster = create_raster(data_sum, crs, f"{hours[0]}hour-{hours[1]}hour_accum_precipitation")
+    {"name": "25hour-48hour", "hours": [25, 48]},
+    {"name": "49hour-72hour", "hours": [49, 72]},
+    {"name": "73hour-120hour", "hours": [73, 120]},
+    {"name": "121hour-168hour", "hours": [121, 168]},
+    {"name": "169hour-240hour", "hours": [169, 240]},
 
-        uploaded_raster = upload_raster(local_raster, output_bucket, output_workspace)
-        all_uploaded_rasters.append(uploaded_raster)
-    
-    ##########################
     ## Forecast Total Precip ##
-    ##########################
-    total_sum = total_sum.where(total_sum>0.01)
-    local_raster = create_raster(total_sum, crs, "1hour-240hour_accum_precipitation")
+    {"name": "1hour-240hour", "accumulations": [
+        "1hour-24hour", "25hour-48hour", "49hour-72hour", "73hour-120hour", "121hour-168hour", "169hour-240hour"
+    ]}
+]
 
-    uploaded_raster = upload_raster(local_raster, output_bucket, output_workspace)
-    all_uploaded_rasters.append(uploaded_raster)
-    
-    return all_uploaded_rasters
+def main(product_name, data_bucket, input_files, reference_time, output_bucket, output_workspace):
+    return accumulate_precip(data_bucket, input_files, ACCUMULATIONS, output_bucket, output_workspace)
@@ -1,50 +1,21 @@
 import sys
 sys.path.append("..")
-from lambda_function import sum_rasters, create_raster, upload_raster
+from lambda_function import accumulate_precip
 
-def main(product_name, data_bucket, input_files, reference_time, output_bucket, output_workspace):
-    hour_intervals = [[1, 1], [2, 2], [3, 3], [4, 6], [7, 9], [10, 12], [13, 15], [16, 18]]
-    
-    ###################
+ACCUMULATIONS = [
     ## Hourly Precip ##
-    ###################
-
-    total_sum_initiated = False
-    all_uploaded_rasters = []
-    for hours in hour_intervals:
-        hour1 = hours[0]-1
-        hour2 = hours[1]
-    
-        data_sum, crs = sum_rasters(data_bucket, input_files[hour1:hour2], "RAINRATE")
-        
-        data_sum = data_sum * 3600 / 25.4
-        data_sum = data_sum.round(2)
-
-        if not total_sum_initiated:
-            total_sum_initiated = True
-            total_sum = data_sum
-        else:
-            total_sum += data_sum
-        
-        data_sum = data_sum.where(data_sum>0.01)
-        
-        if hours[0] == hours[1]:
-            raster_name = f"{hours[0]}hour_accum_precipitation"
-        else:
-            raster_name = f"{hours[0]}hour-{hours[1]}hour_accum_precipitation"
-
-        local_raster = create_raster(data_sum, crs, raster_name)
+    {"name": "1hour", "hours": [1, 1]},
+    {"name": "2hour", "hours": [2, 2]},
+    {"name": "3hour", "hours": [3, 3]},
+    {"name": "4hour-6hour", "hours": [4, 6]},
+    {"name": "7hour-9hour", "hours": [7, 9]},
+    {"name": "10hour-12hour", "hours": [10, 12]},
+    {"name": "13hour-15hour", "hours": [13, 15]},
+    {"name": "16hour-18hour", "hours": [16, 18]},
 
-        uploaded_raster = upload_raster(local_raster, output_bucket, output_workspace)
-        all_uploaded_rasters.append(uploaded_raster)
-
-    ###################
     ## Total Precip ##
-    ###################
-    total_sum = total_sum.where(total_sum>0.01)
-    local_raster = create_raster(total_sum, crs, "1hour-18hour_accum_precipitation")
-
-    uploaded_raster = upload_raster(local_raster, output_bucket, output_workspace)
-    all_uploaded_rasters.append(uploaded_raster)
+    {"name": "1hour-18hour", "accumulations": ["1hour", "2hour", "3hour", "4hour-6hour", "7hour-9hour", "10hour-12hour", "13hour-15hour", "16hour-18hour"]}
+]
 
-    return all_uploaded_rasters
+def main(product_name, data_bucket, input_files, reference_time, output_bucket, output_workspace):
+    return accumulate_precip(data_bucket, input_files, ACCUMULATIONS, output_bucket, output_workspace)
@@ -1,36 +1,34 @@
 import sys
 sys.path.append("../utils")
-from lambda_function import open_raster, create_raster, upload_raster
+from lambda_function import open_raster, write_rasters
 
 def main(product_name, data_bucket, input_files, reference_time, output_bucket, output_workspace):
     reversed_input_files = sorted(input_files, reverse=True)
 
     ### 72-HOUR SNOW WATER EQUIVALENT CHANGE
-    all_uploaded_rasters = []
-
-    variable = "SNEQV" 
+    variable = "SNEQV"
     hours = [1, 2, 3] #defining loop for input files
     change = {1:24,2:48,3:72} #defining dictionary for naming purposes
-    for hour in hours:
-        swe_present, crs = open_raster(data_bucket, reversed_input_files[0], variable)
-        swe_past, crs = open_raster(data_bucket, reversed_input_files[hour], variable)
-        #get the land files from past 3 days (72hours) in reverse order
 
-        swe_present = swe_present.sel(time = swe_present.time[0])
-        swe_past = swe_past.sel(time = swe_past.time[0])
+    def swe_change_rasters():
+        for hour in hours:
+            swe_present, crs = open_raster(data_bucket, reversed_input_files[0], variable)
+            swe_past, crs = open_raster(data_bucket, reversed_input_files[hour], variable)
+            #get the land files from past 3 days (72hours) in reverse order
 
-        swe_present_nan = swe_present.where(swe_present != -99990)
-        swe_present_nan = swe_present_nan / 254 # convert kg/m2 to inches, should be 25.4 
-        #but there's an extra order of mag
-        swe_past_nan = swe_past.where(swe_past != -99990)
-        swe_past_nan = swe_past_nan /254 #convert kg/m2 to inches
+            swe_present = swe_present.sel(time = swe_present.time[0])
+            swe_past = swe_past.sel(time = swe_past.time[0])
 
-        swe_difference = swe_present_nan - swe_past_nan
-        data = swe_difference.round(2)
+            swe_present_nan = swe_present.where(swe_present != -99990)
+            swe_present_nan = swe_present_nan / 254 # convert kg/m2 to inches, should be 25.4
+            #but there's an extra order of mag
+            swe_past_nan = swe_past.where(swe_past != -99990)
+            swe_past_nan = swe_past_nan /254 #convert kg/m2 to inches
 
-        local_raster = create_raster(data, crs, f"ana_past_{change[hour]}hr_snow_water_equivalent_change")
+            swe_difference = swe_present_nan - swe_past_nan
+            data = swe_difference.round(2)
 
-        uploaded_raster = upload_raster(local_raster, output_bucket, output_workspace)
-        all_uploaded_rasters.append(uploaded_raster)
+            yield data, crs, f"ana_past_{change[hour]}hr_snow_water_equivalent_change"
 
-    return all_uploaded_rasters
+    # The rasters are encoded and uploaded while the next ones are calculated
+    return write_rasters(swe_change_rasters(), output_bucket, output_workspace)
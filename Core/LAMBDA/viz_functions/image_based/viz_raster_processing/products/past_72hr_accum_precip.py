@@ -1,35 +1,27 @@
 import sys
 sys.path.append("../utils")
-from lambda_function import sum_rasters, create_raster, upload_raster
+from lambda_function import accumulate_precip
 
-def main(product_name, data_bucket, input_files, reference_time, output_bucket, output_workspace):
-    reversed_input_files = sorted(input_files, reverse=True)
-    all_uploaded_rasters = []
-
-    ######################################
+ACCUMULATIONS = [
     ## Past 72 Hour Precip in intervals ##
-    ######################################
-    
-    hour_intervals = [[1, 1], [2, 3], [4, 6], [7, 12], [13, 24], [25, 48], [49, 72]]
-    total_sum = None
-    for hours in hour_intervals:
-        hour1 = hours[0]-1
-        hour2 = hours[1]
-    
-        data_sum, crs = sum_rasters(data_bucket, reversed_input_files[hour1:hour2], "RAINRATE")
-        
-        data_sum = data_sum * 3600 / 25.4
-        data_sum = data_sum.round(2)
+    {"name": "1hour", "hours": [1, 1], "output": False},
+    {"name": "2hour-3hour", "hours": [2, 3], "output": False},
+    {"name": "4hour-6hour", "hours": [4, 6], "output": False},
+    {"name": "7hour-12hour", "hours": [7, 12], "output": False},
+    {"name": "13hour-24hour", "hours": [13, 24], "output": False},
+    {"name": "25hour-48hour", "hours": [25, 48], "output": False},
+    {"name": "49hour-72hour", "hours": [49, 72], "output": False},
 
-        if total_sum is None:
-            total_sum = data_sum
-        else:
-            total_sum += data_sum
-        
-        filtered_sum = total_sum.where(total_sum>0.01)
-        local_raster = create_raster(filtered_sum, crs, f"past_{hour2}hour_accum_precipitation")
+    ## Past Precip totals ##
+    {"name": "past_1hour", "accumulations": ["1hour"]},
+    {"name": "past_3hour", "accumulations": ["past_1hour", "2hour-3hour"]},
+    {"name": "past_6hour", "accumulations": ["past_3hour", "4hour-6hour"]},
+    {"name": "past_12hour", "accumulations": ["past_6hour", "7hour-12hour"]},
+    {"name": "past_24hour", "accumulations": ["past_12hour", "13hour-24hour"]},
+    {"name": "past_48hour", "accumulations": ["past_24hour", "25hour-48hour"]},
+    {"name": "past_72hour", "accumulations": ["past_48hour", "49hour-72hour"]}
+]
 
-        uploaded_raster = upload_raster(local_raster, output_bucket, output_workspace)
-        all_uploaded_rasters.append(uploaded_raster)
-    
-    return all_uploaded_rasters
+def main(product_name, data_bucket, input_files, reference_time, output_bucket, output_workspace):
+    reversed_input_files = sorted(input_files, reverse=True)
+    return accumulate_precip(data_bucket, reversed_input_files, ACCUMULATIONS, output_bucket, output_workspace)
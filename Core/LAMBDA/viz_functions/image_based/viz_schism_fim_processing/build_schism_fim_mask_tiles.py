@@ -0,0 +1,48 @@
+"""
+Builds the mask tiles of a SCHISM FIM domain: the interior and exterior mask geometries clipped to each DEM tile, stored
+next to the tiles, which process_schism_fim reads instead of parsing every mask shapefile of the domain in each job.
+Each mask tile records the version (ETags) of the masks and DEM tile it was built from, and jobs go back to clipping the
+mask shapefiles for any tile whose inputs have changed since, so rerun it whenever the masks or the DEM tiles of a
+domain change. It runs from the SCHISM FIM image, with the same INPUTS_BUCKET and INPUTS_PREFIX environment as the
+processing jobs:
+
+    python build_schism_fim_mask_tiles.py atlgulf
+"""
+import argparse
+
+import rasterio
+
+from process_schism_fim import (
+    DOMAINS, INPUTS_BUCKET, INPUTS_PREFIX, S3, clip_masks_to_tile, get_mask_geoms_by_group, get_mask_tile_version,
+    list_mask_objects, write_mask_tile
+)
+
+
+def main(domain):
+    mask_objects = list_mask_objects(domain)
+    mask_geoms_by_group = get_mask_geoms_by_group(domain, mask_objects)
+
+    tiles_prefix = f'{INPUTS_PREFIX}/dems/{domain}/tiles/'
+    print(f"Building mask tiles for the tiles in s3://{INPUTS_BUCKET}/{tiles_prefix}...")
+    n_tiles = 0
+    for page in S3.get_paginator('list_objects_v2').paginate(Bucket=INPUTS_BUCKET, Prefix=tiles_prefix):
+        for tile in page.get('Contents', []):
+            tile_key = tile['Key']
+            if not tile_key.lower().endswith('.tif'):
+                continue
+
+            with rasterio.open(f's3://{INPUTS_BUCKET}/{tile_key}') as dem:
+                tile_masks = clip_masks_to_tile(mask_geoms_by_group, dem.bounds)
+            mask_tile_key = write_mask_tile(tile_key, tile_masks, get_mask_tile_version(mask_objects, tile['ETag']))
+            n_geoms = {group: len(tile_mask['geoms']) for group, tile_mask in tile_masks.items()}
+            print(f"... {mask_tile_key}: {n_geoms}")
+            n_tiles += 1
+
+    print(f"Built {n_tiles} mask tiles for {domain}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('domain', choices=DOMAINS)
+    args = parser.parse_args()
+    main(args.domain)
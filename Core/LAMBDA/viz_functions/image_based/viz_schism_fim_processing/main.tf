@@ -58,6 +58,8 @@ variable "viz_db_user_secret_string" {
 
 locals {
   viz_schism_fim_resource_name = "hv-vpp-${var.environment}-viz-schism-fim-processing"
+  # tiles of a job are processed in parallel, with one process (and its share of memory) per vCPU
+  schism_fim_tile_processes = 2
 }
 
 
@@ -84,6 +86,11 @@ data "archive_file" "schism_processing_zip" {
     filename = "process_schism_fim.py"
   }
 
+  source {
+    content  = file("${path.module}/build_schism_fim_mask_tiles.py")
+    filename = "build_schism_fim_mask_tiles.py"
+  }
+
   source {
     content  = file("${path.module}/requirements.txt")
     filename = "requirements.txt"
@@ -310,11 +317,11 @@ resource "aws_batch_job_definition" "schism_fim_job_definition" {
     resourceRequirements = [
       {
         type  = "VCPU"
-        value = "1"
+        value = tostring(local.schism_fim_tile_processes)
       },
       {
         type  = "MEMORY"
-        value = "7000"
+        value = tostring(7000 * local.schism_fim_tile_processes)
       }
     ]
 
@@ -327,6 +334,10 @@ resource "aws_batch_job_definition" "schism_fim_job_definition" {
         name  = "INPUTS_PREFIX"
         value = "schism_fim"
       },
+      {
+        name  = "TILE_PROCESSES"
+        value = tostring(local.schism_fim_tile_processes)
+      },
       {
         name  = "VIZ_DB_DATABASE"
         value = var.viz_db_name
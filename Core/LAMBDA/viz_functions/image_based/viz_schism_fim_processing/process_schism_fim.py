@@ -9,23 +9,32 @@
 #
 ################################
 import boto3
+import hashlib
+import io
 import geopandas as gpd
 import fiona
 import numpy as np
 import rasterio
-import rasterio.mask
-import rioxarray as rxr
+import rasterio.features
+import rasterio.warp
+import rasterio.windows
 import os
 import s3fs
 import xarray as xr
 import json
+import multiprocessing
 import sys
 
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 # from fiona.model import to_dict
 from rasterio.session import AWSSession
+from rasterio.enums import Resampling
 from rasterio.io import MemoryFile
-from scipy.interpolate import griddata
-from shapely.geometry import box, shape
+from scipy.sparse import csr_matrix
+from scipy.spatial import cKDTree, Delaunay
+from shapely.geometry import box, mapping, shape
+from shapely.prepared import prep
 from time import sleep, time
 
 # DO NOT LEAVE THIS COMMENTED!!!!!!!
@@ -41,6 +50,13 @@ S3 = boto3.client('s3')
 DOMAINS = ['atlgulf', 'pacific', 'hi', 'prvi']
 NO_DATA = np.nan
 METERS_TO_FT = 3.281
+WEIGHTS_FOLDER = 'interpolation_weights'
+MASK_TILES_FOLDER = 'mask_tiles'
+MASK_TILE_BUFFER = 10 * GRID_SIZE
+TILE_PROCESSES = int(os.environ.get('TILE_PROCESSES', 1))
+WRITER_THREADS = 4
+
+ForecastPoints = namedtuple('ForecastPoints', ['x', 'y', 'elev'])
 
 def main(event):
     main_start = time()
@@ -59,70 +75,218 @@ def main(event):
 
     print(f"Processing {config_name} for {reference_time}...")
     
-    mask_geoms_by_group = get_mask_geoms_by_group(domain)
-    fcst_points = get_fcst_point_ds(fim_config)
+    masks_by_tile = get_masks_by_tile(domain, tile_keys)
+    fcst_points = get_fcst_point_index(get_fcst_point_ds(fim_config))
     process_db = database(db_type="viz")
     run_times = []
     main_end = time()
     print(f'Top-level processing (i.e. data from network to memory) time: {main_end - main_start} seconds')
-    
-    for tile_key in tile_keys:
-        start = time()
-        final_grid_memfile, polygon_df = create_fim_by_tile(tile_key, fcst_points, mask_geoms_by_group)
-        end = time()
-        run_times.append(end - start)
-        depth_key = f"{output_workspace}/tif/{tile_key.split('/')[-1]}"
-        print(f"Uploading depth grid to AWS at s3://{output_bucket}/{depth_key}")
-        start = time()
-        S3.upload_fileobj(
-            final_grid_memfile,
-            output_bucket,
-            depth_key
-        )
-        end = time()
-        print(f"Upload depth to S3 time: {end-start} seconds")
 
-        start = time()
-        if polygon_df.empty:
-            print("Raster to polygon yielded no features.")
-        else:
-            print("Writing polygons to PostGIS database...")
-            attempts = 3
-            polygon_df.to_crs(3857, inplace=True)
-            polygon_df.set_crs('epsg:3857', inplace=True)
-            polygon_df.rename_geometry('geom', inplace=True)
-            for attempt in range(attempts):
-                try:
-                    polygon_df.to_postgis(target_table, con=process_db.engine, schema=target_table_schema, if_exists='append')
-                    break
-                except Exception as e:
-                    if attempt == attempts - 1:
-                        raise Exception(f"Failed to add SCHISM FIM polygons to DB for {tile_key} of {config_name}: ({e})")
-                    else:
-                        sleep(1)
-        end = time()
-        print(f"Polygon to DB time: {end-start} seconds")
-    process_db.engine.dispose()
+    # tiles are uploaded and written to the DB on threads, while the next
+    # tiles are still being processed
+    with ThreadPoolExecutor(max_workers=WRITER_THREADS) as writer:
+        writes = []
+        for tile_key, depth_tif, polygon_df, run_time in process_tiles(tile_keys, fcst_points, masks_by_tile):
+            run_times.append(run_time)
+            writes.append(writer.submit(
+                write_tile_outputs, tile_key, depth_tif, polygon_df, output_bucket, output_workspace,
+                target_table, target_table_schema, process_db, config_name
+            ))
+        for write in as_completed(writes):
+            write.result()
+
     print(f'Tile processing times (in seconds): {run_times}')
     return {
         "success": True
     }
 
-def get_mask_geoms_by_group(domain):
-    print(f'Getting mask groups for {domain} domain...')
-    mask_groups = {}
+#
+# Processes tiles and yields their depth tif bytes and FIM polygons as they
+# finish. With more than one process, the tiles are fanned out to a pool of
+# forked workers, which inherit the forecast points index and masks instead
+# of loading their own copies
+#
+def process_tiles(tile_keys, fcst_points, masks_by_tile, processes=TILE_PROCESSES):
+    processes = min(processes, len(tile_keys))
+    if processes <= 1:
+        init_tile_worker(fcst_points, masks_by_tile)
+        for tile_key in tile_keys:
+            yield process_tile(tile_key)
+        return
+
+    print(f"Processing {len(tile_keys)} tiles with {processes} processes...")
+    # all of the workers are forked when the first tile is submitted, before
+    # any writer threads are running
+    with ProcessPoolExecutor(
+        max_workers=processes,
+        mp_context=multiprocessing.get_context('fork'),
+        initializer=init_tile_worker,
+        initargs=(fcst_points, masks_by_tile, True)
+    ) as pool:
+        tiles = [pool.submit(process_tile, tile_key) for tile_key in tile_keys]
+        for tile in as_completed(tiles):
+            yield tile.result()
+
+def init_tile_worker(fcst_points, masks_by_tile, forked=False):
+    global TILE_INPUTS, S3
+    TILE_INPUTS = (fcst_points, masks_by_tile)
+    if forked:
+        # boto3 clients can't be shared across a fork
+        S3 = boto3.client('s3')
+
+def process_tile(tile_key):
+    start = time()
+    fcst_points, masks_by_tile = TILE_INPUTS
+    final_grid_memfile, polygon_df = create_fim_by_tile(tile_key, fcst_points, masks_by_tile[tile_key])
+    depth_tif = final_grid_memfile.read()
+    final_grid_memfile.close()
+    end = time()
+    return tile_key, depth_tif, polygon_df, end - start
+
+def write_tile_outputs(tile_key, depth_tif, polygon_df, output_bucket, output_workspace,
+                       target_table, target_table_schema, process_db, config_name):
+    depth_key = f"{output_workspace}/tif/{tile_key.split('/')[-1]}"
+    print(f"Uploading depth grid to AWS at s3://{output_bucket}/{depth_key}")
+    start = time()
+    S3.upload_fileobj(
+        io.BytesIO(depth_tif),
+        output_bucket,
+        depth_key
+    )
+    end = time()
+    print(f"Upload depth to S3 time: {end-start} seconds")
+
+    start = time()
+    if polygon_df.empty:
+        print("Raster to polygon yielded no features.")
+    else:
+        print("Writing polygons to PostGIS database...")
+        attempts = 3
+        polygon_df.to_crs(3857, inplace=True)
+        polygon_df.set_crs('epsg:3857', inplace=True)
+        polygon_df.rename_geometry('geom', inplace=True)
+        for attempt in range(attempts):
+            try:
+                polygon_df.to_postgis(target_table, con=process_db.engine, schema=target_table_schema, if_exists='append')
+                break
+            except Exception as e:
+                if attempt == attempts - 1:
+                    raise Exception(f"Failed to add SCHISM FIM polygons to DB for {tile_key} of {config_name}: ({e})")
+                else:
+                    sleep(1)
+    end = time()
+    print(f"Polygon to DB time: {end-start} seconds")
+
+#
+# Gets the masks of each tile from its prebuilt mask tile (see
+# build_schism_fim_mask_tiles.py). Tiles without one, or whose mask tile was
+# built from different mask shapefiles or a different DEM tile, fall back to
+# clipping the domain's mask shapefiles to the tile here
+#
+def get_masks_by_tile(domain, tile_keys):
+    mask_objects = list_mask_objects(domain)
+    masks_by_tile = {}
+    for tile_key in tile_keys:
+        try:
+            dem_etag = S3.head_object(Bucket=INPUTS_BUCKET, Key=tile_key)['ETag']
+            tile_masks = read_mask_tile(tile_key, get_mask_tile_version(mask_objects, dem_etag))
+        except Exception as e:
+            print(f"...No mask tile for {tile_key} ({e})")
+            continue
+        if tile_masks is not None:
+            masks_by_tile[tile_key] = tile_masks
+
+    missing_tile_keys = [tile_key for tile_key in tile_keys if tile_key not in masks_by_tile]
+    if missing_tile_keys:
+        mask_geoms_by_group = get_mask_geoms_by_group(domain, mask_objects)
+        for tile_key in missing_tile_keys:
+            with rasterio.open(f's3://{INPUTS_BUCKET}/{tile_key}') as dem:
+                masks_by_tile[tile_key] = clip_masks_to_tile(mask_geoms_by_group, dem.bounds)
+
+    return masks_by_tile
+
+def list_mask_objects(domain):
     masks_prefix = f'{INPUTS_PREFIX}/masks/{domain}/'
     result = S3.list_objects(Bucket=INPUTS_BUCKET, Prefix=masks_prefix)
-    mask_prefixes = result.get('Contents')
+    return result.get('Contents', [])
+
+def get_mask_geoms_by_group(domain, mask_objects=None):
+    print(f'Getting mask groups for {domain} domain...')
+    mask_groups = {}
+    if mask_objects is None:
+        mask_objects = list_mask_objects(domain)
     for group_key in ['interior', 'exterior']:
         print(f'... Getting {group_key} masks... ')
-        mask_groups[group_key] = geoms = []
-        for m in mask_prefixes:
+        geoms = []
+        for m in mask_objects:
             if group_key in m['Key']:                
                 with fiona.open(f"zip+s3://{INPUTS_BUCKET}/{m['Key']}", "r") as shapefile:
                     geoms.extend(shape(feature["geometry"]) for feature in shapefile)    
+        # groups without any masks in the domain are left out
+        if geoms:
+            mask_groups[group_key] = geoms
     return mask_groups
 
+#
+# Clips the mask geometries of a domain to the (buffered) bounds of a tile.
+# The bounds of all of a group's geometries are kept with the clipped ones,
+# since exterior masks crop tiles to those, even where the group is empty
+#
+def clip_masks_to_tile(mask_geoms_by_group, bounds, buffer=MASK_TILE_BUFFER):
+    clip_box = box(bounds[0] - buffer, bounds[1] - buffer, bounds[2] + buffer, bounds[3] + buffer)
+    prepared_clip_box = prep(clip_box)
+
+    tile_masks = {}
+    for group, geoms in mask_geoms_by_group.items():
+        clipped_geoms = (geom.intersection(clip_box) for geom in geoms if prepared_clip_box.intersects(geom))
+        all_bounds = np.array([geom.bounds for geom in geoms])
+        tile_masks[group] = {
+            'geoms': [geom for geom in clipped_geoms if not geom.is_empty],
+            'bounds': (*all_bounds[:, :2].min(axis=0).tolist(), *all_bounds[:, 2:].max(axis=0).tolist())
+        }
+    return tile_masks
+
+#
+# Gets the version of a mask tile: a hash of the ETags of the domain's mask
+# shapefiles and of the DEM tile, and of the clipping buffer, which is stored
+# in the mask tile so that jobs never apply masks built from older inputs
+#
+def get_mask_tile_version(mask_objects, dem_etag, buffer=MASK_TILE_BUFFER):
+    mask_version = hashlib.sha1()
+    for mask_object in sorted(mask_objects, key=lambda m: m['Key']):
+        mask_version.update(f"{mask_object['Key']} {mask_object['ETag']}\n".encode())
+    mask_version.update(f"{dem_etag} {buffer!r}".encode())
+    return mask_version.hexdigest()
+
+def get_mask_tile_key(tile_key):
+    tiles_folder, tile_name = os.path.split(tile_key)
+    tile_name = os.path.splitext(tile_name)[0]
+    return f"{os.path.dirname(tiles_folder)}/{MASK_TILES_FOLDER}/{tile_name}.geojson"
+
+def read_mask_tile(tile_key, version):
+    mask_tile = json.loads(S3.get_object(Bucket=INPUTS_BUCKET, Key=get_mask_tile_key(tile_key))['Body'].read())
+    if mask_tile.get('version') != version:
+        print(f"...Mask tile for {tile_key} is out of date with the masks or DEM tile, clipping the masks instead")
+        return None
+    tile_masks = {group: {'geoms': [], 'bounds': tuple(bounds)} for group, bounds in mask_tile['groups'].items()}
+    for feature in mask_tile['features']:
+        tile_masks[feature['properties']['group']]['geoms'].append(shape(feature['geometry']))
+    return tile_masks
+
+def write_mask_tile(tile_key, tile_masks, version):
+    mask_tile = {
+        'type': 'FeatureCollection',
+        'version': version,
+        'groups': {group: tile_mask['bounds'] for group, tile_mask in tile_masks.items()},
+        'features': [
+            {'type': 'Feature', 'properties': {'group': group}, 'geometry': mapping(geom)}
+            for group, tile_mask in tile_masks.items() for geom in tile_mask['geoms']
+        ]
+    }
+    mask_tile_key = get_mask_tile_key(tile_key)
+    S3.put_object(Body=json.dumps(mask_tile).encode(), Bucket=INPUTS_BUCKET, Key=mask_tile_key)
+    return mask_tile_key
+
 def get_fcst_point_ds(fim_config):
     fim_config_preprocessing = fim_config.get('preprocess', {})
     preprocessing_output_file_format = fim_config_preprocessing.get('output_file')
@@ -147,7 +311,64 @@ def get_fcst_point_ds(fim_config):
 
     return fcst_point_ds
 
-def create_fim_by_tile(tile_key, fcst_points, mask_geoms_by_group):
+#
+# Builds a spatial index of the SCHISM forecast points, once per run, so
+# that each tile only looks at the nodes near it instead of the whole mesh
+#
+def get_fcst_point_index(fcst_point_ds):
+    if fcst_point_ds is None:
+        return None
+
+    print("Building spatial index of SCHISM forecast points...")
+    # drop nodes with missing values in any variable, like dropna did on the
+    # clipped Dataset, so the index only holds usable forecast points
+    valid = np.ones(fcst_point_ds.sizes['node'], dtype=bool)
+    for var in fcst_point_ds.data_vars.values():
+        if 'node' in var.dims:
+            valid &= var.notnull().all([dim for dim in var.dims if dim != 'node']).values
+
+    elev = fcst_point_ds.elev if len(fcst_point_ds.elev.dims) == 1 else fcst_point_ds.elev[0]
+    return ForecastPointIndex(
+        fcst_point_ds.x.values[valid],
+        fcst_point_ds.y.values[valid],
+        elev.values[valid]
+    )
+
+class ForecastPointIndex:
+    def __init__(self, x, y, elev):
+        self.points = ForecastPoints(x, y, elev)
+        self.tree = cKDTree(np.column_stack((x, y)))
+        print(f"...Indexed {len(x)} forecast points.")
+
+    def query(self, bounds, buffer=0):
+        """
+        Gets the forecast points within some bounds.
+
+        Args:
+            bounds (tuple): The (x_min, y_min, x_max, y_max) bounds to query
+            buffer (float): Distance, in degrees, to grow the bounds by on each side
+
+        Returns:
+            ForecastPoints: x, y and elev arrays of the points strictly inside the
+                (buffered) bounds, in mesh order
+        """
+        x_min, y_min = bounds[0] - buffer, bounds[1] - buffer
+        x_max, y_max = bounds[2] + buffer, bounds[3] + buffer
+
+        # the smallest square around the bounds, with a little slack for
+        # rounding, then trim the corners and edges off exactly
+        center = ((x_min + x_max) / 2, (y_min + y_max) / 2)
+        radius = max(x_max - x_min, y_max - y_min) / 2
+        nodes = self.tree.query_ball_point(center, radius * (1 + 1e-9), p=np.inf, return_sorted=True)
+        nodes = np.asarray(nodes, dtype=np.intp)
+
+        x = self.points.x[nodes]
+        y = self.points.y[nodes]
+        nodes = nodes[(x < x_max) & (x > x_min) & (y < y_max) & (y > y_min)]
+
+        return ForecastPoints(*(values[nodes] for values in self.points))
+
+def create_fim_by_tile(tile_key, fcst_points, tile_masks):
     print(f'Processing tile {tile_key}...')
     tile_uri = f's3://{INPUTS_BUCKET}/{tile_key}'
     start = time()
@@ -170,7 +391,8 @@ def create_fim_by_tile(tile_key, fcst_points, mask_geoms_by_group):
         
         # interpolate the schism data
         start = time()
-        interp_grid_memfile = interpolate(clipped_npds, GRID_SIZE)
+        weights_key = get_weights_key(tile_key, clipped_npds, GRID_SIZE)
+        interp_grid, interp_transform = interpolate(clipped_npds, GRID_SIZE, weights_key)
         del clipped_npds
         end = time()
         print(f"Interpolation time: {end-start} seconds")
@@ -178,8 +400,8 @@ def create_fim_by_tile(tile_key, fcst_points, mask_geoms_by_group):
         # subtract dem from schism data 
         # (includes code to match extent/resolution)
         start = time()
-        wse_grid = wse_to_depth(interp_grid_memfile, dem_obj)
-        del interp_grid_memfile
+        wse_grid = wse_to_depth(interp_grid, interp_transform, dem_obj)
+        del interp_grid
         end = time()
         print(f"WSE to Depth time: {end-start} seconds")
         if wse_grid is None:
@@ -188,47 +410,42 @@ def create_fim_by_tile(tile_key, fcst_points, mask_geoms_by_group):
 
         # apply masks
         start = time()
-        final_grid_memfile = mask_fim(wse_grid, mask_geoms_by_group)
+        final_grid, final_transform = mask_fim(*wse_grid, tile_masks)
         del wse_grid
         end = time()
         print(f"Apply masks time: {end-start} seconds")
     except Exception as e:
         print(e)
         print("Issue encountered (see above). Creating empty tile...")
-        final_grid_memfile = create_empty_tile(dem_obj)
+        final_grid, final_transform = create_empty_tile(dem_obj)
 
     dem_obj.close()
     print("Converting depth to binary fim...")
-    # translate all > 0 depth values to 1 for wet (everything else [dry] already 0)
     start = time()
-    binary_fim_memfile = fim_to_binary(final_grid_memfile)
+    binary_fim = fim_to_binary(final_grid)
     end = time()
     print(f"FIM to Binary time: {end-start} seconds")
     start = time()
-    polygon_df = raster_to_polygon_dataframe(binary_fim_memfile, {})
+    polygon_df = raster_to_polygon_dataframe(binary_fim, final_transform, {})
     end = time()
     print(f"Raster to polygon DF time: {end-start} seconds")
 
+    # the depth grid is only encoded once, for the upload
+    start = time()
+    final_grid_memfile = write_grid_memfile(final_grid, final_transform)
+    end = time()
+    print(f"Depth grid to GeoTIFF time: {end-start} seconds")
+
     print(f"Successfully processed tile {os.path.basename(tile_key)}")
     return final_grid_memfile, polygon_df
 
 #
 # Clips SCHISM forecast points to fit some shapefile bounds
 #
-def clip_to_bounds(fcst_points, bounds):
+def clip_to_bounds(fcst_points, bounds, buffer=0):
     print("Clipping SCHISM max_elevs domain to new tile domain...")
 
-    fcst_points_clipped = fcst_points.where(
-        ((fcst_points.x < bounds[2]) & #x_max
-        (fcst_points.x > bounds[0]) & #x_min
-        (fcst_points.y < bounds[3]) & #y_max
-        (fcst_points.y > bounds[1])), #y_min
-        NO_DATA
-    )
-    
-    fcst_points_clipped = fcst_points_clipped.dropna('node', how="any")
-    
-    return fcst_points_clipped
+    return fcst_points.query(bounds, buffer)
 
 def check_names(f):
     # time series netcdf needs to have x, y, and elev variables
@@ -252,7 +469,22 @@ def check_names(f):
 
     return f
 
-def interpolate(numpy_ds, grid_size):
+#
+# Gets the S3 key of the interpolation weights of a tile, next to the DEM
+# tiles. The weights only depend on the tile's mesh nodes and the grid size,
+# so those are hashed into the key, and a new mesh version gets new weights
+#
+def get_weights_key(tile_key, numpy_ds, grid_size):
+    mesh_version = hashlib.sha1()
+    mesh_version.update(np.ascontiguousarray(numpy_ds.x, dtype='float64').tobytes())
+    mesh_version.update(np.ascontiguousarray(numpy_ds.y, dtype='float64').tobytes())
+    mesh_version.update(np.float64(grid_size).tobytes())
+
+    tiles_folder, tile_name = os.path.split(tile_key)
+    tile_name = os.path.splitext(tile_name)[0]
+    return f"{os.path.dirname(tiles_folder)}/{WEIGHTS_FOLDER}/{tile_name}/{mesh_version.hexdigest()}.npz"
+
+def interpolate(numpy_ds, grid_size, weights_key=None):
     print('Interpolating max_elevs grid...')
 
     # get bounding box of forecast points 
@@ -260,260 +492,249 @@ def interpolate(numpy_ds, grid_size):
     x_max = np.max(numpy_ds.x)
     y_min = np.min(numpy_ds.y)
     y_max = np.max(numpy_ds.y)
+    grid_x = np.arange(x_min, x_max, grid_size)
+    grid_y = np.arange(y_min, y_max, grid_size)
 
     print("...Creating grid and interpolating...")
     # interpolate over forecast points' elevation data onto the new xx-yy grid
-    # .. cubic is also an option for cubic spline, vs barycentric linear
-    # .. or nearest, for nearest neighbor, but that's slower (better for depth?)
+    # .. with barycentric linear weights, which only depend on the mesh, so
+    # they're cached and each forecast is a sparse matrix-vector product
+    weights = get_interpolation_weights(numpy_ds, grid_x, grid_y, weights_key)
+    interp_grid = np.full(len(grid_x) * len(grid_y), np.nan)
+    interp_grid[weights['cells']] = weights['matrix'] @ np.asarray(numpy_ds.elev, dtype='float64')
 
     # reverse order rows are stored in to match with descending y / lat values
-    interp_grid = np.flip(
-        griddata(
-            np.column_stack((numpy_ds.x, numpy_ds.y)), 
-            numpy_ds.elev if len(numpy_ds.elev.dims) == 1 else numpy_ds.elev[0],
-            tuple(
-                np.meshgrid(
-                    np.arange(x_min, x_max, grid_size),
-                    np.arange(y_min, y_max, grid_size)
-                )
-            ), 
-            method="linear"
-        ),
-        0
-    )
+    interp_grid = np.flip(interp_grid.reshape(len(grid_y), len(grid_x)), 0)
 
-    # write out interpolated raster to file or to a memory file for later use
-    interp_memfile = MemoryFile()
-    with interp_memfile.open(
-        height=interp_grid.shape[0],
-        width=interp_grid.shape[1],
-        count=1,
-        compress='lzw',
-        dtype=interp_grid.dtype,
-        driver="GTiff",
-        crs="epsg:4326",
-        transform=rasterio.transform.from_origin(
-            x_min, y_max, grid_size, grid_size)
-    ) as src:
-        # write single-band raster
-        src.write(interp_grid, 1)
-
-    return interp_memfile
-
-def wse_to_depth(interp_grid_memfile, dem):
-    # clip the interpolated rst and dem to match bounding boxes
-    dem_bounds = None
-    rst_bounds = None
-    with interp_grid_memfile.open() as rst:
-        rst_bounds = rst.bounds
-        dem_bounds = dem.bounds
-        # get overlapping boundaries
-        x_min = max(rst_bounds[0], dem_bounds[0]) # max of left values
-        y_min = max(rst_bounds[1], dem_bounds[1]) # max of bottom values
-        x_max = min(rst_bounds[2], dem_bounds[2]) # min of right values
-        y_max = min(rst_bounds[3], dem_bounds[3]) # min of top values
-
-        # create a clipping box of the overlapping boundaries
-        feature = box(x_min, y_min, x_max, y_max)
-
-        # clip the interp raster and topobathy dem to be same bounds
+    return interp_grid, rasterio.transform.from_origin(x_min, y_max, grid_size, grid_size)
+
+def get_interpolation_weights(numpy_ds, grid_x, grid_y, weights_key=None):
+    n_points = len(numpy_ds.x)
+    n_cells = len(grid_x) * len(grid_y)
+
+    weights = None
+    if weights_key:
         try:
-            rst_masked, rst_trans = rasterio.mask.mask(rst, [feature],
-                crop=True,
-                #nodata=0)
-                nodata=NO_DATA)
-            dem_masked, dem_trans = rasterio.mask.mask(dem, [feature],
-                crop=True,
-                #nodata=0)
-                nodata=NO_DATA)
-        except:
-            # no overlapping area for the raster and dem
-            return None
-
-    # write out rst_masked with updated metadata
-    # (can write to memory file instead)
-    #
-    # ... writing these to a file or memfile lets us use them as rasterio
-    # DatasetReader later, which makes it easier to match their extents and
-    # resolution perfectly to allow us to subtract correctly
-    temp_rst_memfile = MemoryFile()
-    with temp_rst_memfile.open(
-        height=rst_masked.shape[1],
-        width=rst_masked.shape[2],
-        count=1,
-        compress='lzw',
-        dtype=rst_masked.dtype,
-        driver="GTiff",
-        crs="epsg:4326",
-        transform=rst_trans
-    ) as rst_src:
-        # write single-band raster
-        rst_src.write(rst_masked[0], 1)
+            start = time()
+            body = S3.get_object(Bucket=INPUTS_BUCKET, Key=weights_key)['Body'].read()
+            with np.load(io.BytesIO(body)) as cached:
+                weights = {name: cached[name] for name in cached.files}
+            if weights['shape'].tolist() != [n_cells, n_points]:
+                print(f"...Cached interpolation weights at {weights_key} don't match the grid, rebuilding them")
+                weights = None
+            else:
+                print(f"...Read cached interpolation weights from {weights_key} in {time() - start} seconds")
+        except Exception as e:
+            print(f"...No cached interpolation weights at {weights_key} ({e})")
+            weights = None
+
+    if weights is None:
+        start = time()
+        weights = build_interpolation_weights(numpy_ds, grid_x, grid_y)
+        print(f"...Built interpolation weights in {time() - start} seconds")
+        if weights_key:
+            try:
+                weights_file = io.BytesIO()
+                np.savez_compressed(weights_file, **weights)
+                weights_file.seek(0)
+                S3.upload_fileobj(weights_file, INPUTS_BUCKET, weights_key)
+                print(f"...Cached interpolation weights at s3://{INPUTS_BUCKET}/{weights_key}")
+            except Exception as e:
+                print(f"WARNING: Failed to cache interpolation weights at {weights_key} ({e})")
+
+    # each grid cell inside the mesh is a weighted sum of its triangle's 3 nodes
+    n_inside = len(weights['cells'])
+    return {
+        'cells': weights['cells'],
+        'matrix': csr_matrix(
+            (weights['weights'].ravel(), weights['vertices'].ravel(), np.arange(0, 3 * n_inside + 1, 3)),
+            shape=(n_inside, n_points)
+        )
+    }
 
-    # write out dem with updated metadata
-    temp_dem_memfile = MemoryFile()
-    with temp_dem_memfile.open(
-        height=dem_masked.shape[1],
-        width=dem_masked.shape[2],
-        count=1,
-        compress='lzw',
-        dtype=dem_masked.dtype,
-        driver="GTiff",
-        crs="epsg:4326",
-        transform=dem_trans
-    ) as dem_src:
-        # write single-band raster
-        dem_src.write(dem_masked[0], 1)
-
-    # match resolution and coordinates of dem to the interpolation
-    # .. even if the extent and resolution are the same, it's good to do
-    # this to be absolutely certain before trying to do raster math
-    with rxr.open_rasterio(temp_rst_memfile) as rst_masked:
-        with rxr.open_rasterio(temp_dem_memfile) as dem_masked:
-            # create dem with projection and resolution that matches interp rst
-            matching_dem = dem_masked.rio.reproject_match(rst_masked)
-            # make sure coordinates of dem match rst
-            matching_dem = matching_dem.assign_coords({
-                    'x':rst_masked.x,
-                    'y':rst_masked.y
-            })
+#
+# Triangulates the forecast points and finds the barycentric weights of the
+# triangle around each grid cell, the same as scipy's linear griddata does
+#
+def build_interpolation_weights(numpy_ds, grid_x, grid_y):
+    points = np.column_stack((numpy_ds.x, numpy_ds.y)).astype('float64')
+    grid_points = np.column_stack([coords.ravel() for coords in np.meshgrid(grid_x, grid_y)])
+
+    triangulation = Delaunay(points)
+    simplices = triangulation.find_simplex(grid_points)
+    cells = np.flatnonzero(simplices >= 0)
+    simplices = simplices[cells]
+
+    # cells outside of the mesh are left out, and stay NO_DATA
+    transform = triangulation.transform
+    dx = grid_points[cells, 0] - transform[simplices, 2, 0]
+    dy = grid_points[cells, 1] - transform[simplices, 2, 1]
+    b0 = transform[simplices, 0, 0] * dx + transform[simplices, 0, 1] * dy
+    b1 = transform[simplices, 1, 0] * dx + transform[simplices, 1, 1] * dy
+
+    return {
+        'shape': np.array([len(grid_points), len(points)]),
+        'cells': cells.astype('int32'),
+        'vertices': triangulation.simplices[simplices].astype('int32'),
+        'weights': np.column_stack((b0, b1, 1.0 - b0 - b1))
+    }
+
+#
+# Gets the window of a raster grid that covers some shapes, the same way
+# rasterio.mask does for a dataset. Raises a WindowError if they don't overlap
+#
+def get_geometry_window(shape, transform, geoms):
+    all_bounds = [rasterio.features.bounds(geom, transform=~transform) for geom in geoms]
+    cols = [col for (left, bottom, right, top) in all_bounds for col in (left, right)]
+    rows = [row for (left, bottom, right, top) in all_bounds for row in (top, bottom)]
+
+    row_start, row_stop = int(np.floor(min(rows))), int(np.ceil(max(rows)))
+    col_start, col_stop = int(np.floor(min(cols))), int(np.ceil(max(cols)))
+    window = rasterio.windows.Window(
+        col_off=col_start,
+        row_off=row_start,
+        width=max(col_stop - col_start, 0),
+        height=max(row_stop - row_start, 0)
+    )
+
+    return window.intersection(rasterio.windows.Window(0, 0, shape[1], shape[0]))
+
+#
+# Sets the cells of a grid outside of some shapes (or inside of them, if
+# inverted) to NO_DATA, optionally cropping the grid to some bounds first
+#
+def mask_grid(grid, transform, geoms, crop_bounds=None, invert=False):
+    if crop_bounds is not None:
+        window = get_geometry_window(grid.shape, transform, [box(*crop_bounds)])
+        grid = grid[window.toslices()]
+        transform = rasterio.windows.transform(window, transform)
+
+    if geoms:
+        mask = rasterio.features.geometry_mask(geoms, out_shape=grid.shape, transform=transform, invert=invert)
+    else:
+        # none of the shapes are on this grid
+        mask = np.full(grid.shape, not invert)
+
+    grid = np.where(mask, NO_DATA, grid)
+    return grid, transform
+
+def wse_to_depth(interp_grid, interp_transform, dem):
+    # clip the interpolated grid and dem to match bounding boxes
+    rst_bounds = rasterio.transform.array_bounds(*interp_grid.shape, interp_transform)
+    dem_bounds = dem.bounds
+    # get overlapping boundaries
+    x_min = max(rst_bounds[0], dem_bounds[0]) # max of left values
+    y_min = max(rst_bounds[1], dem_bounds[1]) # max of bottom values
+    x_max = min(rst_bounds[2], dem_bounds[2]) # min of right values
+    y_max = min(rst_bounds[3], dem_bounds[3]) # min of top values
+
+    # create a clipping box of the overlapping boundaries
+    feature = box(x_min, y_min, x_max, y_max)
+
+    # clip the interp grid and topobathy dem to be same bounds
+    try:
+        rst_masked, rst_trans = mask_grid(interp_grid, interp_transform, [feature], crop_bounds=feature.bounds)
+
+        # only read the dem window under the box, with its own nodata as NO_DATA too
+        dem_window = get_geometry_window(dem.shape, dem.transform, [feature])
+        dem_trans = dem.window_transform(dem_window)
+        dem_masked = dem.read(1, window=dem_window, masked=True)
+        dem_masked.mask = dem_masked.mask | rasterio.features.geometry_mask(
+            [feature], out_shape=dem_masked.shape, transform=dem_trans
+        )
+        dem_masked = dem_masked.filled(NO_DATA)
+    except:
+        # no overlapping area for the raster and dem
+        return None
+
+    # match resolution and coordinates of dem to the interpolation, so the
+    # two grids line up cell for cell for the raster math
+    matching_dem = np.full(rst_masked.shape, NO_DATA, dtype=dem_masked.dtype)
+    rasterio.warp.reproject(
+        source=dem_masked,
+        destination=matching_dem,
+        src_transform=dem_trans,
+        src_crs="epsg:4326",
+        dst_transform=rst_trans,
+        dst_crs="epsg:4326",
+        dst_nodata=NO_DATA,
+        resampling=Resampling.nearest
+    )
 
     # calculate WSE depth
     wse_depth = rst_masked - matching_dem
     wse_depth = wse_depth * METERS_TO_FT
     wse_depth = wse_depth.round()
 
-    wse_memfile = MemoryFile()
-    with wse_memfile.open( 
-        height=wse_depth.shape[1],
-        width=wse_depth.shape[2],
-        count=1,
-        dtype=wse_depth.dtype,
-        compress='lzw',
-        driver="GTiff",
-        crs="epsg:4326",
-        transform=rasterio.transform.from_origin(rst_bounds[0], rst_bounds[3], GRID_SIZE, GRID_SIZE)
-    ) as wse_src:
-        # write single-band raster
-        wse_src.write(wse_depth[0], 1)
-
-    return wse_memfile
-
-def fim_to_binary(wse_memfile):
-    with wse_memfile.open() as wse_rst:
-        interp_grid = wse_rst.read(1)
+    return wse_depth, rst_trans
 
+def fim_to_binary(wse_grid):
     print("Translating to binary fim")
-    interp_grid[interp_grid > 0] = 1
-
-    # need interpolation in rasterio DatasetReader format for easy masking
-    # steps, so need to save as file or memory file because it's a
-    # numpy array right here
-    fim_memfile = MemoryFile()
-    with fim_memfile.open( 
-        height=interp_grid.shape[0],
-        width=interp_grid.shape[1],
-        count=1,
-        dtype=interp_grid.dtype,
-        compress='lzw',
-        driver="GTiff",
-        crs="epsg:4326",
-        transform=wse_rst.transform
-    ) as src:
-        # write single-band raster
-        src.write(interp_grid, 1)
-    
-    return fim_memfile 
+    # translate all > 0 depth values to 1 for wet (everything else [dry] already 0)
+    binary_grid = wse_grid.copy()
+    binary_grid[binary_grid > 0] = 1
 
-def mask_fim(input_fim, mask_geoms_by_group):
-    out_meta = {}
+    return binary_grid
 
-    for group, geoms in mask_geoms_by_group.items():
-        if not geoms: continue
+def mask_fim(wse_grid, wse_transform, tile_masks):
+    for group, tile_mask in tile_masks.items():
         print(f'... Applying {group} masks...')
-        
-        # open the latest intermediate file and mask out the next mask
-        # ... need rst in rasterio DatasetReader format, so need to save
-        # as file or memory file, because the rasterio mask function does not
-        # return out_image in a format we can directly reuse!
-        start = time()
-        with input_fim.open() as rst:
-            out_image, out_transform = rasterio.mask.mask(
-                rst, 
-                geoms, 
-                crop=(group != 'interior'), 
-                invert=(group == 'interior'), 
-                nodata=NO_DATA
-            )
-        end = time()
-        print(f'Apply single mask time: {end - start} seconds')
-
-        # update raster metadata in case it was cropped
-        # (or not filled in yet)
-        out_meta.update({
-            "driver": "GTiff",
-            "height":out_image.shape[1],
-            "width":out_image.shape[2],
-            "compress": 'lzw',
-            "crs":"epsg:4326",
-            "count":1,
-            "dtype":out_image.dtype,
-            "transform":out_transform
-        })
-        
-        input_fim = MemoryFile()
-        # write out latest intermediate mask
-        # .. needs to be written as file or memory file so we can use it as a
-        # rasterio DatasetReader for next mask
-        # xxx specify location
 
+        # interior masks take out the areas inside them, and exterior masks
+        # take out everything outside of them (cropping to their extent)
         start = time()
-        with input_fim.open(**out_meta) as src:
-            src.write(out_image[0], 1)
-        end = time()
-        print(f'Write mask output (numpy array) to memory file time: {end - start} seconds')
-
-    final_memfile = MemoryFile()
-    print(f"** Writing out final raster to MemoryFile **")
-    with final_memfile.open(**out_meta) as dest:
-        # Set every cell less than 0 to NO_DATA value
-        out_image[out_image < 0] = NO_DATA
-        dest.write(out_image[0], 1)
-
-    return final_memfile
-
-def raster_to_polygon_dataframe(input_raster_memfile, attributes):
-    gpd_polygonized_raster = gpd.GeoDataFrame()
-    with input_raster_memfile.open() as src:
-        image = src.read(1).astype('float32')
-        geoms = list(
-            {'properties': attributes, 'geometry': s} for s, v 
-            in rasterio.features.shapes(image, mask=image > 0, transform=src.transform)
+        wse_grid, wse_transform = mask_grid(
+            wse_grid,
+            wse_transform,
+            tile_mask['geoms'],
+            crop_bounds=(tile_mask['bounds'] if group != 'interior' else None),
+            invert=(group == 'interior')
         )
-        if geoms:
-            gpd_polygonized_raster  = gpd.GeoDataFrame.from_features(geoms, crs='4326')
+        end = time()
+        print(f'Apply single mask time: {end - start} seconds')
 
-    return gpd_polygonized_raster
+    # Set every cell less than 0 to NO_DATA value
+    wse_grid[wse_grid < 0] = NO_DATA
 
-def create_empty_tile(dem_memfile):
-    dem = dem_memfile.read(1)
-    dem[dem != 0] = 0
+    return wse_grid, wse_transform
 
+#
+# Writes a single-band grid out to a compressed GeoTIFF MemoryFile
+#
+def write_grid_memfile(grid, transform):
     memfile = MemoryFile()
     with memfile.open(
-        height=dem_memfile.shape[0],
-        width=dem_memfile.shape[1],
+        height=grid.shape[0],
+        width=grid.shape[1],
         count=1,
         compress='lzw',
-        dtype=dem.dtype,
+        dtype=grid.dtype,
         driver="GTiff",
         crs="epsg:4326",
-        transform=dem_memfile.transform
+        transform=transform
     ) as src:
         # write single-band raster
-        src.write(dem, 1)
-    
+        src.write(grid, 1)
+
     return memfile
 
+def raster_to_polygon_dataframe(grid, transform, attributes):
+    gpd_polygonized_raster = gpd.GeoDataFrame()
+    image = grid.astype('float32')
+    geoms = list(
+        {'properties': attributes, 'geometry': s} for s, v 
+        in rasterio.features.shapes(image, mask=image > 0, transform=transform)
+    )
+    if geoms:
+        gpd_polygonized_raster  = gpd.GeoDataFrame.from_features(geoms, crs='4326')
+
+    return gpd_polygonized_raster
+
+def create_empty_tile(dem):
+    empty_grid = dem.read(1)
+    empty_grid[empty_grid != 0] = 0
+
+    return empty_grid, dem.transform
+
 if __name__ == "__main__":
     main(json.loads(sys.argv[1]))
@@ -478,6 +478,7 @@ resource "aws_lambda_function" "viz_initialize_pipeline" {
       RASTER_OUTPUT_BUCKET         = var.fim_output_bucket
       RASTER_OUTPUT_PREFIX         = local.raster_output_prefix
       INGEST_FLOW_THRESHOLD        = local.ingest_flow_threshold
+      INGEST_BATCH_SIZE            = 12
       VIZ_DB_DATABASE              = var.viz_db_name
       VIZ_DB_HOST                  = var.viz_db_host
       VIZ_DB_USERNAME              = jsondecode(var.viz_db_user_secret_string)["username"]
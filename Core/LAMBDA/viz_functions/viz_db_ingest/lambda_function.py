@@ -1,27 +1,30 @@
 ################################################################################
-################################ Viz DB Ingest ################################# 
+################################ Viz DB Ingest #################################
 ################################################################################
 """
 This function downloads a file from S3 and ingets it into the vizprocessing RDS
-database.
+database. When the event has a list of "files" instead of a single "file", the
+files are downloaded and read concurrently and ingested with a single COPY.
 
 Args:
     event (dictionary): The event passed from the state machine.
     context (object): Automatic metadata regarding the invocation.
-    
+
 Returns:
     dictionary: The details of the file that was ingested, to be returned to the state machine.
 """
 ################################################################################
 import os
+import io
 import boto3
 import json
 import re
+import struct
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import pandas as pd
 import xarray as xr
-from io import StringIO
 from psycopg2.errors import UndefinedTable, BadCopyFileFormat, InvalidTextRepresentation
 from viz_classes import database
 from viz_lambda_shared_funcs import check_if_file_exists
@@ -29,6 +32,21 @@ from viz_lambda_shared_funcs import check_if_file_exists
 s3 = boto3.client('s3')
 s3_resource = boto3.resource('s3')
 
+# Rows per chunk written into the COPY stream, and the COPY format to use ('csv' for text COPY or 'binary')
+INGEST_CHUNK_SIZE = int(os.environ.get('INGEST_CHUNK_SIZE', 250000))
+INGEST_COPY_FORMAT = os.environ.get('INGEST_COPY_FORMAT', 'csv').lower()
+INGEST_BATCH_THREADS = int(os.environ.get('INGEST_BATCH_THREADS', 4))
+
+# Postgres binary COPY layout (see https://www.postgresql.org/docs/current/sql-copy.html#id-1.9.3.55.9.4)
+PGCOPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+PGCOPY_TRAILER = struct.pack('>h', -1)
+PGCOPY_EPOCH = np.datetime64('2000-01-01T00:00:00', 'us')
+PGCOPY_TYPES = {
+    'int2': ('>i2', 'iub'), 'int4': ('>i4', 'iub'), 'int8': ('>i8', 'iub'),
+    'float4': ('>f4', 'iubf'), 'float8': ('>f8', 'iubf'),
+    'timestamp': ('>i8', 'M'), 'timestamptz': ('>i8', 'M')
+}
+
 class MissingS3FileException(Exception):
     """ my custom exception class """
 
@@ -36,40 +54,121 @@ def lambda_handler(event, context):
 
     target_table = event['target_table']
     target_cols = event['target_cols']
-    file = event['file']
     bucket = event['bucket']
     reference_time = event['reference_time']
     keep_flows_at_or_above = event['keep_flows_at_or_above']
     reference_time_dt = datetime.strptime(reference_time, '%Y-%m-%d %H:%M:%S')
     create_table = event.get('iteration_index') == 0
-    
-    print(f"Checking existance of {file} on S3/Google Cloud/Para Nomads.")
-    download_path = check_if_file_exists(bucket, file, download=True)
-    
-    if not target_table:
-        dump_dict = {
-            "file": file,
-            "target_table": target_table,
-            "reference_time": reference_time,
-            "rows_imported": 0
-        }
-        return json.dumps(dump_dict)
-    
+    batch = 'files' in event
+    files = event['files'] if batch else [event['file']]
+
     viz_db = database(db_type="viz")
     nwm_version = 0
 
+    # Download and read the files on a thread pool (batches use a download subfolder per file, since files from
+    # different days can have the same name)
+    def read_file(index):
+        return read_ingest_file(
+            bucket, files[index], target_table, target_cols, keep_flows_at_or_above,
+            download_subfolder=f"ingest_{index}" if batch else None
+        )
+
+    with ThreadPoolExecutor(max_workers=max(1, min(INGEST_BATCH_THREADS, len(files)))) as executor:
+        file_results = list(executor.map(read_file, range(len(files))))
+    column_sets = [columns for _, columns in file_results if columns is not None]
+    rows_imported = [len(next(iter(columns.values()))) if columns else 0 for _, columns in file_results]
+
+    try:
+        if target_table and column_sets:
+            print(f"--> Preparing and Importing {', '.join(files)}")
+            try:
+                copy_columns_to_db(viz_db, target_table, column_sets)
+            except (UndefinedTable, BadCopyFileFormat, InvalidTextRepresentation):
+                if not create_table:
+                    raise
+
+                print("Error encountered. Recreating table now and retrying import...")
+                create_table_df = pd.DataFrame({column: values[:0] for column, values in column_sets[0].items()})
+                schema, table = target_table.split('.')
+                create_table_df.to_sql(con=viz_db.engine, schema=schema, name=table, index=False, if_exists='replace')
+                copy_columns_to_db(viz_db, target_table, column_sets)
+            print(f"--> Import of {sum(rows_imported)} rows Complete. Removing downloaded files and closing db connection.")
+    finally:
+        for download_path, _ in file_results:
+            if os.path.exists(download_path):
+                os.remove(download_path)
+
+    if not batch:
+        dump_dict = {
+                            "file": files[0],
+                            "target_table": target_table,
+                            "reference_time": reference_time,
+                            "rows_imported": rows_imported[0]
+                        }
+        if target_table:
+            dump_dict["nwm_version"] = nwm_version
+    else:
+        dump_dict = {
+                            "files": [{"file": file, "rows_imported": rows} for file, rows in zip(files, rows_imported)],
+                            "target_table": target_table,
+                            "reference_time": reference_time,
+                            "rows_imported": sum(rows_imported),
+                            "nwm_version": nwm_version
+                        }
+    return json.dumps(dump_dict)    # Return some info on the import
+
+###################################
+def read_ingest_file(bucket, file, target_table, target_cols, keep_flows_at_or_above, download_subfolder=None):
+    """
+        Downloads an ingest file and reads it into column arrays.
+
+        Returns:
+            download_path (str): The local path of the downloaded file.
+            columns (dict): Column name -> 1d numpy array, or None when there is no target table to ingest into.
+    """
+    print(f"Checking existance of {file} on S3/Google Cloud/Para Nomads.")
+    download_path = check_if_file_exists(bucket, file, download=True, download_subfolder=download_subfolder)
+
+    if not target_table:
+        return download_path, None
+
     if file.endswith('.nc'):
-        ds = xr.open_dataset(download_path)
+        columns = read_netcdf_columns(download_path, file, target_cols, keep_flows_at_or_above)
+    elif file.endswith('.csv'):
+        columns = read_csv_columns(download_path)
+    else:
+        print("File format not supported.")
+        exit()
+    return download_path, columns
+
+###################################
+def read_netcdf_columns(download_path, file, target_cols, keep_flows_at_or_above):
+    """
+        Reads the target columns of a NetCDF file straight into flat numpy arrays - one row per element of the
+        variables' dimensions, like xarray's to_dataframe - without building a DataFrame of every variable. When
+        streamflow is a target column, the keep_flows_at_or_above threshold is applied to the streamflow array first
+        and only the rows that pass are gathered from the other variables.
+
+        Args:
+            download_path (str): The local path of the NetCDF file.
+            file (str): The S3 key of the file, used to parse the forecast hour.
+            target_cols (list): The columns to read, in table order. All variables are read when empty.
+            keep_flows_at_or_above (float): Streamflow threshold of the rows to keep.
+
+        Returns:
+            columns (dict): Column name -> 1d numpy array, in target_cols order.
+    """
+    with xr.open_dataset(download_path) as ds:
         ds_vars = [var for var in ds.variables]
 
-        if not target_cols:
-            target_cols = ds_vars
+        target_cols = list(target_cols) if target_cols else ds_vars
 
+        scalars = {}
         try:
             if "hawaii" in file:
-                ds['forecast_hour'] = int(int(re.findall("(\d{8})/[a-z0-9_]*/.*t(\d{2})z.*[ftm](\d*)\.", file)[0][-1])/100)
+                scalars['forecast_hour'] = int(int(re.findall("(\d{8})/[a-z0-9_]*/.*t(\d{2})z.*[ftm](\d*)\.", file)[0][-1])/100)
             else:
-                ds['forecast_hour'] = int(re.findall("(\d{8})/[a-z0-9_]*/.*t(\d{2})z.*[ftm](\d*)\.", file)[0][-1])
+                scalars['forecast_hour'] = int(re.findall("(\d{8})/[a-z0-9_]*/.*t(\d{2})z.*[ftm](\d*)\.", file)[0][-1])
             if 'forecast_hour' not in target_cols:
                 target_cols.append('forecast_hour')
         except:
@@ -78,13 +177,13 @@ def lambda_handler(event, context):
         try:
             try:
                 if not isinstance(ds.NWM_version_number, str):
-                    ds['nwm_vers'] = float(ds.NWM_version_number.values[0].replace("v",""))
+                    scalars['nwm_vers'] = float(ds.NWM_version_number.values[0].replace("v",""))
                 else:
-                    ds['nwm_vers'] = float(ds.NWM_version_number.replace("v",""))
+                    scalars['nwm_vers'] = float(ds.NWM_version_number.replace("v",""))
             except Exception as e:
                 print(e)
                 try:
-                    ds['nwm_vers'] = float(ds.model_version.replace("NWM ",""))
+                    scalars['nwm_vers'] = float(ds.model_version.replace("NWM ",""))
                 except:
                     raise
             if 'nwm_vers' not in target_cols:
@@ -92,56 +191,161 @@ def lambda_handler(event, context):
         except:
             print("NWM_version_number property is not available in the netcdf file")
 
-        drop_vars = [var for var in ds_vars if var not in target_cols]
-        df = ds.to_dataframe().reset_index()
-        df = df.drop(columns=drop_vars)
-        ds.close()
-        if 'streamflow' in target_cols:
-            df = df.loc[df['streamflow'] >= keep_flows_at_or_above].round({'streamflow': 2}).copy()  # noqa
-        df = df[target_cols]
+        missing_cols = [col for col in target_cols if col not in scalars and col not in ds.variables]
+        if missing_cols:
+            raise KeyError(f"{missing_cols} not found in {file}")
 
-    elif file.endswith('.csv'):
-        df = pd.read_csv(download_path)
-        for column in df:  # Replace any 'None' strings with nulls
-            df[column].replace('None', np.nan, inplace=True)
-        df = df.copy()
-    else:
-        print("File format not supported.")
-        exit()
+        variables = {col: ds[col] for col in target_cols if col not in scalars}
+        dims = [dim for dim in ds.dims if any(dim in variable.dims for variable in variables.values())]
+        shape = tuple(ds.sizes[dim] for dim in dims)
 
-    print(f"--> Preparing and Importing {file}")
-    f = StringIO()  # Use StringIO to store the temporary text file in memory (faster than on disk)
-    df.to_csv(f, sep='\t', index=False, header=False)
-    f.seek(0)
-    try:
-        connection = viz_db.get_db_connection()
-        with connection:
-            with connection.cursor() as cur:
-                cur.copy_expert(f"COPY {target_table} FROM STDIN WITH DELIMITER E'\t' null as ''", f)
-        connection.close()
-    except (UndefinedTable, BadCopyFileFormat, InvalidTextRepresentation):
-        if not create_table:
-            raise
-
-        print("Error encountered. Recreating table now and retrying import...")
-        create_table_df = df.head(0)
-        schema, table = target_table.split('.')
-        create_table_df.to_sql(con=viz_db.engine, schema=schema, name=table, index=False, if_exists='replace')
+        # Flat indexes of the rows to keep, in the row-major order of the dims
+        if 'streamflow' in variables:
+            streamflow = variables['streamflow']
+            flows = streamflow.transpose(*[dim for dim in dims if dim in streamflow.dims]).values.reshape([ds.sizes[dim] if dim in streamflow.dims else 1 for dim in dims])
+            rows = np.flatnonzero(np.broadcast_to(flows >= keep_flows_at_or_above, shape))
+        else:
+            rows = np.arange(int(np.prod(shape)))
+        dim_indexes = dict(zip(dims, np.unravel_index(rows, shape))) if dims else {}
+
+        columns = {}
+        for col in target_cols:
+            if col in scalars:
+                columns[col] = np.full(len(rows), scalars[col])
+                continue
+
+            variable = variables[col]
+            values = variable.values
+            if variable.dims:
+                values = values[tuple(dim_indexes[dim] for dim in variable.dims)]
+            else:
+                values = np.full(len(rows), values)
+            if col == 'streamflow':
+                values = np.round(values, 2)
+            columns[col] = values
+
+    return columns
+
+###################################
+def read_csv_columns(download_path):
+    df = pd.read_csv(download_path)
+    for column in df:  # Replace any 'None' strings with nulls
+        df[column].replace('None', np.nan, inplace=True)
+    return {column: df[column].to_numpy() for column in df}
+
+###################################
+def copy_columns_to_db(viz_db, target_table, column_sets, connection=None):
+    """
+        COPYs sets of column arrays (e.g. one per file) into an existing table, streaming the rows into a single COPY
+        statement INGEST_CHUNK_SIZE rows at a time. Uses binary COPY when INGEST_COPY_FORMAT is 'binary' and every
+        column can be written in the table's binary format (numeric and timestamp columns with no nulls), and text COPY
+        otherwise.
+
+        Args:
+            viz_db (database): The viz database.
+            target_table (str): The schema qualified table to COPY into. Columns are matched by position.
+            column_sets (list): Dicts of column name -> 1d numpy array, in table column order.
+            connection (psycopg2 connection): An open connection to COPY on. The COPY is part of the connection's
+                current transaction and is not committed here. Opens (and commits / closes) its own when not provided.
+    """
+    if any(list(columns) != list(column_sets[0]) for columns in column_sets):
+        raise ValueError(f"Files being ingested into {target_table} have different columns: {[list(columns) for columns in column_sets]}")
+
+    if connection is None:
         connection = viz_db.get_db_connection()
-        with connection:
-            with connection.cursor() as cur:
-                f.seek(0)
-                cur.copy_expert(f"COPY {target_table} FROM STDIN WITH DELIMITER E'\t' null as ''", f)
-        connection.close()
-
-    print(f"--> Import of {len(df)} rows Complete. Removing {download_path} and closing db connection.")
-    os.remove(download_path)
-
-    dump_dict = {
-                        "file": file,
-                        "target_table": target_table,
-                        "reference_time": reference_time,
-                        "rows_imported": len(df),
-                        "nwm_version": nwm_version
-                    }
-    return json.dumps(dump_dict)    # Return some info on the import
+        try:
+            with connection:
+                copy_columns_to_db(viz_db, target_table, column_sets, connection=connection)
+        finally:
+            connection.close()
+        return
+
+    with connection.cursor() as cur:
+        binary_types = get_binary_copy_types(cur, target_table, column_sets) if INGEST_COPY_FORMAT == 'binary' else None
+        if binary_types:
+            copy_stream = CopyStream(iter_binary_copy_chunks(column_sets, binary_types))
+            cur.copy_expert(f"COPY {target_table} FROM STDIN WITH (FORMAT binary)", copy_stream)
+        else:
+            copy_stream = CopyStream(iter_text_copy_chunks(column_sets))
+            cur.copy_expert(f"COPY {target_table} FROM STDIN WITH DELIMITER E'\t' null as ''", copy_stream)
+
+###################################
+def iter_column_chunks(column_sets, chunk_size=INGEST_CHUNK_SIZE):
+    for columns in column_sets:
+        n_rows = len(next(iter(columns.values()))) if columns else 0
+        for start in range(0, n_rows, chunk_size):
+            yield {column: values[start:start+chunk_size] for column, values in columns.items()}
+
+###################################
+def iter_text_copy_chunks(column_sets, chunk_size=INGEST_CHUNK_SIZE):
+    for chunk in iter_column_chunks(column_sets, chunk_size):
+        yield pd.DataFrame(chunk).to_csv(sep='\t', index=False, header=False).encode()
+
+###################################
+def get_binary_copy_types(cur, target_table, column_sets):
+    """
+        Returns the postgres type of each table column if all of the columns can be written with binary COPY, or
+        None if any can't (missing table, column count mismatch, text / unsupported types, nulls or out of range values).
+    """
+    schema, table = target_table.split('.')
+    cur.execute("""
+        SELECT udt_name FROM information_schema.columns
+        WHERE table_schema = %s AND table_name = %s
+        ORDER BY ordinal_position
+    """, (schema, table))
+    pg_types = [row[0] for row in cur.fetchall()]
+
+    for columns in column_sets:
+        if len(pg_types) != len(columns):
+            return None
+        for pg_type, values in zip(pg_types, columns.values()):
+            if pg_type not in PGCOPY_TYPES or values.dtype.kind not in PGCOPY_TYPES[pg_type][1]:
+                return None
+            if values.dtype.kind in 'fM' and np.isnan(values).any():
+                return None
+            if pg_type.startswith('int') and len(values):
+                type_info = np.iinfo(PGCOPY_TYPES[pg_type][0])
+                if values.min() < type_info.min or values.max() > type_info.max:
+                    return None
+    return pg_types
+
+###################################
+def iter_binary_copy_chunks(column_sets, pg_types, chunk_size=INGEST_CHUNK_SIZE):
+    """ Yields a binary COPY stream of the column sets, packing each chunk of rows with a numpy structured array. """
+    fields = [('field_count', '>i2')]
+    for i, pg_type in enumerate(pg_types):
+        fields += [(f'length_{i}', '>i4'), (f'value_{i}', PGCOPY_TYPES[pg_type][0])]
+    row_dtype = np.dtype(fields)
+
+    yield PGCOPY_HEADER
+    for columns in iter_column_chunks(column_sets, chunk_size):
+        chunk = np.empty(len(next(iter(columns.values()))), dtype=row_dtype)
+        chunk['field_count'] = len(pg_types)
+        for i, values in enumerate(columns.values()):
+            if values.dtype.kind == 'M':
+                values = (values.astype('datetime64[us]') - PGCOPY_EPOCH).astype('int64')
+            chunk[f'length_{i}'] = row_dtype[f'value_{i}'].itemsize
+            chunk[f'value_{i}'] = values
+        yield chunk.tobytes()
+    yield PGCOPY_TRAILER
+
+###################################
+class CopyStream(io.RawIOBase):
+    """ Read-only file object over an iterator of bytes chunks, so that psycopg2's copy_expert can stream them. """
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = memoryview(b'')
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not len(self._buffer):
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return 0
+            self._buffer = memoryview(chunk)
+        size = min(len(b), len(self._buffer))
+        b[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
@@ -1,7 +1,19 @@
-CREATE INDEX IF NOT EXISTS {index_name} ON {target_table} {index_columns};
+--> Add the reference time column back. Its default is the reference time of this run, so that every row gets it
+--> without updating (and rewriting) the table. Only a table that was loaded with its own reference_time is updated.
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 
+    FROM information_schema.columns
+    WHERE table_schema = '{target_schema}' AND table_name = '{target_table_only}' AND column_name='reference_time') THEN
+        UPDATE {target_table} SET reference_time = '1900-01-01 00:00:00 UTC' WHERE reference_time != '1900-01-01 00:00:00 UTC';
+    ELSE
+        ALTER TABLE {target_table} ADD COLUMN reference_time TEXT DEFAULT '1900-01-01 00:00:00 UTC';
+    END IF;
+END $$;
 
-ALTER TABLE {target_table} ADD COLUMN IF NOT EXISTS reference_time TEXT DEFAULT '1900-01-01 00:00:00 UTC';
-UPDATE {target_table} SET reference_time = '1900-01-01 00:00:00 UTC' WHERE reference_time != '1900-01-01 00:00:00 UTC';
+--> Build the index once, now that the table is loaded
+CREATE INDEX IF NOT EXISTS {index_name} ON {target_table} {index_columns};
+ANALYZE {target_table};
 
 -- Checks to see if feature_id is a column in the target table
 SELECT EXISTS (SELECT 1 
@@ -1,11 +1,11 @@
---> Drop target table index (if exists)
-DROP INDEX IF EXISTS {target_schema}.{index_name};
+--> Build a fresh table to ingest into, with the columns of the target table minus reference_time (which isn't in the
+--> ingest files and is added back by ingest_finish). It has no index until ingest_finish, so that the COPYs into it
+--> don't maintain an index row by row.
+DROP TABLE IF EXISTS {target_table}_ingest;
+CREATE TABLE {target_table}_ingest (LIKE {target_table} INCLUDING DEFAULTS);
+ALTER TABLE {target_table}_ingest DROP COLUMN IF EXISTS reference_time;
 
---> Truncate target table
-TRUNCATE TABLE {target_table};
-
---> Remove reference time column
-ALTER TABLE {target_table} DROP COLUMN IF EXISTS reference_time;
-ALTER TABLE {target_table} RENAME TO {target_table_only}_stage;
-SELECT * INTO {target_table} FROM {target_table}_stage;
-DROP TABLE {target_table}_stage;
\ No newline at end of file
+--> Swap it in for the target table (and its index). Dropping the old table rather than truncating and rebuilding it
+--> leaves nothing behind to vacuum.
+DROP TABLE {target_table};
+ALTER TABLE {target_table}_ingest RENAME TO {target_table_only};
\ No newline at end of file
@@ -18,13 +18,23 @@ SELECT
     'Cached' AS prc_method
 FROM {db_fim_table}_flows AS fs
 JOIN handfim_cache.hydrotable_cached_max AS cfm ON fs.hand_id = cfm.hand_id
-JOIN handfim_cache.hydrotable_cached AS cf ON fs.hand_id = cf.hand_id
-WHERE fs.prc_status = 'Pending' 
-    AND (
-        (fs.discharge_cfs <= cf.rc_discharge_cfs AND fs.discharge_cfs > cf.rc_previous_discharge_cfs)
-		OR 
-        ((fs.discharge_cfs >= cfm.max_rc_discharge_cfs) AND rc_stage_ft = 83)
-    );
+-- The rating curve step whose (rc_previous_discharge_cfs, rc_discharge_cfs] range holds the forecast is a probe of the
+-- (hand_id, rc_discharge_range) GiST index, plus the stage 83 step for forecasts above the top of the rating curve
+-- (unless that step already matched)
+JOIN LATERAL (
+    SELECT hc.rc_discharge_cfs, hc.rc_previous_discharge_cfs, hc.rc_stage_ft, hc.rc_previous_stage_ft
+    FROM handfim_cache.hydrotable_cached AS hc
+    WHERE hc.hand_id = fs.hand_id
+        AND hc.rc_discharge_range @> fs.discharge_cfs::numeric
+    UNION ALL
+    SELECT hc.rc_discharge_cfs, hc.rc_previous_discharge_cfs, hc.rc_stage_ft, hc.rc_previous_stage_ft
+    FROM handfim_cache.hydrotable_cached AS hc
+    WHERE hc.hand_id = fs.hand_id
+        AND hc.rc_stage_ft = 83
+        AND fs.discharge_cfs >= cfm.max_rc_discharge_cfs
+        AND NOT hc.rc_discharge_range @> fs.discharge_cfs::numeric
+) AS cf ON TRUE
+WHERE fs.prc_status = 'Pending';
 
 INSERT INTO {db_fim_table}_geo (hand_id, rc_stage_ft, geom)
 SELECT fim.hand_id, fim.rc_stage_ft, geom
@@ -1,6 +1,7 @@
 -- This template is designed to add freshly processed FIM polygons (which don't already exist in the cache) in the current FIM run back into to the cached hand tables.
--- To ensure that no duplicates are added to the cache (which could be possible if multiple fim configurations are running at the same time), this query joins to the target table and ensures that
--- the current hydrotable record doesn't alraedy exist in the cache.
+-- To ensure that no duplicates are added to the cache (which could be possible if multiple fim configurations are running at the same time), the inserts skip
+-- any record that conflicts with the unique hand_id / (hand_id, rc_stage_ft) indexes or the discharge range exclusion constraint of the cache tables
+-- (see Core/Manual_Workflows/db_updates/hydrotable_cached_ranges.sql), rather than anti-joining the whole cache.
 
 -- 1. Add unique hand_id records to the hydrotable_cached_max table
 INSERT INTO handfim_cache.hydrotable_cached_max(hand_id, model_version, max_rc_discharge_cfs, max_rc_stage_ft)
@@ -10,9 +11,8 @@ SELECT DISTINCT
     fim.max_rc_discharge_cfs,
     fim.max_rc_stage_ft
 FROM {db_fim_table} AS fim
-LEFT OUTER JOIN handfim_cache.hydrotable_cached_max AS hcm ON fim.hand_id = hcm.hand_id
-WHERE fim.prc_method = 'HAND_Processing' 
-    AND hcm.hand_id IS NULL;
+WHERE fim.prc_method = 'HAND_Processing'
+ON CONFLICT DO NOTHING;
 
 -- 2. Add records for each stage_ft step of the hydrotable to the hydrotable_cached table
 INSERT INTO handfim_cache.hydrotable_cached (hand_id, rc_discharge_cfs, rc_previous_discharge_cfs, rc_stage_ft, rc_previous_stage_ft)
@@ -23,9 +23,8 @@ SELECT
     fim.rc_stage_ft,
     fim.rc_previous_stage_ft
 FROM {db_fim_table} AS fim
-LEFT OUTER JOIN handfim_cache.hydrotable_cached AS hc ON fim.hand_id = hc.hand_id AND fim.rc_stage_ft = hc.rc_stage_ft
-WHERE fim.prc_method = 'HAND_Processing' AND
-hc.rc_stage_ft IS NULL;
+WHERE fim.prc_method = 'HAND_Processing'
+ON CONFLICT DO NOTHING;
 
 -- 3a. Remove invalid geometries
 DELETE FROM {db_fim_table}_geo
@@ -49,6 +48,5 @@ SELECT
     fim.rc_discharge_cms,
     fim.note
 FROM {db_fim_table}_zero_stage AS fim
-LEFT OUTER JOIN handfim_cache.hydrotable_cached_zero_stage AS hczs ON fim.hand_id = hczs.hand_id
-WHERE hczs.rc_discharge_cms IS NULL
-AND fim.rc_discharge_cms IS NOT NULL;
\ No newline at end of file
+WHERE fim.rc_discharge_cms IS NOT NULL
+ON CONFLICT DO NOTHING;
\ No newline at end of file
@@ -505,11 +505,19 @@ class configuration:
                 bucket=os.environ['PYTHON_PREPROCESSING_BUCKET']
             else:
                 bucket = self.input_bucket
+
+            # Groups of files that the db ingest lambda ingests together in one invocation (with a single COPY)
+            ingest_batch_size = int(os.environ.get('INGEST_BATCH_SIZE', 12))
+            ingest_batches = [
+                target_table_metadata["s3_keys"][i:i+ingest_batch_size]
+                for i in range(0, len(target_table_metadata["s3_keys"]), ingest_batch_size)
+            ]
             
             ingest_sets.append({
                 "target_table": target_table, 
                 "target_cols": target_table_metadata["target_cols"],
                 "ingest_datasets": target_table_metadata["s3_keys"], 
+                "ingest_batches": ingest_batches,
                 "index_columns": target_keys,
                 "index_name": index_name,
                 "bucket": bucket,
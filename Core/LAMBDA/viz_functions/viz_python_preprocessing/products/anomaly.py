@@ -3,7 +3,10 @@ import pandas as pd
 import xarray as xr
 import tempfile
 import boto3
+import hashlib
+import io
 import os
+from botocore.exceptions import ClientError
 from viz_lambda_shared_funcs import check_if_file_exists
 
 INSUFFICIENT_DATA_ERROR_CODE = -9998
@@ -20,114 +23,61 @@ PERCENTILE_14_TABLE_75TH = "viz_authoritative_data/derived_data/nwm_v21_14_day_a
 PERCENTILE_14_TABLE_90TH = "viz_authoritative_data/derived_data/nwm_v21_14_day_average_percentiles/final_14day_all_90th_perc.nc"
 PERCENTILE_14_TABLE_95TH = "viz_authoritative_data/derived_data/nwm_v21_14_day_average_percentiles/final_14day_all_95th_perc.nc"
 
+# Packed (day_of_year, feature_id, percentile) stores of the percentile tables above, built by
+# Manual_Workflows/helper_functions/build_anomaly_percentile_store.py. Only the reference day's slice is read from S3.
+PERCENTILE_STORE = "viz_authoritative_data/derived_data/nwm_v21_7_day_average_percentiles/final_7day_percentiles_by_day.npy"
+PERCENTILE_STORE_FEATURE_IDS = "viz_authoritative_data/derived_data/nwm_v21_7_day_average_percentiles/final_7day_percentiles_feature_ids.npy"
+PERCENTILE_14_STORE = "viz_authoritative_data/derived_data/nwm_v21_14_day_average_percentiles/final_14day_percentiles_by_day.npy"
+PERCENTILE_14_STORE_FEATURE_IDS = "viz_authoritative_data/derived_data/nwm_v21_14_day_average_percentiles/final_14day_percentiles_feature_ids.npy"
+PERCENTILES = [5, 10, 25, 75, 90, 95]
+# Running streamflow sums of the files in the last anomaly window, so that each run only reads the files that entered
+# or left the window since the previous run
+ANOMALY_STATE = "viz_ingest/anomaly_state/ana_{anomaly_config}day_anomaly_state.npz"
+ANOMALY_CATEGORIES = [
+    "Low (<= 5th)",
+    "Much Below Normal (6th - 10th)",
+    "Below Normal (11th - 25th))",
+    "Normal (26th - 75th)",
+    "Above Normal (76th - 90th)",
+    "Much Above Normal (91st - 95th)",
+    "High (> 95th)"
+]
+
 def run_anomaly(reference_time, fileset_bucket, fileset, output_file_bucket, output_file, auth_data_bucket, anomaly_config=7):
     average_flow_col = f'average_flow_{anomaly_config}day'
     anom_col = f'anom_cat_{anomaly_config}day'
     
-    ##### Data Prep #####
-    if anomaly_config == 7:
-        download_subfolder = "7_day"
-        percentile_5 = check_if_file_exists(auth_data_bucket, PERCENTILE_TABLE_5TH, download=True, download_subfolder=download_subfolder)
-        percentile_10 = check_if_file_exists(auth_data_bucket, PERCENTILE_TABLE_10TH, download=True, download_subfolder=download_subfolder)
-        percentile_25 = check_if_file_exists(auth_data_bucket, PERCENTILE_TABLE_25TH, download=True, download_subfolder=download_subfolder)
-        percentile_75 = check_if_file_exists(auth_data_bucket, PERCENTILE_TABLE_75TH, download=True, download_subfolder=download_subfolder)
-        percentile_90 = check_if_file_exists(auth_data_bucket, PERCENTILE_TABLE_90TH, download=True, download_subfolder=download_subfolder)
-        percentile_95 = check_if_file_exists(auth_data_bucket, PERCENTILE_TABLE_95TH, download=True, download_subfolder=download_subfolder)
-    elif anomaly_config == 14:
-        download_subfolder = "14_day"
-        percentile_5 = check_if_file_exists(auth_data_bucket, PERCENTILE_14_TABLE_5TH, download=True, download_subfolder=download_subfolder)
-        percentile_10 = check_if_file_exists(auth_data_bucket, PERCENTILE_14_TABLE_10TH, download=True, download_subfolder=download_subfolder)
-        percentile_25 = check_if_file_exists(auth_data_bucket, PERCENTILE_14_TABLE_25TH, download=True, download_subfolder=download_subfolder)
-        percentile_75 = check_if_file_exists(auth_data_bucket, PERCENTILE_14_TABLE_75TH, download=True, download_subfolder=download_subfolder)
-        percentile_90 = check_if_file_exists(auth_data_bucket, PERCENTILE_14_TABLE_90TH, download=True, download_subfolder=download_subfolder)
-        percentile_95 = check_if_file_exists(auth_data_bucket, PERCENTILE_14_TABLE_95TH, download=True, download_subfolder=download_subfolder)
-    else:
+    if anomaly_config not in (7, 14):
         raise Exception("Anomaly config must be 7 or 14 for the appropriate percentile files")
     
-    #Get NWM version from first file
-    first_file_path = check_if_file_exists(fileset_bucket, fileset[0], download=True, download_subfolder=reference_time.strftime('%Y%m%d'))
-    with xr.open_dataset(first_file_path) as first_file:
-        nwm_vers = first_file.NWM_version_number.replace("v","")
-    os.remove(first_file_path)
-    
-    # Loop through filepaths, download file, and import data into pandas - we have to delete files as we go on anomaly, or else the lambda storage will fill up.
-    print("-->Looping through files to get streamflow sum")
-    df = pd.DataFrame()
-    for file in fileset:
-        download_path = check_if_file_exists(fileset_bucket, file, download=True, download_subfolder=reference_time.strftime('%Y%m%d'))
-        
-        with xr.open_dataset(download_path) as ds_file:
-            df_file = ds_file['streamflow'].to_dataframe()
-            df_file['streamflow']  = df_file['streamflow'] * 35.3147  # convert streamflow from cms to cfs
-    
-            if df.empty:
-                df = df_file
-                df = df.rename(columns={"streamflow": "streamflow_sum"})
-            else:
-                df['streamflow_sum'] += df_file['streamflow']
-        os.remove(download_path)
+    # Get the streamflow sums of the files in the window - we have to delete files as we go on anomaly, or else the lambda storage will fill up.
+    print("-->Getting streamflow sums")
+    state = update_anomaly_state(
+        fileset_bucket, fileset, output_file_bucket, ANOMALY_STATE.format(anomaly_config=anomaly_config),
+        download_subfolder=reference_time.strftime('%Y%m%d')
+    )
+    nwm_vers = state['versions'][0]  # NWM version of the first file
 
-    df[average_flow_col] = df['streamflow_sum'] / len(fileset)
-    df = df.drop(columns=['streamflow_sum'])
+    average_flows = (state['sums'] * state['scale_factor'] / len(fileset) + state['add_offset']) * 35.3147  # convert streamflow from cms to cfs
+    average_flows[state['missing_counts'] > 0] = np.nan
+    df = pd.DataFrame({average_flow_col: average_flows}, index=pd.Index(state['feature_ids'], name='feature_id'))
     df[average_flow_col] = df[average_flow_col].round(2)
 
     # Import Percentile Data
     print("-->Importing percentile data:")
 
     date = int(reference_time.strftime("%j")) - 1  # retrieves the date in integer form from reference_time
+    perc_feature_ids, percentiles = get_percentiles(auth_data_bucket, anomaly_config, date)
 
-    print(f"---->Retrieving {anomaly_config} day 5th percentiles...")
-    ds_perc = xr.open_dataset(percentile_5)
-    df_perc = ds_perc.sel(time=date)['streamflow'].to_dataframe()
-    df_perc = df_perc.rename(columns={"streamflow": "prcntle_5"})
-    df_perc['prcntle_5'] = (df_perc['prcntle_5'] * 35.3147).round(2)  # convert streamflow from cms to cfs
-    df = df.join(df_perc)
-
-    print(f"---->Retrieving {anomaly_config} day 10th percentiles...")
-    ds_perc = xr.open_dataset(percentile_10)
-    df_perc = ds_perc.sel(time=date)['streamflow'].to_dataframe()
-    df_perc = df_perc.rename(columns={"streamflow": "prcntle_10"})
-    df_perc['prcntle_10'] = (df_perc['prcntle_10'] * 35.3147).round(2)  # convert streamflow from cms to cfs
-    df = df.join(df_perc)
-
-    print(f"---->Retrieving {anomaly_config} day 25th percentiles...")
-    ds_perc = xr.open_dataset(percentile_25)
-    df_perc = ds_perc.sel(time=date)['streamflow'].to_dataframe()
-    df_perc = df_perc.rename(columns={"streamflow": "prcntle_25"})
-    df_perc['prcntle_25'] = (df_perc['prcntle_25'] * 35.3147).round(2)  # convert streamflow from cms to cfs
-    df = df.join(df_perc)
-
-    print(f"---->Retrieving {anomaly_config} day 75th percentiles...")
-    ds_perc = xr.open_dataset(percentile_75)
-    df_perc = ds_perc.sel(time=date)['streamflow'].to_dataframe()
-    df_perc = df_perc.rename(columns={"streamflow": "prcntle_75"})
-    df_perc['prcntle_75'] = (df_perc['prcntle_75'] * 35.3147).round(2)  # convert streamflow from cms to cfs
-    df = df.join(df_perc)
-
-    print(f"---->Retrieving {anomaly_config} day 90th percentiles...")
-    ds_perc = xr.open_dataset(percentile_90)
-    df_perc = ds_perc.sel(time=date)['streamflow'].to_dataframe()
-    df_perc = df_perc.rename(columns={"streamflow": "prcntle_90"})
-    df_perc['prcntle_90'] = (df_perc['prcntle_90'] * 35.3147).round(2)  # convert streamflow from cms to cfs
-    df = df.join(df_perc)
-
-    print(f"---->Retrieving {anomaly_config} day 95th percentiles...")
-    ds_perc = xr.open_dataset(percentile_95)
-    df_perc = ds_perc.sel(time=date)['streamflow'].to_dataframe()
-    df_perc = df_perc.rename(columns={"streamflow": "prcntle_95"})
-    df_perc['prcntle_95'] = (df_perc['prcntle_95'] * 35.3147).round(2)  # convert streamflow from cms to cfs
-    df = df.join(df_perc)
+    # Line the percentiles up with the streamflow features (features without percentiles get NaNs)
+    positions = pd.Index(perc_feature_ids).get_indexer(df.index)
+    percentiles = (percentiles[positions] * 35.3147).round(2)  # convert streamflow from cms to cfs
+    percentiles[positions == -1] = np.nan
+    for i, percentile in enumerate(PERCENTILES):
+        df[f'prcntle_{percentile}'] = percentiles[:, i]
 
     print("---->Creating percentile dictionary...")
-    df[anom_col] = np.nan
-    df.loc[(df[average_flow_col] >= df['prcntle_95']) & df[anom_col].isna(), anom_col] = "High (> 95th)"
-    df.loc[(df[average_flow_col] >= df['prcntle_90']) & df[anom_col].isna(), anom_col] = "Much Above Normal (91st - 95th)"  # noqa: E501
-    df.loc[(df[average_flow_col] >= df['prcntle_75']) & df[anom_col].isna(), anom_col] = "Above Normal (76th - 90th)"
-    df.loc[(df[average_flow_col] >= df['prcntle_25']) & df[anom_col].isna(), anom_col] = "Normal (26th - 75th)"
-    df.loc[(df[average_flow_col] >= df['prcntle_10']) & df[anom_col].isna(), anom_col] = "Below Normal (11th - 25th))"
-    df.loc[(df[average_flow_col] >= df['prcntle_5']) & df[anom_col].isna(), anom_col] = "Much Below Normal (6th - 10th)"
-    df.loc[(df[average_flow_col] < df['prcntle_5']) & df[anom_col].isna(), anom_col] = "Low (<= 5th)"
-    df.loc[df[anom_col].isna(), anom_col] = "Insufficient Data Available"
+    df[anom_col] = classify_anomaly(df[average_flow_col].to_numpy(), percentiles)
     df = df.replace(round(INSUFFICIENT_DATA_ERROR_CODE * 35.3147, 2), None)
     df['nwm_vers'] = nwm_vers
 
@@ -139,4 +89,238 @@ def run_anomaly(reference_time, fileset_bucket, fileset, output_file_bucket, out
     df.to_csv(tmp_ouput_path, index=False)
     s3.upload_file(tmp_ouput_path, output_file_bucket, output_file)
     print(f"--- Uploaded to {output_file_bucket}:{output_file}")
-    os.remove(tmp_ouput_path)
\ No newline at end of file
+    os.remove(tmp_ouput_path)
+
+def get_percentiles(auth_data_bucket, anomaly_config, day):
+    """
+        Gets the 5th - 95th percentile flows of every feature for a day of the year, from the packed percentile store
+        if it has been built, otherwise from the percentile NetCDF tables.
+        Args:
+            auth_data_bucket (str): S3 bucket of the authoritative data
+            anomaly_config (int): 7 or 14 (day average)
+            day (int): Zero based day of the year
+        Returns:
+            feature_ids (numpy array): The feature ids of the percentile rows
+            percentiles (numpy array): (feature, percentile) array of the percentile flows (cms), in PERCENTILES order
+    """
+    store_key, feature_ids_key = {
+        7: (PERCENTILE_STORE, PERCENTILE_STORE_FEATURE_IDS),
+        14: (PERCENTILE_14_STORE, PERCENTILE_14_STORE_FEATURE_IDS)
+    }[anomaly_config]
+
+    try:
+        percentiles = read_npy_rows(auth_data_bucket, store_key, day)
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ['NoSuchKey', '404']:
+            raise
+        print(f"---->{store_key} does not exist. Reading the percentile NetCDF files.")
+        return get_percentiles_from_netcdf(auth_data_bucket, anomaly_config, day)
+
+    s3 = boto3.client('s3')
+    feature_ids = np.load(io.BytesIO(s3.get_object(Bucket=auth_data_bucket, Key=feature_ids_key)['Body'].read()))
+    return feature_ids, percentiles
+
+
+def read_npy_rows(bucket, key, index):
+    """
+        Reads one slice along the first axis of an .npy file on S3 with range requests (the header, then the
+        slice), without downloading the rest of the file.
+    """
+    s3 = boto3.client('s3')
+    header = io.BytesIO(s3.get_object(Bucket=bucket, Key=key, Range="bytes=0-4095")['Body'].read())
+    version = np.lib.format.read_magic(header)
+    if version == (1, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(header)
+    else:
+        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(header)
+    if fortran_order or not 0 <= index < shape[0]:
+        raise ValueError(f"Can't read slice {index} of {key} (shape {shape}, fortran_order {fortran_order})")
+
+    slice_nbytes = int(np.prod(shape[1:])) * dtype.itemsize
+    start = header.tell() + index * slice_nbytes
+    body = s3.get_object(Bucket=bucket, Key=key, Range=f"bytes={start}-{start + slice_nbytes - 1}")['Body'].read()
+    return np.frombuffer(body, dtype=dtype).reshape(shape[1:])
+
+
+def get_percentiles_from_netcdf(auth_data_bucket, anomaly_config, day):
+    if anomaly_config == 7:
+        download_subfolder = "7_day"
+        percentile_tables = [PERCENTILE_TABLE_5TH, PERCENTILE_TABLE_10TH, PERCENTILE_TABLE_25TH, PERCENTILE_TABLE_75TH, PERCENTILE_TABLE_90TH, PERCENTILE_TABLE_95TH]
+    else:
+        download_subfolder = "14_day"
+        percentile_tables = [PERCENTILE_14_TABLE_5TH, PERCENTILE_14_TABLE_10TH, PERCENTILE_14_TABLE_25TH, PERCENTILE_14_TABLE_75TH, PERCENTILE_14_TABLE_90TH, PERCENTILE_14_TABLE_95TH]
+
+    feature_ids = None
+    percentiles = []
+    for percentile, percentile_table in zip(PERCENTILES, percentile_tables):
+        print(f"---->Retrieving {anomaly_config} day {percentile}th percentiles...")
+        percentile_file = check_if_file_exists(auth_data_bucket, percentile_table, download=True, download_subfolder=download_subfolder)
+        with xr.open_dataset(percentile_file) as ds_perc:
+            streamflow = ds_perc.sel(time=day)['streamflow']
+            if feature_ids is None:
+                feature_ids = streamflow['feature_id'].values
+                percentiles.append(streamflow.values)
+            else:
+                percentiles.append(streamflow.to_series().reindex(feature_ids).values)
+    return feature_ids, np.stack(percentiles, axis=1)
+
+
+def classify_anomaly(average_flows, percentiles):
+    """
+        Classifies average flows into the ANOMALY_CATEGORIES by the highest percentile they are at or above (Low if
+        below the 5th, Insufficient Data Available if the flow or percentiles are missing).
+        Args:
+            average_flows (numpy array): The average flow of each feature
+            percentiles (numpy array): (feature, percentile) array of the feature percentiles, in PERCENTILES order
+        Returns:
+            categories (numpy array): The anomaly category of each feature
+    """
+    at_or_above = average_flows[:, None] >= percentiles
+    category_index = np.where(
+        at_or_above.any(axis=1),
+        len(PERCENTILES) - np.argmax(at_or_above[:, ::-1], axis=1),
+        np.where(average_flows < percentiles[:, 0], 0, -1)
+    )
+    categories = np.array(ANOMALY_CATEGORIES + ["Insufficient Data Available"], dtype=object)
+    return categories[category_index]
+
+
+def update_anomaly_state(fileset_bucket, fileset, state_bucket, state_key, download_subfolder=None):
+    """
+        Gets the per-feature streamflow sums of the files in an anomaly window from the running sum state of the
+        previous run, reading only the files that entered or left the window since then, and saves the updated state.
+        The sums are kept in the files' raw (packed integer) streamflow values, so adding and removing files is exact.
+        The state is rebuilt from all of the files in the window when it is missing, fails its checksum, doesn't
+        match the files, or when rebuilding would read fewer files than updating.
+        Args:
+            fileset_bucket (str): S3 bucket of the NWM files
+            fileset (list): The files in the anomaly window
+            state_bucket (str): S3 bucket of the state
+            state_key (str): S3 key of the state
+            download_subfolder (str): /tmp subfolder to download the files into
+        Returns:
+            state (dict): files, versions (NWM version of each file), feature_ids, sums, missing_counts, scale_factor,
+                          and add_offset
+    """
+    state = load_anomaly_state(state_bucket, state_key)
+    state_files = list(state['files']) if state else []
+    files_to_add = [file for file in fileset if file not in state_files]
+    files_to_remove = [file for file in state_files if file not in fileset]
+
+    if state and len(files_to_add) + len(files_to_remove) < len(fileset):
+        print(f"---->Updating the {state_key} running sums with {len(files_to_add)} new and {len(files_to_remove)} expired files")
+        try:
+            state = update_anomaly_state_files(state, fileset_bucket, files_to_add, files_to_remove, download_subfolder)
+        except AnomalyStateMismatch as e:
+            print(f"---->{e}. Rebuilding {state_key}.")
+            state = None
+    elif state:
+        print(f"---->{state_key} is too far out of date to update. Rebuilding it.")
+        state = None
+
+    if state is None:
+        state = update_anomaly_state_files(None, fileset_bucket, fileset, [], download_subfolder)
+
+    # Keep the files in window order, so that the first file's NWM version is reported
+    order = [list(state['files']).index(file) for file in fileset]
+    state['files'] = np.array(fileset)
+    state['versions'] = state['versions'][order]
+    save_anomaly_state(state, state_bucket, state_key)
+    return state
+
+
+class AnomalyStateMismatch(Exception):
+    """ The files being added to / removed from the anomaly state don't match it. """
+
+
+def update_anomaly_state_files(state, fileset_bucket, files_to_add, files_to_remove, download_subfolder=None):
+    for sign, files in [(1, files_to_add), (-1, files_to_remove)]:
+        for file in files:
+            try:
+                download_path = check_if_file_exists(fileset_bucket, file, download=True, download_subfolder=download_subfolder)
+            except Exception:
+                if sign == 1:
+                    raise
+                raise AnomalyStateMismatch(f"Expired file {file} is no longer available")
+
+            with xr.open_dataset(download_path, mask_and_scale=False) as ds_file:
+                streamflow = ds_file['streamflow']
+                raw_values = streamflow.values
+                missing = np.zeros(raw_values.shape, dtype=bool)
+                for fill_attr in ['_FillValue', 'missing_value']:
+                    if fill_attr in streamflow.attrs:
+                        missing |= (raw_values == streamflow.attrs[fill_attr])
+                if raw_values.dtype.kind == 'f':
+                    missing |= np.isnan(raw_values)
+                values = np.where(missing, 0, raw_values).astype('int64' if raw_values.dtype.kind in 'iu' else 'float64')
+                feature_ids = ds_file['feature_id'].values
+                scale_factor = float(streamflow.attrs.get('scale_factor', 1))
+                add_offset = float(streamflow.attrs.get('add_offset', 0))
+                version = ds_file.NWM_version_number.replace("v","")
+            os.remove(download_path)
+
+            if state is None:
+                state = {
+                    'files': np.array([], dtype=str), 'versions': np.array([], dtype=str), 'feature_ids': feature_ids,
+                    'sums': np.zeros(len(feature_ids), dtype=values.dtype), 'missing_counts': np.zeros(len(feature_ids), dtype='int32'),
+                    'scale_factor': scale_factor, 'add_offset': add_offset
+                }
+            elif (
+                not np.array_equal(feature_ids, state['feature_ids']) or values.dtype != state['sums'].dtype
+                or scale_factor != state['scale_factor'] or add_offset != state['add_offset']
+            ):
+                raise AnomalyStateMismatch(f"The feature ids or streamflow encoding of {file} don't match the state")
+
+            state['sums'] += sign * values
+            state['missing_counts'] += sign * missing.astype('int32')
+            if sign == 1:
+                state['files'] = np.append(state['files'], file)
+                state['versions'] = np.append(state['versions'], version)
+            else:
+                keep = state['files'] != file
+                state['files'] = state['files'][keep]
+                state['versions'] = state['versions'][keep]
+    return state
+
+
+def get_anomaly_state_checksum(state):
+    checksum = hashlib.sha256()
+    checksum.update("\n".join(state['files']).encode())
+    checksum.update("\n".join(state['versions']).encode())
+    for array in ['feature_ids', 'sums', 'missing_counts']:
+        checksum.update(np.ascontiguousarray(state[array]).tobytes())
+    checksum.update(f"{state['scale_factor']}/{state['add_offset']}".encode())
+    return checksum.hexdigest()
+
+
+def load_anomaly_state(state_bucket, state_key):
+    s3 = boto3.client('s3')
+    try:
+        body = s3.get_object(Bucket=state_bucket, Key=state_key)['Body'].read()
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ['NoSuchKey', '404']:
+            raise
+        print(f"---->{state_key} does not exist yet.")
+        return None
+
+    try:
+        with np.load(io.BytesIO(body)) as npz:
+            state = {key: npz[key] for key in npz.files}
+        state['scale_factor'] = float(state['scale_factor'])
+        state['add_offset'] = float(state['add_offset'])
+        checksum = str(state.pop('checksum'))
+    except Exception as e:
+        print(f"---->{state_key} could not be read: {e}")
+        return None
+
+    if checksum != get_anomaly_state_checksum(state):
+        print(f"---->{state_key} failed its checksum.")
+        return None
+    return state
+
+
+def save_anomaly_state(state, state_bucket, state_key):
+    s3 = boto3.client('s3')
+    buffer = io.BytesIO()
+    np.savez(buffer, checksum=np.array(get_anomaly_state_checksum(state)), **state)
+    s3.put_object(Body=buffer.getvalue(), Bucket=state_bucket, Key=state_key)
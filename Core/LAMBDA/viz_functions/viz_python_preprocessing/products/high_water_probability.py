@@ -1,14 +1,18 @@
 import datetime as dt
 import os
-from netCDF4 import Dataset
 import xarray
 import numpy as np
 import pandas as pd
 import re
 import boto3
 import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from viz_lambda_shared_funcs import get_db_values, organize_input_files
 
+HIGH_WATER_THREADS = int(os.environ.get('HIGH_WATER_THREADS', 4))  # Number of files read at once
+CFS_FROM_CMS = 35.3147
+
 def run_high_water_probability(reference_time, fileset_bucket, fileset, output_file_bucket, output_file):
     ##### Data Prep #####
     print("Downloading NWM Data")
@@ -32,28 +36,8 @@ def run_high_water_probability(reference_time, fileset_bucket, fileset, output_f
 
     ##### Medium Range Configuration #####
     elif "medium_range" in input_files[0]:
-        df_probabilities = pd.DataFrame()
         day_windows = {'start_hour': [3, 27, 51, 75, 3], 'end_hour': [24, 48, 72, 120, 120]}
-
-        for i in range(len(day_windows['start_hour'])):
-            day_files = []
-            begin_hour = day_windows['start_hour'][i]
-            end_hour = day_windows['end_hour'][i]
-            print(f"Calculating probabilities for {begin_hour}_to_{end_hour}")
-            for file in input_files:
-                hour_pattern = re.search(r'f(\d\d\d)', file).group(1)
-                if(hour_pattern):
-                    hour = int(hour_pattern)
-                    if(hour >= begin_hour and hour <= end_hour):
-                        day_files.append(file)
-
-            probability_df = mrf_high_water_probability(day_files, df_high_water_threshold)
-            probability_df = probability_df.rename(columns={"Prob": f"hours_{begin_hour}_to_{end_hour}"})
-
-            if df_probabilities.empty:
-                df_probabilities = probability_df
-            else:
-                df_probabilities = df_probabilities.join(probability_df)
+        df_probabilities = mrf_high_water_probability(input_files, df_high_water_threshold, day_windows)
 
     ##### Format and Upload Output #####
     print("Adding high water threshold, reference time, and update time to dataframe")
@@ -97,21 +81,11 @@ def srf_high_water_probability(reference_time, lead_times, discard_threshold, nw
 
     discard_date = reference_time - dt.timedelta(hours=discard_threshold)
 
-    # return paths to all files with specified valid time
-    print("Collecting files for valid times...")
-    working_fpaths = find_nwm_file_paths(nwm_fpaths, valid_times, reference_time, discard_date)
+    # return paths to all files of the ensemble members
+    print("Collecting files for ensemble members...")
+    working_fpaths = find_nwm_file_paths(nwm_fpaths, reference_time, discard_date)
     nwm_file_count = len(working_fpaths)
-    print("Found {} files with matching valid times.".format(nwm_file_count))
-
-    # Import Feature IDs
-    print("-->Importing feature IDs...")
-    with xarray.open_dataset(working_fpaths[0]) as ds_features:
-        # Gets a dataframe of feature ids and streamflow for forecast
-        streamflow_features = ds_features['streamflow'].to_dataframe()
-
-    joined = streamflow_features.join(df_high_water_threshold)   # attaches recurrence flows to streamflow features
-    recurrence_flows_array = joined["high_water_threshold"].values  # Extract recurrence flows as array
-    featureID_list = joined.index.values  # Extract feature_ids as array
+    print("Found {} files within the ensemble window.".format(nwm_file_count))
 
     # Calculate High Flow Probabilities
     print("-->Calculating high flow probabilities...")
@@ -126,107 +100,163 @@ def srf_high_water_probability(reference_time, lead_times, discard_threshold, nw
         member = member_date.strftime("%H")
         ensemble_members.append(member)
 
-    # create a NumPy array of zeros with the same length of recurrence_flows_array; this array will be used to
-    # count up the number of streamflow files that predicted a reach would be above its high water threshold flow
-    final_above_array = np.zeros(len(recurrence_flows_array), dtype=np.int16)
+    file_windows = {}
     for member in ensemble_members:
-        ensemble_files_list = [x for x in working_fpaths if 'nwm.t{}z.short_range.channel_rt'.format(member) in x]
-        # creates a NumPy array of zeros with the same length of recurrence_flows_array;
-        # this array will be used to count up the number of streamflow files that predicted a reach would be above
-        # its high water threshold flow
-        above_array = np.zeros(len(recurrence_flows_array), dtype=np.int16)
-        for file in ensemble_files_list:
-            n = Dataset(file)
-            streamflows = n['streamflow'][:]
-            n.close()
-            streamflows = streamflows * 35.3147  # convert streamflow from cms to cfs
-            # checks to see if any streamflow values are at or above their high water threshold flow, and
-            # returns a boolean array of the results
-            true_false_array = np.greater_equal(streamflows, recurrence_flows_array)
-            # increases the above count in above_array for reaches that had streamflow values above their high water threshold
-            above_array = above_array + true_false_array
-        # set anything in final_above_array >0 to 1, so -any- instance of high water threshold gives a stream reach a 1
-        above_array = np.where(above_array >= 1, 1, 0)
-        final_above_array += above_array  # add ensemble member's 0 or 1 predictions for each stream
+        for file in [x for x in working_fpaths if 'nwm.t{}z.short_range.channel_rt'.format(member) in x]:
+            file_windows[file] = (member, [0])
+
+    # counts the number of ensemble members that predicted a reach would be above its high water threshold flow,
+    # only using the files with specified valid time
+    featureID_list, final_above_array = count_ensemble_exceedances(file_windows, df_high_water_threshold, 1, valid_times)
 
     print("Processing NWM probabilities...")
     # divides above_array by the total number of streamflow files to compute probabilities, and
     # then multiplies the results by 100 to covert them into percentages
-    probabilities = (final_above_array / ensemble_number) * 100.0
+    probabilities = (final_above_array[0] / ensemble_number) * 100.0
 
-    df_probabilities = pd.DataFrame(list(zip(featureID_list, probabilities)), columns=['feature_id', 'Prob'])
+    df_probabilities = pd.DataFrame({'feature_id': featureID_list, 'Prob': probabilities.astype(int)})
     df_probabilities = df_probabilities.set_index('feature_id')
-    df_probabilities['Prob'] = df_probabilities['Prob'].astype(int)
 
     return df_probabilities
 
 
-def mrf_high_water_probability(streamflow_files_list, high_water_values):
+def mrf_high_water_probability(streamflow_files_list, high_water_values, day_windows):
     """
     This function computes high water probabilities (%) from the 7 members of the National Water Model (NWM) medium-range
-    forecast.
+    forecast, for each of the day windows.
 
     Args:
         streamflow_files_list (list): A list of paths to the NWM channel_rt output NetCDF files for the forecast of
             interest.
+        high_water_values (DataFrame): The high water threshold flows, indexed by feature_id
+        day_windows (dict): The 'start_hour' and 'end_hour' lists of the forecast hours of each window
 
     Returns:
-        probability_array (array): An array of (Feature ID, High Water Probability (%)) pairs for the time period of
-            interest.
+        df_probabilities (DataFrame): The High Water Probability (%) of each window (hours_{start}_to_{end} columns),
+            indexed by Feature ID.
     """
+    window_names = [
+        f"hours_{begin_hour}_to_{end_hour}" for begin_hour, end_hour in zip(day_windows['start_hour'], day_windows['end_hour'])
+    ]
+
+    # finds the windows and ensemble member of each file, and the ensemble members of each window, on-the-fly
+    file_windows = {}
+    window_members = [[] for _ in window_names]
+    for file in streamflow_files_list:
+        member = int(re.search(r'channel_rt_(\d+)', file).group(1))
+        hour = int(re.search(r'f(\d\d\d)', file).group(1))
+        windows = [
+            i for i, (begin_hour, end_hour) in enumerate(zip(day_windows['start_hour'], day_windows['end_hour']))
+            if hour >= begin_hour and hour <= end_hour
+        ]
+        if not windows:
+            continue
 
-    # Import Feature IDs
-    print("--> Importing feature IDs...")
+        file_windows[file] = (member, windows)
+        for window in windows:
+            if member not in window_members[window]:
+                window_members[window].append(member)
 
-    with xarray.open_dataset(streamflow_files_list[0]) as ds_features:
-        df_features = ds_features['streamflow'].to_dataframe()  # gets a dataframe of feature ids and streamflows
-    joined = df_features.join(high_water_values)  # attaches the high water threshold flows to the streamflow features
-    high_water_flows_array = joined["high_water_threshold"].values  # extracts the high water threshold flows as an array
-    featureID_array = joined.index.values  # extracts the feature IDs as an array
+    for window_name, members in zip(window_names, window_members):
+        if not members:
+            raise ValueError(f"No medium range files were given for {window_name}")
 
     # Calculate High Water Probabilities
-    print("--> Calculating high water probabilities...")
+    print(f"--> Calculating high water probabilities for {', '.join(window_names)}...")
+    featureID_array, final_above_array = count_ensemble_exceedances(file_windows, high_water_values, len(window_names))
 
-    ensemble_members = []
-    for file in streamflow_files_list:  # finds the number of ensemble members on-the-fly
-        ensemble_pattern = re.search(r'channel_rt_(\d+)', file).group(1)
-        if(ensemble_pattern):
-            member = int(ensemble_pattern)
-            if member not in ensemble_members:
-                ensemble_members.append(member)
-
-    # creates a NumPy array of zeros with the same length of high water threshold flows_array;
-    # this array will be used to count up the number of ensemble members that predicted a reach would be
-    # above its high water threshold flow
-    final_above_array = np.zeros(len(high_water_flows_array), dtype=np.int16)
-    for member in ensemble_members:
-        ensemble_files_list = [x for x in streamflow_files_list if 'channel_rt_{}'.format(member) in x]
-        above_array = np.zeros(len(high_water_flows_array), dtype=np.int16)  # creates a NumPy array of zeros
-        for file in ensemble_files_list:
-            n = Dataset(file)
-            streamflows = n['streamflow'][:]
-            n.close()
-            streamflows = streamflows * 35.3147  # converts streamflows from cms to cfs
-            # checks to see if any streamflow values are at or above their high water threshold flow
-            # returns a boolean array of the results
-            true_false_array = np.greater_equal(streamflows, high_water_flows_array)
-            # increases the above count in above_array for reaches that had streamflow values above their high water threshold flows
-            above_array = above_array + true_false_array
-        # sets anything in final_above_array >0 to 1, so -any- instance of high water threshold gives a stream reach a 1
-        above_array = np.where(above_array >= 1, 1, 0)
-        final_above_array += above_array  # adds the ensemble member's predictions for each stream to final_above_array
-
-    # divides final_above_array by the total number of streamflow files to compute probabilities
+    # divides final_above_array by the total number of ensemble members to compute probabilities
     # then multiplies the results by 100 to covert them into percentages
-    probabilities = (final_above_array / len(ensemble_members)) * 100.0
-
-    df_probabilities = pd.DataFrame(list(zip(featureID_array, probabilities)), columns=['feature_id', 'Prob'])
+    df_probabilities = pd.DataFrame({'feature_id': featureID_array})
+    for window, window_name in enumerate(window_names):
+        probabilities = (final_above_array[window] / len(window_members[window])) * 100.0
+        df_probabilities[window_name] = probabilities.astype(int)
     df_probabilities = df_probabilities.set_index('feature_id')
-    df_probabilities['Prob'] = df_probabilities['Prob'].astype(int)
 
     return df_probabilities
 
 
+def count_ensemble_exceedances(file_windows, high_water_values, n_windows, valid_times=None, threads=HIGH_WATER_THREADS):
+    """
+    Counts the number of ensemble members that predicted each reach would be at or above its high water threshold flow
+    in any of their files of each window. Every file is read once (up to 2 x threads files ahead on a thread pool),
+    and each member's exceedances of each window are kept as a packed bitset, so all the windows are counted in a
+    single sweep of the files.
+
+    Args:
+        file_windows (dict): The (ensemble member, list of window indexes) of each file to read
+        high_water_values (DataFrame): The high water threshold flows, indexed by feature_id
+        n_windows (int): The number of windows
+        valid_times (list, optional): Only count the files with one of these model_output_valid_time values
+
+    Returns:
+        feature_ids (array): The feature IDs of the reaches, in the order of the files
+        counts (array): (window x reach) array of the number of ensemble members above the high water threshold
+    """
+    files = list(file_windows)
+
+    # Import Feature IDs, and attach the high water threshold flows to them
+    print("--> Importing feature IDs...")
+    with xarray.open_dataset(files[0]) as ds_features:
+        feature_ids = ds_features['feature_id'].values
+    high_water_flows_array = high_water_values['high_water_threshold'].reindex(feature_ids).values
+
+    member_bitsets = {}
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        pending = deque()
+        for index, file in enumerate(files):
+            pending.append((file, executor.submit(read_exceedances, file, high_water_flows_array, valid_times)))
+
+            # Fold the finished files into their members' bitsets, keeping up to 2 x threads files in flight
+            while pending and (len(pending) >= threads * 2 or index == len(files) - 1):
+                file, future = pending.popleft()
+                exceedances = future.result()
+                if exceedances is None:
+                    continue
+
+                # -any- instance of high water threshold in a member's files of a window gives the reach a 1
+                member, windows = file_windows[file]
+                for window in windows:
+                    bitset = member_bitsets.get((member, window))
+                    if bitset is None:
+                        member_bitsets[(member, window)] = exceedances.copy()
+                    else:
+                        np.bitwise_or(bitset, exceedances, out=bitset)
+
+    counts = np.zeros((n_windows, len(feature_ids)), dtype=np.int16)
+    for (member, window), bitset in member_bitsets.items():
+        counts[window] += np.unpackbits(bitset, count=len(feature_ids))  # add the member's 0 or 1 for each reach
+
+    return feature_ids, counts
+
+
+def read_exceedances(file, high_water_flows_array, valid_times=None):
+    """
+    Reads the streamflows of a NWM channel_rt file, and checks which are at or above their high water threshold flow.
+    The valid time is checked from the file header first, so the streamflows of files that are filtered out are
+    never read.
+
+    Args:
+        file (str): The path to the file
+        high_water_flows_array (array): The high water threshold flows of the file's reaches
+        valid_times (list, optional): Only read the file if its model_output_valid_time is one of these values
+
+    Returns:
+        exceedances (array): The packed bits of the reaches at or above their high water threshold flow (None if the
+            file couldn't be opened or has a different valid time)
+    """
+    try:
+        with xarray.open_dataset(file) as ds:
+            if valid_times is not None and ds.attrs.get('model_output_valid_time') not in valid_times:
+                return None
+            streamflows = ds['streamflow'].values * CFS_FROM_CMS  # convert streamflow from cms to cfs
+    except IOError:
+        print(('WARNING - File given could not be opened: {0}'.format(file)))
+        return None
+
+    return np.packbits(np.greater_equal(streamflows, high_water_flows_array))
+
+
 def calc_valid_times(reference_time, lead_times):
     valid_times = []
 
@@ -238,14 +268,15 @@ def calc_valid_times(reference_time, lead_times):
     return valid_times
 
 
-def find_nwm_file_paths(nwm_fpaths, valid_times, reference_time, discard_date):
+def find_nwm_file_paths(nwm_fpaths, reference_time, discard_date):
     """
     Determines which files are needed to support the probabilistic forecast for
-    the specified valid time.
+    the reference time. The files' valid times are checked when they are read.
 
     Args:
         nwm_fpaths(list): a list of strings, each of which is the path to a nwm file
-        valid_times(list): a list of strings, each representing a datetime
+        reference_time(datetime): the reference time
+        discard_date(datetime): files generated at or before this time are excluded
 
     Returns:
         A list of file paths.
@@ -271,12 +302,6 @@ def find_nwm_file_paths(nwm_fpaths, valid_times, reference_time, discard_date):
             print(('WARNING - File given but not found: {0}'.format(nwm_fpath)))
             continue
 
-        # check if NWM file falls in range of valid times
-        try:
-            with Dataset(nwm_fpath, 'r') as f:
-                if f.model_output_valid_time in valid_times:
-                    working_fpaths.append(nwm_fpath)
-        except IOError:
-            print(('WARNING - File given could not be opened: {0}'.format(nwm_fpath)))
+        working_fpaths.append(nwm_fpath)
 
-    return working_fpaths
\ No newline at end of file
+    return working_fpaths
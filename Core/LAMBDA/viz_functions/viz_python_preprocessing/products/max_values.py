@@ -4,10 +4,13 @@ import pandas as pd
 import numpy as np
 import boto3
 import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 from viz_lambda_shared_funcs import check_if_file_exists
 
 CACHE_DAYS = os.environ['CACHE_DAYS']
+MAX_VALUES_THREADS = int(os.environ.get('MAX_VALUES_THREADS', 4))  # Number of files downloaded / read at once
 MAX_PROPS = {
     'channel_rt': {
         'max_variable': 'streamflow',
@@ -23,7 +26,7 @@ MAX_PROPS = {
     }
 }
 
-def aggregate_max_to_file(fileset_bucket, fileset, output_file_bucket, output_file):
+def aggregate_max_to_file(fileset_bucket, fileset, output_file_bucket, output_file, include_time_of_max=False):
     """
         Iterates through a times series of National Water Model (NWM) channel_rt output NetCDF files, and finds the
         maximum flow of each NWM reach during this period.  Outputs a NetCDF file containing all NWM reaches and their
@@ -33,6 +36,8 @@ def aggregate_max_to_file(fileset_bucket, fileset, output_file_bucket, output_fi
             path_to_nwm_files (str or list): Path to the directory or list of the paths to the files to caclulate
                                              maximum flows on.
             output_netcdf (str): Key (path) of the max flows netcdf that will be store in S3
+            include_time_of_max (bool): Also write the time of each reach's maximum flow (e.g. for arrival time
+                                        products) to the output file.
     """
     model_var = [d for d in list(MAX_PROPS.keys()) if d in fileset[0]][0]
     max_props = MAX_PROPS[model_var]
@@ -42,13 +47,17 @@ def aggregate_max_to_file(fileset_bucket, fileset, output_file_bucket, output_fi
     max_result = aggregate_max(fileset_bucket, fileset, max_props)  # creates a max flow array for all reaches
 
     print(f"--> Creating {output_file}")
+    if not include_time_of_max:
+        max_result.pop('max_times')
     write_netcdf(max_result, output_file_bucket, output_file)  # creates the output NetCDF file
 
 
-def aggregate_max(fileset_bucket, fileset, max_props):
+def aggregate_max(fileset_bucket, fileset, max_props, threads=MAX_VALUES_THREADS):
     """
         Iterates through a times series of National Water Model (NWM) channel_rt output NetCDF files, and finds
-        the maximum flow of each NWM reach during this period.
+        the maximum flow of each NWM reach during this period, along with the time of that maximum. Up to 2 x threads
+        files are downloaded and read ahead at once, and only the max variable is read out of each file, while the
+        files are folded (in order) into a float32 max array.
         Args:
             data_bucket (str): S3 bucket name where the NWM files are stored
             active_file_paths (str or list): Path to the directory or list of the paths to the files to caclulate
@@ -56,24 +65,73 @@ def aggregate_max(fileset_bucket, fileset, max_props):
         Returns:
             max_flows (numpy array): Numpy array that contains all the max flows for each feature for the forecast
             feature_ids (numpy array): Numpy array that contains all the features ids for the forecast
+            max_times (numpy array): Numpy array that contains the (first) time of the max flow of each feature
     """
     max_var = max_props['max_variable']
     id_var = max_props['id']
-    identifiers = None
+    file_results = []
     max_vals = None
-    extras = None
+    max_time_index = None
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        pending = deque()
+        for index, file in enumerate(fileset):
+            # The first file also provides the identifiers and extras
+            pending.append(executor.submit(read_max_file, fileset_bucket, file, index, max_props, index == 0))
+            if len(pending) < threads * 2 and index < len(fileset) - 1:
+                continue
+
+            # Fold the finished files in order, keeping up to 2 x threads files in flight
+            while pending and (len(pending) >= threads * 2 or index == len(fileset) - 1):
+                file_result = pending.popleft().result()
+                temp_vals = file_result.pop('values').astype('float32')
+                file_results.append(file_result)
+
+                # compares the values in each file with those stored in the max_vals array, and keeps the
+                # maximum value (and the index of the file with the maximum value) for each entity
+                if max_vals is None:
+                    max_vals = temp_vals
+                    max_time_index = np.zeros(len(max_vals), dtype='int32')
+                else:
+                    max_time_index[temp_vals > max_vals] = file_result['index']
+                    np.maximum(max_vals, temp_vals, out=max_vals)
+
+    file_times = np.array([file_result['time'] for file_result in file_results])
+    return {
+        "identifiers": {"varname": id_var, "array": file_results[0]['identifiers']},
+        "max_values": {"varname": max_var, "array": max_vals},
+        "max_times": {"varname": f"{max_var}_max_time", "array": file_times[max_time_index]},
+        "extras": file_results[0]['extras']
+    }
+
+
+def read_max_file(fileset_bucket, file, index, max_props, read_identifiers=False):
+    """
+        Downloads one file of the max values fileset and reads its max variable (and its identifiers and extras, for
+        the first file) before deleting it.
+        Args:
+            fileset_bucket (str): S3 bucket name where the NWM files are stored
+            file (str): Key (path) of the file
+            index (int): Position of the file in the fileset, which is also used as its download subfolder, since
+                         files from different days can have the same name
+            max_props (dict): The MAX_PROPS of the model variable
+            read_identifiers (bool): Whether to also read the identifiers and extras
+        Returns:
+            file_result (dict): The values, time, identifiers, and extras of the file
+    """
+    max_var = max_props['max_variable']
+    print(f"--> Downloading {file}")
+    download_path = check_if_file_exists(fileset_bucket, file, download=True, download_subfolder=f"max_values_{index}")
 
-    for file in fileset:
-        print(f"--> Downloading {file}")
-        download_path = check_if_file_exists(fileset_bucket, file, download=True)
-        
+    identifiers = None
+    extras = None
+    try:
         with xarray.open_dataset(download_path) as ds:
-            temp_vals = ds[max_var].values.flatten()  # imports the values from each file
-            if max_vals is None:
-                max_vals = temp_vals
-            if identifiers is None:
-                identifiers = ds[id_var].values
-            if extras is None and max_props['extras']:
+            values = ds[max_var].values.flatten()  # imports the values from each file
+            time = ds['time'].values.flatten()[0] if 'time' in ds.variables and ds['time'].size else np.datetime64('NaT')
+            if read_identifiers:
+                identifiers = ds[max_props['id']].values
+            if read_identifiers and max_props['extras']:
                 extras = []
                 for extra in max_props['extras']:
                     try:
@@ -86,17 +144,10 @@ def aggregate_max(fileset_bucket, fileset, max_props):
                             'varname': extra,
                             'array': ds.attrs[extra]
                         })
+    finally:
         os.remove(download_path)
 
-        # compares the values in each file with those stored in the max_vals array, and keeps the
-        # maximum value for each entity
-        max_vals = np.maximum(max_vals, temp_vals)
-
-    return {
-        "identifiers": {"varname": id_var, "array": identifiers},
-        "max_values": {"varname": max_var, "array": max_vals},
-        "extras": extras
-    }
+    return {"index": index, "values": values, "time": time, "identifiers": identifiers, "extras": extras}
 
 
 def write_netcdf(max_result, output_file_bucket, output_file):
@@ -117,11 +168,14 @@ def write_netcdf(max_result, output_file_bucket, output_file):
     identifiers = max_result['identifiers']['array']
     values = max_result['max_values']['array']
     extras = max_result['extras'] 
+    max_times = max_result.get('max_times')
 
     # Create a dataframe from the identifiers and values arrays
     df = pd.DataFrame(identifiers, columns=[id_colname]).set_index(id_colname)
     df[values_colname] = values
     df[values_colname] = df[values_colname].fillna(0)
+    if max_times:
+        df[max_times['varname']] = max_times['array']
     if extras:
         for extra in extras:
             df[extra['varname']] = extra['array']
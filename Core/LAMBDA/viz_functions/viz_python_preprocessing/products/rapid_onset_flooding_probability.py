@@ -9,12 +9,10 @@ import os
 import boto3
 import tempfile
 from datetime import datetime, timedelta
-from itertools import cycle, islice
 
 from viz_lambda_shared_funcs import get_db_values, organize_input_files
 
 CFS_FROM_CMS = 35.315
-pd.options.mode.chained_assignment = None
 
 def run_rapid_onset_flooding_probability(reference_time, fileset_bucket, fileset, output_file_bucket, output_file):
     percent_change_threshold = 100
@@ -60,9 +58,7 @@ def srf_rapid_onset_probability(reference_time, a_input_files, percent_change_th
         stream_reaches_at_or_below (int): The stream order threshold by which to consider reaches.
     """
     reference_time = reference_time  # datetime.strptime(reference_time, '%Y-%m-%dT%H:%M:%SZ')
-    hours_in_day = list(range(0, 24))
     files = {}
-    dataframes = {}
 
     df_high_water_threshold = get_db_values("derived.recurrence_flows_conus", ["feature_id", "high_water_threshold"])
     df_high_water_threshold = df_high_water_threshold.set_index("feature_id")
@@ -73,15 +69,7 @@ def srf_rapid_onset_probability(reference_time, a_input_files, percent_change_th
 
     df_main = df_streamorder.join(df_high_water_threshold)
 
-    # Setup a dictionary of empty dataframes for each of the 7 ensemble members
     print("Organizing input files / ensemble members.")
-    # We're including the full 18 hour set for the ensemble members that have it, see vlab ticket for explantion.
-    ensemble_hours = list(islice(cycle(hours_in_day), reference_time.hour+1, reference_time.hour+1+18))
-    # This is a little complicated, but essentially slices a rolling list of hours in the day to get the
-    # correct ensemble members.
-    ensemble_members = list(islice(cycle(hours_in_day), (reference_time.hour+24)-6, (reference_time.hour+24)-6+7))
-    for mem in ensemble_members:
-        dataframes[mem] = pd.DataFrame()
 
     # Loop through the input files and parse out the important dates in order to organize our data processing.
     for file in a_input_files:
@@ -124,117 +112,32 @@ def srf_rapid_onset_probability(reference_time, a_input_files, percent_change_th
     df_all_input_files = df_all_input_files.sort_values(["model_initialization_date", "model_initialization_hour", "model_output_delta_hour"])
     df_all_input_files = df_all_input_files.reset_index()
 
-    def preprocess(ds):
-        ds['streamflow'] = ds['streamflow']*CFS_FROM_CMS
-        analysis_time = str(ds.time.values[0]).split(".")[0].replace("T", " ")
-        analysis_time = datetime.strptime(analysis_time, "%Y-%m-%d %H:%M:%S")
-        ds = ds.rename({'streamflow': analysis_time.hour})
-        ds = ds.drop_dims(['time', 'reference_time'])
-        return ds
-
-    drop_vars = ['crs', 'nudge', 'velocity', 'qSfcLatRunoff', 'qBucket', 'qBtmVertRunoff']
-
-    # Loop through ref_hour data frames and note reaches that meet rapid onset conditions within the 12-hour window.
+    # Loop through ref_hour members and note reaches that meet rapid onset conditions within the 12-hour window.
     print(f"Identifying reaches that meet rapid onset criteria ({percent_change_threshold}% increase and high flow threshold "
           f"within {high_water_hour_threshold} hours) in each ref_hour member.")
-    df_all = df_main
+    rof_counts = np.zeros((2, len(df_main)), dtype='int32')  # hour_1_6 and hour_7_12 ROF member counts of each reach
     ensembles_used = []
     for model_initialization_hour, df_model_initialization_hour in df_all_input_files.groupby("model_initialization_hour"):
         print(f"Processing model_initialization_hour {model_initialization_hour}")
-        model_output_valid_hours = df_model_initialization_hour['model_output_valid_hour'].values
-
-        df_ensemble = xr.open_mfdataset(df_model_initialization_hour['index'].values.tolist(), drop_variables=drop_vars, preprocess=preprocess, combine='by_coords').to_dataframe()  # Use dask to open up all ensemble files at once and change streamflow col to datetime
-        df_ensemble = df_ensemble[model_output_valid_hours]
-        df_ensemble = df_ensemble.loc[(df_ensemble!=0).any(axis=1)]  # Remove all rows with a 0 value for every timestep
-        df = df_ensemble.join(df_main)  # Join main data to ref_hour data
-        df = df[df['strm_order'] <= stream_reaches_at_or_below]  # Only look at lower order streams
-        df = df[df["high_water_threshold"] > 0]  # Only look at reaches with high water threshold above 0
-
-        df['double_increase'] = None
-        df['high_water_hour'] = None
-        df['in_rof'] = False
-        df['hour_1_6_rof'] = False
-        df['hour_7_12_rof'] = False
-        previous_hour_rof = None
-
-        for i, model_output_valid_hour in enumerate(model_output_valid_hours[1:]):  # Start on the second hour
-
-            
-            if model_output_valid_hour not in df:  # Skip to the next iteration if the hour is out of range
-                continue
-
-            if model_output_valid_hour in model_output_valid_hours[:6]:
-                hour_rof = 'hour_1_6_rof'
-            else:
-                hour_rof = 'hour_7_12_rof'
-
-            if not previous_hour_rof:
-                previous_hour_rof = hour_rof
-
-            # Identify reaches currently in ROF and ending because of drop of flow
-            rof_ending_condition = (df['in_rof']==True) & (df[model_output_valid_hour] < df['high_water_threshold']) & (df['high_water_hour'] < model_output_valid_hour)
-            df.loc[rof_ending_condition, hour_rof] = True
-            df.loc[rof_ending_condition, 'high_water_hour'] = None
-            df.loc[rof_ending_condition, 'in_rof'] = False
-
-            # Identify reaches currently in ROF and set ROF status to True. Will cover reaches in ROF over multiple days
-            rof_continous_condition = (df['in_rof']==True)
-            if previous_hour_rof != hour_rof:
-                df.loc[rof_continous_condition, hour_rof] = True
-
-            # Identify the hour of the 100%+ increase
-            double_increase_condition = (df[hour_rof]==False) & (df[model_output_valid_hour] >= (df[model_output_valid_hours[i]]*(1+(percent_change_threshold/100)))) & (df[model_output_valid_hour] != 0)
-            df_doubled = df[double_increase_condition]
-
-            # Checking if high water occurs in the next 6 hours (assuming 3 hour timesteps). If so, set high water hour accordingly
-            high_water_condition = (df_doubled[model_output_valid_hour]>=df_doubled['high_water_threshold'])
-            if len(df_doubled[high_water_condition]):
-                df_doubled.loc[high_water_condition, 'high_water_hour'] = model_output_valid_hour  # Identify the hour of high flow threshold conditions
-                df_doubled.loc[high_water_condition, 'in_rof'] = True
-                df_doubled.loc[high_water_condition, hour_rof] = True
-            
-            if model_output_valid_hour not in model_output_valid_hours[-1:]:
-                high_water_condition = (df_doubled[model_output_valid_hours[i+2]]>=df_doubled['high_water_threshold'])
-                if len(df_doubled[high_water_condition]):
-                    df_doubled.loc[high_water_condition, 'high_water_hour'] = model_output_valid_hours[i+2]  # Identify the hour of high flow threshold conditions
-                    df_doubled.loc[high_water_condition, 'in_rof'] = True
-                    df_doubled.loc[high_water_condition, hour_rof] = True
-
-            if model_output_valid_hour not in model_output_valid_hours[-2:]:
-                high_water_condition = (df_doubled[model_output_valid_hours[i+3]]>=df_doubled['high_water_threshold'])
-                if len(df_doubled[high_water_condition]):
-                    df_doubled.loc[high_water_condition, 'high_water_hour'] = model_output_valid_hours[i+3]  # Identify the hour of high flow threshold conditions
-                    df_doubled.loc[high_water_condition, 'in_rof'] = True
-                    df_doubled.loc[high_water_condition, hour_rof] = True
-
-            df.update(df_doubled)
-
-        df = df[df['hour_1_6_rof'] | df['hour_7_12_rof']]  # Remove rows where rapid onset flooding wont occur
-
-        # Rename the rapid onset column to the ensemble reference hour
-        df_ensemble = df.filter(items=['hour_1_6_rof', 'hour_7_12_rof'])
-        df_ensemble = df_ensemble.rename(columns={
-            "hour_1_6_rof": f"hour_1_6_rof_{model_initialization_hour}",
-            "hour_7_12_rof": f"hour_7_12_rof_{model_initialization_hour}"
-        })
+        model_output_valid_hours = df_model_initialization_hour['model_output_valid_hour'].values.astype('float64')
+        hour_categories = (np.arange(len(model_output_valid_hours)) >= 6).astype('int64')  # 0: hour_1_6, 1: hour_7_12
+
+        feature_ids, flows = read_member_flows(df_model_initialization_hour['index'].values.tolist())
+        rof_counts += count_member_rapid_onset_floods(
+            df_main, feature_ids, flows, model_output_valid_hours, hour_categories, 2, percent_change_threshold,
+            stream_reaches_at_or_below
+        )
         ensembles_used.append(model_initialization_hour)  # Create a list of the reference hours used
-        df_all = df_all.join(df_ensemble, on='feature_id')  # Add each ensemble dataframe to df_all as it's calculated.
-    
+
     # Calculate rapid onset flooding probability across ensemble members
     # These are the percentage values that we're going for.
     print("Consolidating and exporting data array.")
-    df_all = df_all.drop(columns=['strm_order', 'high_water_threshold'])
-    df_all = df_all.replace(False, np.nan)
-    df_all = df_all.dropna(how="all")
-
-    hour_1_6_ensembles = [f"hour_1_6_rof_{ensemble}" for ensemble in ensembles_used]
-    hour_7_12_ensembles = [f"hour_7_12_rof_{ensemble}" for ensemble in ensembles_used]
-    all_enembles_used = hour_1_6_ensembles + hour_7_12_ensembles
-
-    df_all['rapid_onset_prob_all'] = ((df_all[all_enembles_used].count(axis=1) / len(all_enembles_used)) * 100).astype(int)
-    df_all['rapid_onset_prob_1_6'] = ((df_all[hour_1_6_ensembles].count(axis=1) / len(ensembles_used)) * 100).astype(int)  # noqa: E501
-    df_all['rapid_onset_prob_7_12'] = ((df_all[hour_7_12_ensembles].count(axis=1) / len(ensembles_used)) * 100).astype(int)  # noqa: E501
-    df_all = df_all.reset_index()
+    has_rof = rof_counts.sum(axis=0) > 0
+    rof_counts = rof_counts[:, has_rof]
+    df_all = pd.DataFrame({"feature_id": df_main.index[has_rof]})
+    df_all['rapid_onset_prob_all'] = ((rof_counts.sum(axis=0) / (2 * len(ensembles_used))) * 100).astype(int)
+    df_all['rapid_onset_prob_1_6'] = ((rof_counts[0] / len(ensembles_used)) * 100).astype(int)
+    df_all['rapid_onset_prob_7_12'] = ((rof_counts[1] / len(ensembles_used)) * 100).astype(int)
 
     return df_all[["feature_id", "rapid_onset_prob_all", "rapid_onset_prob_1_6", "rapid_onset_prob_7_12"]]
 
@@ -255,7 +158,6 @@ def mrf_rapid_onset_probability(reference_time, a_input_files, percent_change_th
     """
     reference_time = reference_time  # datetime.strptime(reference_time, '%Y-%m-%dT%H:%M:%SZ')
     files = {}
-    dataframes = {}
 
     df_high_water_threshold = get_db_values("derived.recurrence_flows_conus", ["feature_id", "high_water_threshold"])
     df_high_water_threshold = df_high_water_threshold.set_index("feature_id")
@@ -266,7 +168,6 @@ def mrf_rapid_onset_probability(reference_time, a_input_files, percent_change_th
 
     df_main = df_streamorder.join(df_high_water_threshold)
 
-    # Setup a dictionary of empty dataframes for each of the 7 ensemble members
     print("Organizing input files / ensemble members.")
     # ensemble_hours = list(islice(cycle(hours_in_day), reference_time.hour+1, reference_time.hour+1+270, 3))
     ensemble_members = []
@@ -278,8 +179,6 @@ def mrf_rapid_onset_probability(reference_time, a_input_files, percent_change_th
                 ensemble_members.append(member)
             
     forecast_times = [reference_time + timedelta(hours=x) for x in range(3, 120, 3)]  # "Double check this!!!!
-    for mem in ensemble_members:
-        dataframes[mem] = pd.DataFrame()
 
     # Loop through the input files and parse out the important dates in order to organize our data processing.
     for file in a_input_files:
@@ -322,132 +221,165 @@ def mrf_rapid_onset_probability(reference_time, a_input_files, percent_change_th
     df_all_input_files = df_all_input_files.sort_values(["ensemble_member", "forecast_file"], ascending=True)
     df_all_input_files = df_all_input_files.reset_index()
 
-    def preprocess(ds):
-        ds['streamflow'] = ds['streamflow']*CFS_FROM_CMS
-        analysis_time = str(ds.time.values[0]).split(".")[0].replace("T", " ")
-        analysis_time = datetime.strptime(analysis_time, "%Y-%m-%d %H:%M:%S")
-        ds = ds.rename({'streamflow': analysis_time})
-        ds = ds.drop_dims(['time', 'reference_time'])
-        return ds
+    # Day of each forecast time (0: day1 ... 4: day5)
+    forecast_days = np.array([
+        next((day for day in range(4) if forecast_time <= reference_time + timedelta(days=day+1)), 4)
+        for forecast_time in forecast_times
+    ])
+    forecast_hours = np.array([(forecast_time - reference_time).total_seconds() / 3600 for forecast_time in forecast_times])
 
-    drop_vars = ['crs', 'nudge', 'velocity', 'qSfcLatRunoff', 'qBucket', 'qBtmVertRunoff']
-
-    # Loop through ensemble data frames and note reaches that meet rapid onset conditions within the 12-hour window.
+    # Loop through ensemble members and note reaches that meet rapid onset conditions within the 12-hour window.
     print(f"Identifying reaches that meet rapid onset criteria ({percent_change_threshold}% increase and high flow threshold "
           f"within {high_water_hour_threshold} hours) in each ensemble member.")
-    df_all = df_main
-
+    rof_counts = np.zeros((5, len(df_main)), dtype='int32')  # day1 - day5 ROF member counts of each reach
     ensembles_used = []
     for ensemble in ensemble_members:
         print(f"Processing ensemble {ensemble}")
         df_ensemble = df_all_input_files[df_all_input_files['ensemble_member']==ensemble]  # Get ensemble specific metadata
-        df_ensemble = xr.open_mfdataset(df_ensemble['index'].values.tolist(), drop_variables=drop_vars, preprocess=preprocess, combine='by_coords').to_dataframe()  # Use dask to open up all ensemble files at once and change streamflow col to datetime
-        df_ensemble = df_ensemble.loc[(df_ensemble!=0).any(axis=1)]  # Remove all rows with a 0 value for every timestep
-        df = df_ensemble.join(df_main)  # Join main data to ensemble data
-        df = df[df['strm_order'] <= stream_reaches_at_or_below]  # Only look at lower order streams
-        df = df[df["high_water_threshold"] > 0]  # Only look at reaches with high water threshold above 0
-
-        df['double_increase'] = None
-        df['high_water_hour'] = None
-        df['in_rof'] = False
-        df['day1_rof'] = False
-        df['day2_rof'] = False
-        df['day3_rof'] = False
-        df['day4_rof'] = False
-        df['day5_rof'] = False
-        previous_day_rof = None
-
-        for i, forecast_time in enumerate(forecast_times[1:]): #start at second hour, then i is the timestep before when using list
-            if forecast_time not in df:  # Skip to the next iteration if the hour is out of range
-                continue
-
-            if forecast_time <= reference_time + timedelta(days=1):
-                day_rof = 'day1_rof'
-            elif forecast_time <= reference_time + timedelta(days=2):
-                day_rof = 'day2_rof'
-            elif forecast_time <= reference_time + timedelta(days=3):
-                day_rof = 'day3_rof'
-            elif forecast_time <= reference_time + timedelta(days=4):
-                day_rof = 'day4_rof'
-            else:
-                day_rof = 'day5_rof'
-
-            if not previous_day_rof:
-                previous_day_rof = day_rof
-
-            # Identify reaches currently in ROF and ending because of drop of flow
-            rof_ending_condition = (df['in_rof']==True) & (df[forecast_time] < df['high_water_threshold']) & (df['high_water_hour'] < forecast_time)
-            df.loc[rof_ending_condition, day_rof] = True
-            df.loc[rof_ending_condition, 'high_water_hour'] = None
-            df.loc[rof_ending_condition, 'in_rof'] = False
-
-            # Identify reaches currently in ROF and set ROF status to True. Will cover reaches in ROF over multiple days
-            rof_continous_condition = (df['in_rof']==True)
-            if previous_day_rof != day_rof:
-                df.loc[rof_continous_condition, day_rof] = True
-
-            # Identify the hour of the 100%+ increase
-            double_increase_condition = (df[day_rof]==False) & (df[forecast_time] >= (df[forecast_times[i]]*(1+(percent_change_threshold/100)))) & (df[forecast_time] != 0)
-            df_doubled = df[double_increase_condition]
-
-            # Checking if high water occurs in the next 6 hours (assuming 3 hour timesteps). If so, set high water hour accordingly
-            high_water_condition = (df_doubled[forecast_time]>=df_doubled['high_water_threshold'])
-            if len(df_doubled[high_water_condition]):
-                df_doubled.loc[high_water_condition, 'high_water_hour'] = forecast_time  # Identify the hour of high flow threshold conditions
-                df_doubled.loc[high_water_condition, 'in_rof'] = True
-                df_doubled.loc[high_water_condition, day_rof] = True
-            
-            if forecast_time not in forecast_times[-1:]:
-                high_water_condition = (df_doubled[forecast_times[i+2]]>=df_doubled['high_water_threshold'])
-                if len(df_doubled[high_water_condition]):
-                    df_doubled.loc[high_water_condition, 'high_water_hour'] = forecast_times[i+2]  # Identify the hour of high flow threshold conditions
-                    df_doubled.loc[high_water_condition, 'in_rof'] = True
-                    df_doubled.loc[high_water_condition, day_rof] = True
-
-            if forecast_time not in forecast_times[-2:]:
-                high_water_condition = (df_doubled[forecast_times[i+3]]>=df_doubled['high_water_threshold'])
-                if len(df_doubled[high_water_condition]):
-                    df_doubled.loc[high_water_condition, 'high_water_hour'] = forecast_times[i+3]  # Identify the hour of high flow threshold conditions
-                    df_doubled.loc[high_water_condition, 'in_rof'] = True
-                    df_doubled.loc[high_water_condition, day_rof] = True
-
-            df.update(df_doubled)
-
-        df = df[df['day1_rof'] | df['day2_rof'] | df['day3_rof'] | df['day4_rof'] | df['day5_rof']]  # Remove rows where rapid onset flooding wont occur
-
-        # Rename the rapid onset column to the ensemble reference hour
-        df_ensemble = df.filter(items=['day1_rof', 'day2_rof', 'day3_rof', 'day4_rof','day5_rof'])
-        df_ensemble = df_ensemble.rename(columns={
-            "day1_rof": f"day1_rof_{ensemble}",
-            "day2_rof": f"day2_rof_{ensemble}",
-            "day3_rof": f"day3_rof_{ensemble}",
-            "day4_rof": f"day4_rof_{ensemble}",
-            "day5_rof": f"day5_rof_{ensemble}"
-        })
+        ensemble_times = df_ensemble['analysis_time'].tolist()
+        if ensemble_times != forecast_times:
+            missing_times = [str(forecast_time) for forecast_time in forecast_times if forecast_time not in ensemble_times]
+            raise KeyError(f"Ensemble {ensemble} is missing forecast times {missing_times}")
+
+        feature_ids, flows = read_member_flows(df_ensemble['index'].values.tolist())
+        rof_counts += count_member_rapid_onset_floods(
+            df_main, feature_ids, flows, forecast_hours, forecast_days, 5, percent_change_threshold,
+            stream_reaches_at_or_below
+        )
         ensembles_used.append(ensemble)  # Create a list of the reference hours used
-        df_all = df_all.join(df_ensemble, on='feature_id')  # Add each ensemble dataframe to df_all as it's calculated.
-        
+
     # Calculate rapid onset flooding probability across ensemble members
     # These are the percentage values that we're going for.
     print("Consolidating and exporting data array.")
-    df_all = df_all.drop(columns=['strm_order', 'high_water_threshold'])
-    df_all = df_all.replace(False, np.nan)
-    df_all = df_all.dropna(how="all")
-
-    day1_ensembles = [f"day1_rof_{ensemble}" for ensemble in ensembles_used]
-    day2_ensembles = [f"day2_rof_{ensemble}" for ensemble in ensembles_used]
-    day3_ensembles = [f"day3_rof_{ensemble}" for ensemble in ensembles_used]
-    day4_ensembles = [f"day4_rof_{ensemble}" for ensemble in ensembles_used]
-    day5_ensembles = [f"day5_rof_{ensemble}" for ensemble in ensembles_used]
-    days45_ensembles = day4_ensembles + day5_ensembles
-    all_enembles_used = day1_ensembles + day2_ensembles + day3_ensembles + day4_ensembles + day5_ensembles
-
-    df_all['rapid_onset_prob_all'] = ((df_all[all_enembles_used].count(axis=1) / len(all_enembles_used)) * 100).astype(int)
-    df_all['rapid_onset_prob_day1'] = ((df_all[day1_ensembles].count(axis=1) / len(ensembles_used)) * 100).astype(int)  # noqa: E501
-    df_all['rapid_onset_prob_day2'] = ((df_all[day2_ensembles].count(axis=1) / len(ensembles_used)) * 100).astype(int)  # noqa: E501
-    df_all['rapid_onset_prob_day3'] = ((df_all[day3_ensembles].count(axis=1) / len(ensembles_used)) * 100).astype(int)  # noqa: E501
-    df_all['rapid_onset_prob_day4_5'] = ((df_all[days45_ensembles].count(axis=1) / len(ensembles_used)) * 100).astype(int)  # noqa: E501
-    df_all = df_all.reset_index()
+    has_rof = rof_counts.sum(axis=0) > 0
+    rof_counts = rof_counts[:, has_rof]
+    df_all = pd.DataFrame({"feature_id": df_main.index[has_rof]})
+    df_all['rapid_onset_prob_all'] = ((rof_counts.sum(axis=0) / (5 * len(ensembles_used))) * 100).astype(int)
+    df_all['rapid_onset_prob_day1'] = ((rof_counts[0] / len(ensembles_used)) * 100).astype(int)
+    df_all['rapid_onset_prob_day2'] = ((rof_counts[1] / len(ensembles_used)) * 100).astype(int)
+    df_all['rapid_onset_prob_day3'] = ((rof_counts[2] / len(ensembles_used)) * 100).astype(int)
+    df_all['rapid_onset_prob_day4_5'] = (((rof_counts[3] + rof_counts[4]) / len(ensembles_used)) * 100).astype(int)
 
     # Format and return an array
     return df_all[["feature_id", "rapid_onset_prob_all", "rapid_onset_prob_day1", "rapid_onset_prob_day2", "rapid_onset_prob_day3", "rapid_onset_prob_day4_5"]]  # noqa: E501
+
+
+
+def read_member_flows(member_files):
+    """
+    Reads the streamflow (cfs) of an ensemble member's files into a (timestep x reach) array.
+
+    Args:
+        member_files(list): The member's files, in timestep order
+    Returns:
+        feature_ids(numpy array): The feature ids of the reaches
+        flows(numpy array): (timestep x reach) array of the streamflow
+    """
+    feature_ids = None
+    flows = None
+    for timestep, file in enumerate(member_files):
+        with xr.open_dataset(file) as ds:
+            timestep_flows = ds['streamflow'].values * CFS_FROM_CMS
+            if flows is None:
+                feature_ids = ds['feature_id'].values
+                flows = np.empty((len(member_files), len(feature_ids)), dtype=timestep_flows.dtype)
+            elif not np.array_equal(ds['feature_id'].values, feature_ids):
+                raise ValueError(f"The feature ids of {file} don't match the other ensemble member files")
+            flows[timestep] = timestep_flows
+    return feature_ids, flows
+
+
+def count_member_rapid_onset_floods(df_main, feature_ids, flows, labels, categories, n_categories,
+                                    percent_change_threshold=100, stream_reaches_at_or_below=4):
+    """
+    Finds which reaches of df_main have rapid onset flooding in each timestep category of one ensemble member. Only
+    lower order streams with a high water threshold, and with flow in at least one timestep, are considered.
+
+    Args:
+        df_main(DataFrame): The strm_order and high_water_threshold of every reach, indexed by feature_id
+        feature_ids(numpy array): The feature ids of the member's flows
+        flows(numpy array): (timestep x reach) array of the member's streamflow
+        labels(numpy array): The label (hour) of each timestep, which high water hours are compared by
+        categories(numpy array): The category (e.g. 0 for hours 1-6 and 1 for hours 7-12) of each timestep
+        n_categories(int): The number of categories
+        percent_change_threshold (int): Number representing the percent change threshold for rapid onset criteria.
+        stream_reaches_at_or_below (int): The stream order threshold by which to consider reaches.
+    Returns:
+        rof(numpy array): (category x df_main reach) array of 1s for the reaches with rapid onset flooding
+    """
+    df_reaches = df_main.reindex(feature_ids)
+    high_water_thresholds = df_reaches['high_water_threshold'].to_numpy(dtype='float64')
+    candidates = (
+        (df_reaches['strm_order'].to_numpy(dtype='float64') <= stream_reaches_at_or_below)
+        & (high_water_thresholds > 0)
+        & (flows != 0).any(axis=0)  # Skip reaches with a 0 value for every timestep
+    )
+
+    member_rof = find_rapid_onset_floods(
+        flows[None, :, candidates], labels[None], categories[None], n_categories, high_water_thresholds[candidates],
+        percent_change_threshold
+    )[0]
+
+    rof = np.zeros((n_categories, len(feature_ids)), dtype='int32')
+    rof[:, candidates] = member_rof
+    positions = pd.Index(feature_ids).get_indexer(df_main.index)
+    return np.where(positions >= 0, rof[:, positions], 0)
+
+
+def find_rapid_onset_floods(flows, labels, categories, n_categories, high_water_thresholds, percent_change_threshold=100):
+    """
+    Rapid onset flooding state machine, run on (member x timestep x reach) arrays. For every timestep after the first,
+    in each member:
+        - Reaches in ROF whose flow drops below the high water threshold after their high water hour end their ROF,
+          which is counted in the timestep's category.
+        - Reaches still in ROF are counted in the timestep's category, when it's a different category than the
+          first timestep's.
+        - Reaches not yet counted in the category whose flow increased by percent_change_threshold since the last
+          timestep (and isn't 0) start ROF if they reach the high water threshold in this timestep or one of the next
+          two. The high water hour is the last of those timesteps that reaches it.
+
+    Args:
+        flows(numpy array): (member x timestep x reach) array of the streamflow
+        labels(numpy array): (member x timestep) array of the label (hour) of each timestep
+        categories(numpy array): (member x timestep) array of the category of each timestep
+        n_categories(int): The number of categories
+        high_water_thresholds(numpy array): The high water threshold of each reach
+        percent_change_threshold (int): Number representing the percent change threshold for rapid onset criteria.
+    Returns:
+        rof(numpy array): (member x category x reach) boolean array of ROF in each category
+    """
+    n_members, n_timesteps, n_reaches = flows.shape
+    members = np.arange(n_members)
+    in_rof = np.zeros((n_members, n_reaches), dtype=bool)
+    high_water_hour = np.full((n_members, n_reaches), np.nan)
+    rof = np.zeros((n_members, n_categories, n_reaches), dtype=bool)
+    if n_timesteps < 2:
+        return rof
+
+    first_categories = categories[:, 1]
+    for timestep in range(1, n_timesteps):
+        flow = flows[:, timestep]
+        category_rof = rof[members, categories[:, timestep]]
+
+        # Identify reaches currently in ROF and ending because of drop of flow
+        rof_ending = in_rof & (flow < high_water_thresholds) & (high_water_hour < labels[:, timestep, None])
+        category_rof |= rof_ending
+        high_water_hour[rof_ending] = np.nan
+        in_rof &= ~rof_ending
+
+        # Identify reaches currently in ROF and set ROF status to True. Will cover reaches in ROF over multiple days
+        category_changed = categories[:, timestep] != first_categories
+        category_rof[category_changed] |= in_rof[category_changed]
+
+        # Identify the hour of the 100%+ increase
+        doubled = ~category_rof & (flow >= (flows[:, timestep-1] * (1+(percent_change_threshold/100)))) & (flow != 0)
+
+        # Checking if high water occurs in the next 6 hours (assuming 3 hour timesteps). If so, set high water hour accordingly
+        for high_water_timestep in range(timestep, min(timestep+3, n_timesteps)):
+            high_water = doubled & (flows[:, high_water_timestep] >= high_water_thresholds)
+            high_water_hour[high_water] = np.broadcast_to(labels[:, high_water_timestep, None], high_water.shape)[high_water]
+            in_rof |= high_water
+            category_rof |= high_water
+
+        rof[members, categories[:, timestep]] = category_rof
+    return rof
@@ -0,0 +1,105 @@
+-- Stores the HAND FIM cache rating curve steps of handfim_cache.hydrotable_cached as discharge ranges, so that the
+-- fim_caching_templates can look up the step of a forecast with an index probe (2b_query_fim_cache-hand.sql) and add
+-- newly processed steps with ON CONFLICT DO NOTHING instead of anti-joining the whole cache
+-- (3_add_any_processed_hand_fim_back_to_cache.sql). Run this once on the viz DB BEFORE deploying those templates. It is
+-- safe to run again, e.g. after the caches are truncated for a new HAND version.
+CREATE EXTENSION IF NOT EXISTS btree_gist;
+
+-- 1. Remove any duplicate steps that concurrent fim configurations slipped past the old anti-joins
+DELETE FROM handfim_cache.hydrotable_cached
+WHERE ctid IN (
+    SELECT ctid FROM (
+        SELECT ctid, row_number() OVER (PARTITION BY hand_id, rc_stage_ft ORDER BY ctid) AS duplicate
+        FROM handfim_cache.hydrotable_cached
+    ) AS steps
+    WHERE duplicate > 1
+);
+
+DELETE FROM handfim_cache.hydrotable_cached_max
+WHERE ctid IN (
+    SELECT ctid FROM (
+        SELECT ctid, row_number() OVER (PARTITION BY hand_id ORDER BY ctid) AS duplicate
+        FROM handfim_cache.hydrotable_cached_max
+    ) AS curves
+    WHERE duplicate > 1
+);
+
+DELETE FROM handfim_cache.hydrotable_cached_zero_stage
+WHERE ctid IN (
+    SELECT ctid FROM (
+        SELECT ctid, row_number() OVER (PARTITION BY hand_id ORDER BY ctid) AS duplicate
+        FROM handfim_cache.hydrotable_cached_zero_stage
+    ) AS curves
+    WHERE duplicate > 1
+);
+
+-- 2. The (rc_previous_discharge_cfs, rc_discharge_cfs] range of each step, i.e. the forecasts that the old
+-- "discharge_cfs > rc_previous_discharge_cfs AND discharge_cfs <= rc_discharge_cfs" condition matched. Steps that
+-- could never match (the first step of a rating curve has the max discharge as its previous one) are empty ranges.
+ALTER TABLE handfim_cache.hydrotable_cached
+    ADD COLUMN IF NOT EXISTS rc_discharge_range numrange GENERATED ALWAYS AS (
+        CASE WHEN rc_previous_discharge_cfs < rc_discharge_cfs
+            THEN numrange(rc_previous_discharge_cfs::numeric, rc_discharge_cfs::numeric, '(]')
+            ELSE 'empty'::numrange
+        END
+    ) STORED;
+
+-- 3. Steps of a rating curve never overlap, so any step overlapping a kept step of its hand_id is a leftover from a
+-- different rating curve and is dropped, keeping a single match per forecast. One pass over the steps in range order:
+-- the kept ranges of a hand_id are disjoint and sorted, so a step overlaps one of them iff it starts below the upper
+-- bound of the last one kept.
+DO $$
+DECLARE
+    step record;
+    last_hand_id integer;
+    last_upper numeric;
+    leftovers tid[] := '{}';
+BEGIN
+    FOR step IN
+        SELECT ctid, hand_id, lower(rc_discharge_range) AS lower_cfs, upper(rc_discharge_range) AS upper_cfs
+        FROM handfim_cache.hydrotable_cached
+        WHERE NOT isempty(rc_discharge_range)
+        ORDER BY hand_id, lower(rc_discharge_range), ctid
+    LOOP
+        IF step.hand_id IS NOT DISTINCT FROM last_hand_id AND step.lower_cfs < last_upper THEN
+            leftovers := leftovers || step.ctid;
+        ELSE
+            last_hand_id := step.hand_id;
+            last_upper := step.upper_cfs;
+        END IF;
+    END LOOP;
+
+    DELETE FROM handfim_cache.hydrotable_cached WHERE ctid = ANY(leftovers);
+END $$;
+
+-- 4. Constraints for ON CONFLICT DO NOTHING, which double as the lookup indexes. The GiST exclusion constraint is the
+-- (hand_id, rc_discharge_range) index that the range lookup probes.
+DO $$
+BEGIN
+    IF NOT EXISTS (
+        SELECT 1 FROM pg_constraint
+        WHERE conname = 'hydrotable_cached_discharge_range_excl'
+            AND conrelid = 'handfim_cache.hydrotable_cached'::regclass
+    ) THEN
+        ALTER TABLE handfim_cache.hydrotable_cached
+            ADD CONSTRAINT hydrotable_cached_discharge_range_excl
+            EXCLUDE USING gist (hand_id WITH =, rc_discharge_range WITH &&);
+    END IF;
+END $$;
+
+CREATE UNIQUE INDEX IF NOT EXISTS hydrotable_cached_hand_id_stage_idx
+    ON handfim_cache.hydrotable_cached (hand_id, rc_stage_ft);
+
+CREATE UNIQUE INDEX IF NOT EXISTS hydrotable_cached_max_hand_id_idx
+    ON handfim_cache.hydrotable_cached_max (hand_id);
+
+CREATE UNIQUE INDEX IF NOT EXISTS hydrotable_cached_zero_stage_hand_id_idx
+    ON handfim_cache.hydrotable_cached_zero_stage (hand_id);
+
+CREATE INDEX IF NOT EXISTS hydrotable_cached_geo_hand_id_stage_idx
+    ON handfim_cache.hydrotable_cached_geo (hand_id, rc_stage_ft);
+
+ANALYZE handfim_cache.hydrotable_cached;
+ANALYZE handfim_cache.hydrotable_cached_max;
+ANALYZE handfim_cache.hydrotable_cached_zero_stage;
+ANALYZE handfim_cache.hydrotable_cached_geo;
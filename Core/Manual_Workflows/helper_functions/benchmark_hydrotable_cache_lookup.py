@@ -0,0 +1,168 @@
+"""
+Benchmark of the HAND FIM cache lookup of 2b_query_fim_cache-hand.sql against the cache size, comparing the original
+rc_discharge_cfs / rc_previous_discharge_cfs join to the rc_discharge_range lookup of a cache migrated with
+db_updates/hydrotable_cached_ranges.sql, and checking that both return the same rows. The synthetic caches are built in
+scratch schemas of the target db, which are dropped afterwards. Run with the viz db environment variables set (see
+shared_funcs.get_db_credentials), or pass a connection string:
+
+    python benchmark_hydrotable_cache_lookup.py --cache-sizes 100000 1000000 2700000 --flows 50000
+"""
+import argparse
+import os
+import timeit
+
+import psycopg2
+
+LEGACY_SCHEMA = 'benchmark_hydrotable_cache_legacy'
+RANGES_SCHEMA = 'benchmark_hydrotable_cache_ranges'
+MIGRATION_FILE = os.path.join(os.path.dirname(__file__), '..', 'db_updates', 'hydrotable_cached_ranges.sql')
+STAGES = 84  # rating curve steps per hand_id, 0 to 83 ft
+
+CREATE_CACHE_SQL = """
+DROP SCHEMA IF EXISTS {schema} CASCADE;
+CREATE SCHEMA {schema};
+
+CREATE TABLE {schema}.hydrotable_cached_max AS
+SELECT
+    hand_id,
+    '4.5.11.1'::varchar(20) AS model_version,
+    round((power(83, 1.6) * scale)::numeric, 2)::double precision AS max_rc_discharge_cfs,
+    83::double precision AS max_rc_stage_ft
+FROM (SELECT hand_id, 1 + (hand_id::bigint * 7919 % 1000) / 10.0 AS scale FROM generate_series(1, {cache_size}) AS hand_id) AS curves;
+
+-- Each step covers (previous discharge, discharge], and the first step wraps around to the max discharge like the
+-- interpolated hydrotables of the HAND processing lambda
+CREATE TABLE {schema}.hydrotable_cached AS
+SELECT
+    hand_id,
+    round((power(stage, 1.6) * scale)::numeric, 2)::double precision AS rc_discharge_cfs,
+    round((power(CASE WHEN stage = 0 THEN 83 ELSE stage - 1 END, 1.6) * scale)::numeric, 2)::double precision
+        AS rc_previous_discharge_cfs,
+    stage AS rc_stage_ft,
+    CASE WHEN stage = 0 THEN 83 ELSE stage - 1 END AS rc_previous_stage_ft
+FROM (SELECT hand_id, 1 + (hand_id::bigint * 7919 % 1000) / 10.0 AS scale FROM generate_series(1, {cache_size}) AS hand_id) AS curves
+CROSS JOIN generate_series(0, 83) AS stage;
+
+CREATE TABLE {schema}.hydrotable_cached_geo (hand_id integer, rc_stage_ft integer);
+CREATE TABLE {schema}.hydrotable_cached_zero_stage (hand_id integer, rc_discharge_cms double precision, note text);
+
+-- Forecasts for a sample of the hand_ids, a few of them above the top of the rating curve (pseudo-random, so that both
+-- schemas get the same ones)
+CREATE TABLE {schema}.flows AS
+SELECT
+    hand_id,
+    round(((hand_id::bigint * 104729 % 10007) / 10007.0 * 1.05 * max_rc_discharge_cfs)::numeric, 2)::double precision
+        AS discharge_cfs,
+    'Pending'::text AS prc_status
+FROM {schema}.hydrotable_cached_max
+WHERE hand_id % greatest({cache_size} / {flows}, 1) = 0;
+"""
+
+LEGACY_INDEX_SQL = """
+CREATE INDEX ON {schema}.hydrotable_cached (hand_id);
+CREATE INDEX ON {schema}.hydrotable_cached_max (hand_id);
+ANALYZE {schema}.hydrotable_cached;
+ANALYZE {schema}.hydrotable_cached_max;
+ANALYZE {schema}.flows;
+"""
+
+LEGACY_LOOKUP_SQL = """
+SELECT fs.hand_id, fs.discharge_cfs, cf.rc_discharge_cfs, cf.rc_previous_discharge_cfs, cf.rc_stage_ft,
+    cf.rc_previous_stage_ft, cfm.max_rc_stage_ft, cfm.max_rc_discharge_cfs
+FROM {schema}.flows AS fs
+JOIN {schema}.hydrotable_cached_max AS cfm ON fs.hand_id = cfm.hand_id
+JOIN {schema}.hydrotable_cached AS cf ON fs.hand_id = cf.hand_id
+WHERE fs.prc_status = 'Pending'
+    AND (
+        (fs.discharge_cfs <= cf.rc_discharge_cfs AND fs.discharge_cfs > cf.rc_previous_discharge_cfs)
+        OR
+        ((fs.discharge_cfs >= cfm.max_rc_discharge_cfs) AND rc_stage_ft = 83)
+    )
+"""
+
+RANGES_LOOKUP_SQL = """
+SELECT fs.hand_id, fs.discharge_cfs, cf.rc_discharge_cfs, cf.rc_previous_discharge_cfs, cf.rc_stage_ft,
+    cf.rc_previous_stage_ft, cfm.max_rc_stage_ft, cfm.max_rc_discharge_cfs
+FROM {schema}.flows AS fs
+JOIN {schema}.hydrotable_cached_max AS cfm ON fs.hand_id = cfm.hand_id
+JOIN LATERAL (
+    SELECT hc.rc_discharge_cfs, hc.rc_previous_discharge_cfs, hc.rc_stage_ft, hc.rc_previous_stage_ft
+    FROM {schema}.hydrotable_cached AS hc
+    WHERE hc.hand_id = fs.hand_id
+        AND hc.rc_discharge_range @> fs.discharge_cfs::numeric
+    UNION ALL
+    SELECT hc.rc_discharge_cfs, hc.rc_previous_discharge_cfs, hc.rc_stage_ft, hc.rc_previous_stage_ft
+    FROM {schema}.hydrotable_cached AS hc
+    WHERE hc.hand_id = fs.hand_id
+        AND hc.rc_stage_ft = 83
+        AND fs.discharge_cfs >= cfm.max_rc_discharge_cfs
+        AND NOT hc.rc_discharge_range @> fs.discharge_cfs::numeric
+) AS cf ON TRUE
+WHERE fs.prc_status = 'Pending'
+"""
+
+
+def build_caches(cursor, cache_size, flows):
+    """ Builds the same synthetic cache in the legacy schema and, migrated to discharge ranges, in the ranges schema """
+    with open(MIGRATION_FILE) as migration_file:
+        migration_sql = migration_file.read().replace('handfim_cache.', f'{RANGES_SCHEMA}.')
+
+    for schema in (LEGACY_SCHEMA, RANGES_SCHEMA):
+        cursor.execute(CREATE_CACHE_SQL.format(schema=schema, cache_size=cache_size, flows=flows))
+    cursor.execute(LEGACY_INDEX_SQL.format(schema=LEGACY_SCHEMA))
+    cursor.execute(migration_sql)
+    cursor.execute(f"ANALYZE {RANGES_SCHEMA}.flows")
+
+
+def time_lookup(cursor, lookup_sql, repeat):
+    """ Best time in seconds of materializing the lookup, which is what the INSERT of the template does """
+    def lookup():
+        cursor.execute(f"SELECT count(*) FROM ({lookup_sql}) AS lookup")
+        return cursor.fetchone()[0]
+
+    return min(timeit.repeat(lookup, number=1, repeat=repeat)), lookup()
+
+
+def main(connection, cache_sizes, flows, repeat):
+    connection.autocommit = True
+    with connection.cursor() as cursor:
+        try:
+            for cache_size in cache_sizes:
+                build_caches(cursor, cache_size, flows)
+                legacy_sql = LEGACY_LOOKUP_SQL.format(schema=LEGACY_SCHEMA)
+                ranges_sql = RANGES_LOOKUP_SQL.format(schema=RANGES_SCHEMA)
+
+                cursor.execute(f"""
+                    SELECT count(*) FROM (
+                        (SELECT * FROM ({legacy_sql}) AS legacy EXCEPT ALL SELECT * FROM ({ranges_sql}) AS ranges)
+                        UNION ALL
+                        (SELECT * FROM ({ranges_sql}) AS ranges EXCEPT ALL SELECT * FROM ({legacy_sql}) AS legacy)
+                    ) AS differences
+                """)
+                differences = cursor.fetchone()[0]
+                assert differences == 0, f"{differences} rows differ between the lookups for {cache_size} hand_ids"
+
+                legacy_seconds, n_rows = time_lookup(cursor, legacy_sql, repeat)
+                ranges_seconds, _ = time_lookup(cursor, ranges_sql, repeat)
+                print(f"{cache_size} hand_ids ({cache_size * STAGES} cached steps), {n_rows} forecasts found: "
+                      f"legacy {legacy_seconds * 1000:.0f} ms, ranges {ranges_seconds * 1000:.0f} ms")
+        finally:
+            for schema in (LEGACY_SCHEMA, RANGES_SCHEMA):
+                cursor.execute(f"DROP SCHEMA IF EXISTS {schema} CASCADE")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cache-sizes', type=int, nargs='+', default=[10_000, 100_000, 1_000_000],
+                        help="number of hand_ids in the synthetic caches")
+    parser.add_argument('--flows', type=int, default=50_000, help="number of forecasts to look up")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--dsn', help="connection string of the target db, instead of the viz db environment")
+    args = parser.parse_args()
+
+    if args.dsn:
+        connection = psycopg2.connect(args.dsn)
+    else:
+        from shared_funcs import get_db_connection
+        connection = get_db_connection("viz")
+    main(connection, args.cache_sizes, args.flows, args.repeat)
@@ -0,0 +1,126 @@
+"""
+Benchmark of the rapid onset flooding state machine, comparing the original per-member pandas loop to the
+find_rapid_onset_floods array engine of the viz_python_preprocessing lambda on synthetic ensembles, and checking that
+both find the same ROF reaches. Run with the lambda requirements installed:
+
+    python benchmark_rapid_onset_flooding_probability.py --config srf --reaches 2700000 --legacy-reaches 200000
+"""
+import argparse
+import os
+import sys
+import timeit
+
+import numpy as np
+import pandas as pd
+
+# The lambda source and the viz_lambda_shared_funcs layer come first, ahead of the helper_functions modules of the same
+# names (viz_classes, viz_lambda_shared_funcs)
+LAMBDA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'LAMBDA')
+sys.path[:0] = [
+    os.path.join(LAMBDA_DIR, 'viz_functions', 'viz_python_preprocessing'),
+    os.path.join(LAMBDA_DIR, 'layers', 'viz_lambda_shared_funcs', 'python')
+]
+from products.rapid_onset_flooding_probability import find_rapid_onset_floods  # noqa: E402
+
+CONFIGS = {
+    # timestep labels and categories of the short range (hourly, 7 members) and medium range (3 hourly, 6 members) runs
+    'srf': {'members': 7, 'labels': np.arange(1, 13), 'categories': (np.arange(12) >= 6).astype('int64')},
+    'mrf': {'members': 6, 'labels': np.arange(3, 120, 3), 'categories': np.minimum((np.arange(3, 120, 3) - 1) // 24, 4)}
+}
+
+
+def legacy_member(df, labels, categories, n_categories, percent_change_threshold=100):
+    """ The original pandas loop of one ensemble member (df has a column per timestep label and high_water_threshold) """
+    category_cols = [f'cat{category}_rof' for category in range(n_categories)]
+    df['double_increase'] = None
+    df['high_water_hour'] = None
+    df['in_rof'] = False
+    for col in category_cols:
+        df[col] = False
+    previous_rof = None
+
+    labels = labels.tolist()
+    for i, label in enumerate(labels[1:]):
+        rof_col = category_cols[categories[i+1]]
+        if not previous_rof:
+            previous_rof = rof_col
+
+        rof_ending_condition = (df['in_rof']==True) & (df[label] < df['high_water_threshold']) & (df['high_water_hour'] < label)
+        df.loc[rof_ending_condition, rof_col] = True
+        df.loc[rof_ending_condition, 'high_water_hour'] = None
+        df.loc[rof_ending_condition, 'in_rof'] = False
+
+        rof_continous_condition = (df['in_rof']==True)
+        if previous_rof != rof_col:
+            df.loc[rof_continous_condition, rof_col] = True
+
+        double_increase_condition = (df[rof_col]==False) & (df[label] >= (df[labels[i]]*(1+(percent_change_threshold/100)))) & (df[label] != 0)
+        df_doubled = df[double_increase_condition]
+
+        high_water_labels = [label]
+        if label not in labels[-1:]:
+            high_water_labels.append(labels[i+2])
+        if label not in labels[-2:]:
+            high_water_labels.append(labels[i+3])
+        for high_water_label in high_water_labels:
+            high_water_condition = (df_doubled[high_water_label]>=df_doubled['high_water_threshold'])
+            if len(df_doubled[high_water_condition]):
+                df_doubled.loc[high_water_condition, 'high_water_hour'] = high_water_label
+                df_doubled.loc[high_water_condition, 'in_rof'] = True
+                df_doubled.loc[high_water_condition, rof_col] = True
+
+        df.update(df_doubled)
+
+    return df[category_cols].to_numpy(dtype=bool).T
+
+
+def synthetic_member(rng, reaches, timesteps):
+    """ Baseflows with random rises, so that a few percent of the reaches double and pass their threshold """
+    baseflow = rng.gamma(1.5, 20, reaches)
+    rises = rng.choice([1, 1.2, 2.5], (timesteps, reaches), p=[0.9, 0.07, 0.03]).cumprod(axis=0)
+    flows = np.round(baseflow * rises * rng.uniform(0.8, 1.2, (timesteps, reaches)), 2)
+    flows[:, rng.random(reaches) < 0.2] = 0
+    return flows
+
+
+def main(config, reaches, legacy_reaches):
+    rng = np.random.default_rng(0)
+    members = CONFIGS[config]['members']
+    labels = CONFIGS[config]['labels'].astype('float64')
+    categories = CONFIGS[config]['categories']
+    n_categories = categories.max() + 1
+    thresholds = np.round(rng.gamma(1.5, 20, reaches) * 4, 2)
+    flows = np.stack([synthetic_member(rng, reaches, len(labels)) for _ in range(members)])
+
+    engine_seconds = timeit.timeit(
+        lambda: [find_rapid_onset_floods(flows[[member]], labels[None], categories[None], n_categories, thresholds)
+                 for member in range(members)], number=1
+    )
+    rof = np.concatenate([
+        find_rapid_onset_floods(flows[[member]], labels[None], categories[None], n_categories, thresholds)
+        for member in range(members)
+    ])
+
+    legacy_seconds = 0
+    for member in range(members):
+        df = pd.DataFrame(flows[member, :, :legacy_reaches].T, columns=labels.tolist())
+        df['high_water_threshold'] = thresholds[:legacy_reaches]
+        start = timeit.default_timer()
+        legacy_rof = legacy_member(df, labels, categories, n_categories)
+        legacy_seconds += timeit.default_timer() - start
+        assert (legacy_rof == rof[member, :, :legacy_reaches]).all(), f"member {member} doesn't match the legacy loop"
+
+    print(f"{config}: {members} members x {len(labels)} timesteps x {reaches} reaches, "
+          f"{rof.any(axis=1).mean() * 100:.1f}% of member reaches in ROF")
+    print(f"legacy pandas loop: {legacy_seconds:.2f} s for {legacy_reaches} reaches "
+          f"(~{legacy_seconds * reaches / legacy_reaches:.1f} s for {reaches})")
+    print(f"array engine:       {engine_seconds:.2f} s for {reaches} reaches")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', choices=list(CONFIGS), default='srf')
+    parser.add_argument('--reaches', type=int, default=2_700_000)
+    parser.add_argument('--legacy-reaches', type=int, default=200_000)
+    args = parser.parse_args()
+    main(args.config, args.reaches, min(args.legacy_reaches, args.reaches))
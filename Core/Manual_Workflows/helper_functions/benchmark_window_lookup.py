@@ -0,0 +1,87 @@
+"""
+Micro-benchmark of the per-window hydroid -> stage lookup overhead in create_inundation_output, comparing the
+original approach (list membership check of np.unique values and a new mapping array allocated for every window) to
+the per-branch lookup table from build_stage_lut / lookup_stages of the viz_hand_fim_processing lambda. Run with the
+lambda requirements installed:
+
+    python benchmark_window_lookup.py --reaches 5000 --windows 20
+"""
+import argparse
+import os
+import sys
+import timeit
+
+import numpy as np
+
+# The lambda source and the viz_lambda_shared_funcs layer come first, ahead of the helper_functions modules of the same
+# names (viz_classes, viz_lambda_shared_funcs)
+LAMBDA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'LAMBDA')
+sys.path[:0] = [
+    os.path.join(LAMBDA_DIR, 'viz_functions', 'image_based', 'viz_hand_fim_processing'),
+    os.path.join(LAMBDA_DIR, 'layers', 'viz_lambda_shared_funcs', 'python')
+]
+for env_var in ['FIM_VERSION', 'HAND_BUCKET', 'HAND_VERSION']:
+    os.environ.setdefault(env_var, 'benchmark')
+
+from lambda_function import build_stage_lut, lookup_stages, HAND_WINDOW_SIZE  # noqa: E402
+
+
+def legacy_window(catchment_window, valid_catchments, hydroids, stages, hydro_id_max):
+    unique_window_catchments = np.unique(catchment_window).tolist()
+    window_valid_catchments = [catchment for catchment in unique_window_catchments if catchment in valid_catchments]
+    if not window_valid_catchments:
+        return None
+
+    mapping_ar_max = max(hydro_id_max, catchment_window.max())
+    mapping_ar = np.full(mapping_ar_max+1, -9999, dtype="float32")
+    mapping_ar[hydroids] = stages
+    reclass_window = mapping_ar[catchment_window]
+    return reclass_window != -9999
+
+
+def lut_window(catchment_window, stage_lut):
+    reclass_window, valid_window = lookup_stages(stage_lut, catchment_window)
+    if not valid_window.any():
+        return None
+    return valid_window
+
+
+def main(reaches, windows, hydro_id_base, catchments_per_window):
+    rng = np.random.default_rng(0)
+    catchment_hydroids = hydro_id_base + np.arange(reaches * 4)
+    hydroids = rng.choice(catchment_hydroids, reaches, replace=False)
+    stages = rng.uniform(0.1, 10, reaches)
+    catchment_windows = [
+        rng.choice(rng.choice(catchment_hydroids, catchments_per_window), (1, HAND_WINDOW_SIZE, HAND_WINDOW_SIZE)).astype('int32')
+        for _ in range(windows)
+    ]
+
+    valid_catchments = hydroids.tolist()
+    hydro_id_max = hydroids.max()
+    legacy_seconds = timeit.timeit(
+        lambda: [legacy_window(w, valid_catchments, hydroids, stages, hydro_id_max) for w in catchment_windows], number=1
+    )
+
+    setup_seconds = timeit.timeit(lambda: build_stage_lut(hydroids, stages), number=1)
+    stage_lut = build_stage_lut(hydroids, stages)
+    lut_seconds = timeit.timeit(lambda: [lut_window(w, stage_lut) for w in catchment_windows], number=1)
+
+    for legacy, lut in zip(
+        [legacy_window(w, valid_catchments, hydroids, stages, hydro_id_max) for w in catchment_windows],
+        [lut_window(w, stage_lut) for w in catchment_windows]
+    ):
+        assert (legacy is None and lut is None) or (legacy == lut).all()
+
+    print(f"{reaches} reaches, {windows} windows of {HAND_WINDOW_SIZE}x{HAND_WINDOW_SIZE}, hydroids from {hydro_id_base}")
+    print(f"legacy lookup:  {legacy_seconds / windows * 1000:.1f} ms per window")
+    print(f"lookup table:   {lut_seconds / windows * 1000:.1f} ms per window (+ {setup_seconds * 1000:.1f} ms once per branch)")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--reaches', type=int, default=5000)
+    parser.add_argument('--windows', type=int, default=20)
+    parser.add_argument('--hydro-id-base', type=int, default=12_000_000)
+    parser.add_argument('--catchments-per-window', type=int, default=200)
+    args = parser.parse_args()
+    main(args.reaches, args.windows, args.hydro_id_base, args.catchments_per_window)
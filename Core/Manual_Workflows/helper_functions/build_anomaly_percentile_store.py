@@ -0,0 +1,76 @@
+import os
+import tempfile
+import boto3
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+# These must match the PERCENTILE_* keys in the viz_python_preprocessing anomaly product
+PERCENTILES = [5, 10, 25, 75, 90, 95]
+PERCENTILE_TABLES = {
+    7: "viz_authoritative_data/derived_data/nwm_v21_7_day_average_percentiles/final_7day_all_{percentile}th_perc.nc",
+    14: "viz_authoritative_data/derived_data/nwm_v21_14_day_average_percentiles/final_14day_all_{percentile}th_perc.nc"
+}
+PERCENTILE_STORES = {
+    7: "viz_authoritative_data/derived_data/nwm_v21_7_day_average_percentiles/final_7day_percentiles_{name}.npy",
+    14: "viz_authoritative_data/derived_data/nwm_v21_14_day_average_percentiles/final_14day_percentiles_{name}.npy"
+}
+
+
+# Packs the six percentile NetCDF tables of an anomaly config into a single (day_of_year, feature_id, percentile)
+# .npy store (final_{7|14}day_percentiles_by_day.npy) plus its feature ids (final_{7|14}day_percentiles_feature_ids.npy).
+# The anomaly product reads only the reference day's slice of the store with S3 range requests, and falls back to the
+# NetCDF tables when the store does not exist. Values are kept in the tables' (decoded) cms values and dtype, so that
+# the products don't change. Re-run this whenever the percentile tables are updated.
+def build_anomaly_percentile_store(profile, bucket, anomaly_configs=(7, 14)):
+    s3_session = boto3.Session(profile_name=profile)
+    s3_client = s3_session.client('s3')
+    tempdir = tempfile.mkdtemp()
+
+    for anomaly_config in anomaly_configs:
+        datasets = []
+        for percentile in PERCENTILES:
+            key = PERCENTILE_TABLES[anomaly_config].format(percentile=percentile)
+            local_path = os.path.join(tempdir, os.path.basename(key))
+            print(f'Downloading {key}')
+            s3_client.download_file(bucket, key, local_path)
+            datasets.append(xr.open_dataset(local_path))
+
+        feature_ids = datasets[0]['feature_id'].values
+        n_days = datasets[0].sizes['time']
+        dtype = np.result_type(*[ds['streamflow'].dtype for ds in datasets])
+
+        # Positions of the store's feature ids in each table (the tables are normally in the same order)
+        positions = [pd.Index(ds['feature_id'].values).get_indexer(feature_ids) for ds in datasets]
+
+        store_path = os.path.join(tempdir, f'percentiles_{anomaly_config}day.npy')
+        store = np.lib.format.open_memmap(store_path, mode='w+', dtype=dtype, shape=(n_days, len(feature_ids), len(PERCENTILES)))
+        for day in range(n_days):
+            for i, ds in enumerate(datasets):
+                streamflow = ds.sel(time=day)['streamflow'].values
+                store[day, :, i] = np.where(positions[i] >= 0, streamflow[positions[i]], np.nan)
+        store.flush()
+        del store
+
+        feature_ids_path = os.path.join(tempdir, f'percentiles_{anomaly_config}day_feature_ids.npy')
+        np.save(feature_ids_path, feature_ids)
+
+        for ds in datasets:
+            ds.close()
+
+        for local_path, name in [(store_path, 'by_day'), (feature_ids_path, 'feature_ids')]:
+            key = PERCENTILE_STORES[anomaly_config].format(name=name)
+            print(f'Uploading {key}')
+            s3_client.upload_file(local_path, bucket, key)
+            os.remove(local_path)
+
+        for percentile in PERCENTILES:
+            os.remove(os.path.join(tempdir, os.path.basename(PERCENTILE_TABLES[anomaly_config].format(percentile=percentile))))
+
+    print(f'Built anomaly percentile stores for {list(anomaly_configs)} day configs')
+
+
+if __name__ == '__main__':
+    profile = 'ti'
+    bucket = 'hydrovis-ti-deployment-us-east-1'
+    build_anomaly_percentile_store(profile, bucket)
@@ -0,0 +1,137 @@
+import io
+import re
+import boto3
+import numpy as np
+import rasterio
+from rasterio.session import AWSSession
+from rasterio.windows import Window
+
+# Must match HAND_WINDOW_SIZE in the viz_hand_fim_processing lambda
+WINDOW_SIZE = 1024
+
+
+def index_catchment_grid(dataset, window_size=WINDOW_SIZE):
+    """
+        Builds the window index of a catchment grid, i.e. which row-major window_size x window_size windows each
+        hydro_id shows up in and the pixel bounding box of each hydro_id.
+
+        Returns:
+            arrays (dict): hydro_ids, window_offsets, window_ids, and bboxes arrays (see load_catchment_window_index
+                in the viz_hand_fim_processing lambda)
+    """
+    nodata = dataset.nodata
+    n_cols = -(-dataset.width // window_size)
+    n_rows = -(-dataset.height // window_size)
+
+    pair_hydro_ids, pair_window_ids, pair_bboxes = [], [], []
+    for window_row in range(n_rows):
+        for window_col in range(n_cols):
+            row_off, col_off = window_row * window_size, window_col * window_size
+            window = Window(col_off, row_off, min(window_size, dataset.width - col_off), min(window_size, dataset.height - row_off))
+            catchment_window = dataset.read(1, window=window).ravel()
+
+            valid = (catchment_window != 0)
+            if nodata is not None:
+                valid &= (catchment_window != nodata)
+            pixels = np.flatnonzero(valid)
+            if not pixels.size:
+                continue
+
+            # Group the valid pixels by hydro_id to get each hydro_id's bounding box within this window
+            values = catchment_window[pixels]
+            order = np.argsort(values, kind='stable')
+            values, pixels = values[order], pixels[order]
+            hydro_ids, starts = np.unique(values, return_index=True)
+            rows = pixels // int(window.width) + row_off
+            cols = pixels % int(window.width) + col_off
+
+            pair_hydro_ids.append(hydro_ids)
+            pair_window_ids.append(np.full(len(hydro_ids), window_row * n_cols + window_col))
+            pair_bboxes.append(np.column_stack([
+                np.minimum.reduceat(rows, starts), np.minimum.reduceat(cols, starts),
+                np.maximum.reduceat(rows, starts), np.maximum.reduceat(cols, starts)
+            ]))
+
+    if not pair_hydro_ids:
+        return {
+            'hydro_ids': np.array([], dtype='int32'), 'window_offsets': np.zeros(1, dtype='int64'),
+            'window_ids': np.array([], dtype='int32'), 'bboxes': np.empty((0, 4), dtype='int32')
+        }
+
+    pair_hydro_ids = np.concatenate(pair_hydro_ids)
+    pair_window_ids = np.concatenate(pair_window_ids)
+    pair_bboxes = np.concatenate(pair_bboxes)
+
+    # Sort the (hydro_id, window) pairs so that each hydro_id's windows are contiguous, then combine the bboxes
+    order = np.lexsort((pair_window_ids, pair_hydro_ids))
+    pair_hydro_ids, pair_window_ids, pair_bboxes = pair_hydro_ids[order], pair_window_ids[order], pair_bboxes[order]
+    hydro_ids, starts = np.unique(pair_hydro_ids, return_index=True)
+    bboxes = np.column_stack([
+        np.minimum.reduceat(pair_bboxes[:, 0], starts), np.minimum.reduceat(pair_bboxes[:, 1], starts),
+        np.maximum.reduceat(pair_bboxes[:, 2], starts), np.maximum.reduceat(pair_bboxes[:, 3], starts)
+    ])
+
+    return {
+        'hydro_ids': hydro_ids,
+        'window_offsets': np.append(starts, len(pair_hydro_ids)).astype('int64'),
+        'window_ids': pair_window_ids.astype('int32'),
+        'bboxes': bboxes.astype('int32')
+    }
+
+
+# Builds a gw_catchments_reaches_filtered_addedAttributes_{branch}_windows.npz next to every branch catchment grid of
+# a HAND version. The viz_hand_fim_processing lambda uses it to only read the raster windows that contain reaches
+# with a stage, and processes every window for any branch that has not been built. Re-run this for every new HAND_VERSION.
+def build_catchment_window_index(profile, bucket, hand_version, huc8_filter=None, overwrite=False):
+    s3_session = boto3.Session(profile_name=profile)
+    s3_client = s3_session.client('s3')
+    hand_prefix = f"fim/hand_{hand_version.replace('.', '_')}/hand_datasets"
+
+    paginator = s3_client.get_paginator('list_objects_v2')
+    pages = paginator.paginate(Bucket=bucket, Prefix=hand_prefix)
+
+    existing_keys = set()
+    catchment_keys = []
+    for page in pages:
+        for obj in page.get('Contents', []):
+            key = obj['Key']
+            existing_keys.add(key)
+            if re.search(r'/branches/[^/]+/gw_catchments_reaches_filtered_addedAttributes_[^/]+\.tif$', key):
+                catchment_keys.append(key)
+
+    built = 0
+    with rasterio.Env(AWSSession(s3_session)):
+        for key in catchment_keys:
+            huc8 = key.replace(f"{hand_prefix}/", "").split("/")[0]
+            if huc8_filter and huc8 not in huc8_filter:
+                continue
+
+            index_key = re.sub(r'\.tif$', '_windows.npz', key)
+            if index_key in existing_keys and not overwrite:
+                continue
+
+            print(f'Building {index_key}')
+            with rasterio.open(f's3://{bucket}/{key}') as dataset:
+                arrays = index_catchment_grid(dataset)
+                width, height = dataset.width, dataset.height
+
+            buffer = io.BytesIO()
+            np.savez_compressed(
+                buffer,
+                hand_version=np.array(hand_version),
+                width=np.array(width),
+                height=np.array(height),
+                window_size=np.array(WINDOW_SIZE),
+                **arrays
+            )
+            s3_client.put_object(Body=buffer.getvalue(), Bucket=bucket, Key=index_key)
+            built += 1
+
+    print(f'Built {built} catchment window indexes for HAND {hand_version}')
+
+
+if __name__ == '__main__':
+    profile = 'ti'
+    bucket = 'hydrovis-ti-deployment-us-east-1'
+    hand_version = '4.5.11.1'
+    build_catchment_window_index(profile, bucket, hand_version)
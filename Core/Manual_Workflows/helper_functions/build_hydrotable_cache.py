@@ -0,0 +1,62 @@
+import io
+import re
+import boto3
+import numpy as np
+import pandas as pd
+
+# These must match HYDROTABLE_COLUMNS in the viz_hand_fim_processing lambda
+HYDROTABLE_COLUMNS = ['HydroID', 'feature_id', 'stage', 'discharge_cms', 'LakeID']
+
+
+# Precompiles every hydroTable_{branch}.csv of a HAND version into a packed hydroTable_{branch}.npz next to it.
+# The viz_hand_fim_processing lambda reads the .npz (only the columns it needs, already typed and sorted) and
+# falls back to the csv for any branch that has not been built. Re-run this for every new HAND_VERSION.
+def build_hydrotable_cache(profile, bucket, hand_version, huc8_filter=None, overwrite=False):
+    s3_session = boto3.Session(profile_name=profile)
+    s3_client = s3_session.client('s3')
+    hand_prefix = f"fim/hand_{hand_version.replace('.', '_')}/hand_datasets"
+
+    paginator = s3_client.get_paginator('list_objects_v2')
+    pages = paginator.paginate(Bucket=bucket, Prefix=hand_prefix)
+
+    existing_keys = set()
+    hydrotable_keys = []
+    for page in pages:
+        for obj in page.get('Contents', []):
+            key = obj['Key']
+            existing_keys.add(key)
+            if re.search(r'/branches/[^/]+/hydroTable_[^/]+\.csv$', key):
+                hydrotable_keys.append(key)
+
+    built = 0
+    for key in hydrotable_keys:
+        huc8 = key.replace(f"{hand_prefix}/", "").split("/")[0]
+        if huc8_filter and huc8 not in huc8_filter:
+            continue
+
+        cache_key = re.sub(r'\.csv$', '.npz', key)
+        if cache_key in existing_keys and not overwrite:
+            continue
+
+        print(f'Building {cache_key}')
+        obj = s3_client.get_object(Bucket=bucket, Key=key)
+        df = pd.read_csv(obj['Body'], usecols=HYDROTABLE_COLUMNS)
+        df = df.sort_values(['HydroID', 'discharge_cms', 'stage'], kind='stable')
+
+        buffer = io.BytesIO()
+        np.savez_compressed(
+            buffer,
+            hand_version=np.array(hand_version),
+            **{column: df[column].to_numpy() for column in HYDROTABLE_COLUMNS}
+        )
+        s3_client.put_object(Body=buffer.getvalue(), Bucket=bucket, Key=cache_key)
+        built += 1
+
+    print(f'Built {built} precompiled hydrotables for HAND {hand_version}')
+
+
+if __name__ == '__main__':
+    profile = 'ti'
+    bucket = 'hydrovis-ti-deployment-us-east-1'
+    hand_version = '4.5.11.1'
+    build_hydrotable_cache(profile, bucket, hand_version)